@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import glob
+import gzip
+import time
+import argparse
+import threading
+
+
+# bytes read from a container stream at once, the only buffer a follower holds besides gzip's
+CHUNK_BYTES = 64*1024
+SUFFIX = '.log.gz'
+
+
+def part_path(out_dir, container, part):
+    return os.path.join(out_dir, f'{container}.{part}{SUFFIX}')
+
+
+class RotatingLog(object):
+    """
+    Output of one container written to gzip parts of max_bytes (uncompressed)
+    each. Past max_parts the oldest part but the first one is removed, so the
+    start of the log (startup, build errors) and its end are kept
+    """
+    def __init__(self, out_dir, container, max_bytes=16*1024**2, max_parts=4, compresslevel=1):
+        super(RotatingLog, self).__init__()
+        self.out_dir = out_dir
+        self.container = container
+        self.max_bytes = max_bytes
+        self.max_parts = max(max_parts, 2)
+        # fastest level: logs are mostly repeated text and compress well anyway
+        self.compresslevel = compresslevel
+        self.parts = []
+        self.file = None
+        self.part_bytes = 0
+        self.dropped_bytes = 0
+        self.open_part(0)
+
+    def open_part(self, part):
+        self.file = gzip.open(part_path(self.out_dir, self.container, part), 'wb', compresslevel=self.compresslevel)
+        self.parts.append([part, 0])
+        self.part_bytes = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.part_bytes += len(data)
+        self.parts[-1][1] += len(data)
+        if self.part_bytes >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        # numbered before the removal, with two parts the one removed is the last one
+        next_part = self.parts[-1][0] + 1
+        if len(self.parts) == self.max_parts:
+            part, size = self.parts.pop(1)
+            os.remove(part_path(self.out_dir, self.container, part))
+            self.dropped_bytes += size
+        self.open_part(next_part)
+
+    def close(self):
+        self.file.close()
+
+    def index(self):
+        '''
+        Returns [(container, part, path, bytes)] of the parts on disk
+        '''
+        return [(self.container, part, part_path(self.out_dir, self.container, part), size) for part, size in self.parts]
+
+
+class ContainerLogCollector(object):
+    """
+    Streams the output of every container of a trial into a RotatingLog per
+    container under out_dir, one thread per container, from start() until
+    stop(). Memory stays at one chunk per container whatever they print: a
+    container writing faster than gzip keeps up is slowed by the pipe, not buffered
+    """
+    def __init__(self, runtime, out_dir, max_bytes=16*1024**2, max_parts=4):
+        super(ContainerLogCollector, self).__init__()
+        self.runtime = runtime
+        self.out_dir = out_dir
+        self.max_bytes = max_bytes
+        self.max_parts = max_parts
+        self.logs = {}
+        self.streams = {}
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def start(self, containers, since=None):
+        '''
+        since: unix time of the first output kept, for containers reused from an earlier trial
+        '''
+        os.makedirs(self.out_dir, exist_ok=True)
+        # a retried trial starts over
+        for path in glob.glob(os.path.join(self.out_dir, '*'+SUFFIX)):
+            os.remove(path)
+        for container in containers:
+            self.logs[container] = RotatingLog(self.out_dir, container, self.max_bytes, self.max_parts)
+            thread = threading.Thread(target=self.follow, args=(container, since), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def follow(self, container, since):
+        log = self.logs[container]
+        try:
+            stream = self.runtime.log_stream(container, since)
+            with self.lock:
+                self.streams[container] = stream
+                if self.stopping:
+                    stream.close()
+            while True:
+                data = stream.read(CHUNK_BYTES)
+                if not data:
+                    break
+                log.write(data)
+        except Exception as e:
+            # logs are best effort, a trial never fails over them; a closed stream ends up here too
+            if not self.stopping:
+                print(f'Log of {container} interrupted: {e}')
+        finally:
+            log.close()
+
+    def stop(self, grace_s=1.0):
+        '''
+        Waits up to grace_s for the streams to end with their containers, closes
+        the ones still open and returns the index of the files, see RotatingLog.index
+        '''
+        deadline = time.time() + grace_s
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+        with self.lock:
+            self.stopping = True
+            for stream in self.streams.values():
+                stream.close()
+        for thread in self.threads:
+            thread.join()
+        index = []
+        for log in self.logs.values():
+            index.extend(log.index())
+            if log.dropped_bytes:
+                print(f'Log of {log.container}: {log.dropped_bytes} bytes of the middle rotated out')
+        return index
+
+
+def read_log(out_dir, container):
+    # parts in order, a gap in the part numbers is output that was rotated out
+    paths = glob.glob(os.path.join(out_dir, f'{glob.escape(container)}.*{SUFFIX}'))
+    prefix = os.path.join(out_dir, container+'.')
+    # the pattern also matches the parts of a container named like '<container>.1'
+    parts = sorted((int(path[len(prefix):-len(SUFFIX)]), path) for path in paths
+                   if path[len(prefix):-len(SUFFIX)].isdigit())
+    previous = None
+    for part, path in parts:
+        if previous is not None and part != previous + 1:
+            yield f'[... parts {previous + 1} to {part - 1} rotated out ...]\n'.encode()
+        previous = part
+        with gzip.open(path, 'rb') as file:
+            while True:
+                data = file.read(CHUNK_BYTES)
+                if not data:
+                    break
+                yield data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the captured container logs of a trial')
+    parser.add_argument('dir', help='trial directory, e.g. log/containers/01_aaaaab')
+    parser.add_argument('containers', nargs='*', help='containers to print, all of them by default')
+    args = parser.parse_args()
+    containers = args.containers
+    if not containers:
+        names = {os.path.basename(path)[:-len(SUFFIX)].rsplit('.', 1)[0]
+                 for path in glob.glob(os.path.join(args.dir, '*'+SUFFIX))}
+        containers = sorted(names)
+    for container in containers:
+        if len(containers) > 1:
+            print(f'==> {container} <==', flush=True)
+        for data in read_log(args.dir, container):
+            sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+if __name__ == '__main__':
+    main()
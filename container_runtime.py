@@ -0,0 +1,524 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import json
+import shlex
+import select
+import socket
+import struct
+import hashlib
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+# DOCKER_HOST=unix:///path/to/fake.sock points the engine runtime at a stand-in engine
+DOCKER_SOCKET = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+API_VERSION = 'v1.41'
+
+# labels shared with docker-compose, so `docker-compose ps/down` still see our containers
+PROJECT_LABEL = 'com.docker.compose.project'
+SERVICE_LABEL = 'com.docker.compose.service'
+CONFIG_LABEL = 'com.docker.compose.config-hash'
+
+# header of a frame of the multiplexed stdout/stderr log stream of a container without a tty
+LOG_FRAME = struct.Struct('>BxxxI')
+
+# requests sent again when their reply is lost; a second create or start may fail or leave a duplicate
+RETRIED_METHODS = ('GET', 'HEAD')
+
+# units of the sizes printed by docker stats
+SIZE_UNITS = {'b': 1, 'kb': 1000, 'mb': 1000**2, 'gb': 1000**3, 'tb': 1000**4,
+              'kib': 1024, 'mib': 1024**2, 'gib': 1024**3, 'tib': 1024**4}
+
+
+def default_project_name(path):
+    # what docker-compose (v1) uses when no -p is given
+    return re.sub(r'[^a-z0-9]', '', os.path.basename(path).lower())
+
+
+def socket_path_of(docker_host):
+    '''
+    unix:///var/run/docker.sock or /var/run/docker.sock -> /var/run/docker.sock;
+    the engine runtime only speaks HTTP over a unix socket
+    '''
+    if '://' not in docker_host:
+        return docker_host
+    url = urllib.parse.urlparse(docker_host)
+    if url.scheme != 'unix' or not url.path:
+        raise Exception(f'{docker_host}: the engine runtime needs a unix:// docker socket, '
+                        f'use --runtime compose for other docker hosts')
+    return url.path
+
+
+def dependency_levels(services):
+    '''
+    Groups the services in levels, every service only depends on services of
+    earlier levels, e.g. [['master'], ['morse', 'ros1_bridge', 'motion_ctrl1'], ['pytrees1']]
+    '''
+    remaining = {name: set(service.get('depends_on', [])) & set(services) for name, service in services.items()}
+    levels = []
+    while remaining:
+        level = sorted(name for name, deps in remaining.items() if not deps)
+        if not level:
+            raise Exception(f'circular depends_on between {sorted(remaining)}')
+        levels.append(level)
+        for name in level:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(level)
+    return levels
+
+
+def parse_size(text):
+    # '0B', '4.1kB', '12.5MiB' -> bytes
+    match = re.match(r'\s*([0-9.]+)\s*([A-Za-z]*)', text)
+    if match is None:
+        return 0.0
+    return float(match.group(1))*SIZE_UNITS.get(match.group(2).lower(), 1)
+
+
+def parse_size_pair(text):
+    # '1.2MB / 4.1kB' -> (1200000.0, 4100.0)
+    first, _, second = text.partition('/')
+    return parse_size(first), parse_size(second)
+
+
+def engine_stats(sample):
+    '''
+    Reduces one /containers/{id}/stats sample of the Engine API to the fields
+    of docker stats: cpu_percent, mem_bytes, block_read, block_write, net_rx, net_tx
+    '''
+    cpu = sample.get('cpu_stats', {})
+    precpu = sample.get('precpu_stats', {})
+    cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - precpu.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    online = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or [1])
+    io = sample.get('blkio_stats', {}).get('io_service_bytes_recursive') or []
+    networks = (sample.get('networks') or {}).values()
+    return {
+        'cpu_percent': 100.0*cpu_delta/system_delta*online if system_delta > 0 and cpu_delta > 0 else 0.0,
+        'mem_bytes': float(sample.get('memory_stats', {}).get('usage', 0)),
+        'block_read': float(sum(entry['value'] for entry in io if entry.get('op', '').lower() == 'read')),
+        'block_write': float(sum(entry['value'] for entry in io if entry.get('op', '').lower() == 'write')),
+        'net_rx': float(sum(network.get('rx_bytes', 0) for network in networks)),
+        'net_tx': float(sum(network.get('tx_bytes', 0) for network in networks)),
+    }
+
+
+class ComposeRuntime(object):
+    """Runs the compose file written by the orchestrator through the docker-compose CLI"""
+    def __init__(self, compose_name, project_name=None):
+        super(ComposeRuntime, self).__init__()
+        self.compose_name = compose_name
+        self.project_name = project_name
+
+    def compose_cmd(self, action):
+        project = '' if self.project_name is None else f'-p {self.project_name} '
+        return shlex.split(f'docker-compose {project}-f {self.compose_name} {action}')
+
+    def run(self, action):
+        # output goes straight to ours as it is printed, instead of being held until the command ends
+        process = subprocess.run(self.compose_cmd(action))
+        if process.returncode != 0:
+            raise Exception(f'docker-compose {action} failed with exit code {process.returncode}')
+        return process
+
+    def create(self, services, networks):
+        # builds images and creates the containers, so a later up only has to start them
+        self.run('up --no-start')
+
+    def up(self, services, networks, remove_orphans=False):
+        # with an unchanged compose file this only starts the stopped containers
+        self.run('up -d --remove-orphans' if remove_orphans else 'up -d')
+
+    def stop(self, names, timeout_s=10):
+        self.run(f'stop -t {timeout_s} '+' '.join(names))
+
+    def down(self):
+        self.run('down')
+
+    def running_services(self):
+        '''
+        Returns the names of the running services, None if they can not be listed
+        '''
+        process = subprocess.run(self.compose_cmd('ps --services --filter status=running'),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        if process.returncode != 0:
+            return None
+        return process.stdout.split()
+
+    def stats(self):
+        '''
+        Returns {container name: engine_stats() like dict} with one docker stats
+        sample of every running container of the project
+        '''
+        ids = subprocess.run(self.compose_cmd('ps -q'),
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             universal_newlines=True).stdout.split()
+        if not ids:
+            return {}
+        process = subprocess.run(['docker', 'stats', '--no-stream', '--format', '{{json .}}']+ids,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 universal_newlines=True)
+        stats = {}
+        for line in process.stdout.splitlines():
+            row = json.loads(line)
+            block_read, block_write = parse_size_pair(row.get('BlockIO', ''))
+            net_rx, net_tx = parse_size_pair(row.get('NetIO', ''))
+            stats[row['Name']] = {
+                'cpu_percent': float(row.get('CPUPerc', '0').rstrip('%') or 0),
+                'mem_bytes': parse_size_pair(row.get('MemUsage', ''))[0],
+                'block_read': block_read,
+                'block_write': block_write,
+                'net_rx': net_rx,
+                'net_tx': net_tx,
+            }
+        return stats
+
+    def log_stream(self, container, since=None):
+        cmd = ['docker', 'logs', '--follow', '--timestamps']
+        if since is not None:
+            cmd += ['--since', f'{since:.3f}']
+        return ProcessLogStream(cmd+[container])
+
+
+class ProcessLogStream(object):
+    """Output of a docker logs --follow process, read as it comes"""
+    def __init__(self, cmd):
+        super(ProcessLogStream, self).__init__()
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+    def read(self, size):
+        # whatever is in the pipe, up to size, without waiting for size bytes
+        return os.read(self.process.stdout.fileno(), size)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP/1.1 keep-alive connection over a unix socket"""
+    def __init__(self, socket_path, timeout=60):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+    def dropped(self):
+        # an idle keep-alive connection has nothing to read, unless the engine closed it
+        return self.sock is not None and bool(select.select([self.sock], [], [], 0)[0])
+
+
+class EngineLogStream(object):
+    """
+    Followed /containers/{id}/logs response, on its own connection since it never
+    ends while the container runs. Without a tty stdout and stderr come in
+    frames, whose headers are stripped
+    """
+    def __init__(self, socket_path, url, tty):
+        super(EngineLogStream, self).__init__()
+        self.connection = UnixHTTPConnection(socket_path, timeout=None)
+        self.connection.request('GET', url)
+        self.response = self.connection.getresponse()
+        if self.response.status != 200:
+            data = self.response.read()
+            self.connection.close()
+            raise Exception(f'GET {url} failed with {self.response.status}: {data.decode(errors="replace").strip()}')
+        self.tty = tty
+        self.frame_left = 0
+
+    def read(self, size):
+        if self.tty:
+            return self.response.read1(size)
+        if self.frame_left == 0:
+            header = self.response.read(LOG_FRAME.size)
+            if len(header) < LOG_FRAME.size:
+                return b''
+            _, self.frame_left = LOG_FRAME.unpack(header)
+            if self.frame_left == 0:
+                return self.read(size)
+        data = self.response.read1(min(size, self.frame_left))
+        self.frame_left -= len(data)
+        return data
+
+    def close(self):
+        # shutdown wakes up a read blocked in another thread, close alone does not
+        sock = self.connection.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.connection.close()
+
+
+class DockerEngineRuntime(object):
+    """
+    Talks to the Docker Engine API directly, creating and starting the compose
+    services in dependency order, the services of one level in parallel.
+    Point socket_path at a fake engine (tests/fake_engine.py) to exercise it without docker.
+    """
+    def __init__(self, project_name, base_path, socket_path=DOCKER_SOCKET, workers=8):
+        super(DockerEngineRuntime, self).__init__()
+        self.project_name = project_name
+        self.base_path = base_path
+        self.socket_path = socket_path_of(socket_path)
+        self.workers = workers
+        # one persistent connection per thread, http.client connections are not thread safe
+        self.local = threading.local()
+        self.build_lock = threading.Lock()
+        self.services = {}
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = UnixHTTPConnection(self.socket_path)
+        elif self.local.connection.dropped():
+            # closed by the engine while idle, reconnect before sending anything on it
+            self.local.connection.close()
+        return self.local.connection
+
+    def request(self, method, path, body=None, query=None, ok=(200, 201, 204)):
+        url = f'/{API_VERSION}{path}'
+        if query:
+            url += '?'+urllib.parse.urlencode(query)
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        for attempt in range(2):
+            connection = self.connection()
+            sent = False
+            try:
+                connection.request(method, url, body=payload, headers=headers)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self.local.connection = None
+                # reconnect once, but only send a request twice when that is harmless
+                if attempt or (sent and method not in RETRIED_METHODS):
+                    raise
+        if response.status not in ok:
+            raise Exception(f'{method} {path} failed with {response.status}: {data.decode(errors="replace").strip()}')
+        if data and response.getheader('Content-Type', '').startswith('application/json'):
+            return response.status, json.loads(data)
+        return response.status, None
+
+    def in_parallel(self, function, items):
+        items = list(items)
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+            return list(pool.map(function, items))
+
+    def network_name(self, name):
+        return f'{self.project_name}_{name}'
+
+    def host_path(self, path):
+        path = os.path.expanduser(os.path.expandvars(path))
+        if not os.path.isabs(path):
+            path = os.path.normpath(os.path.join(self.base_path, path))
+        return path
+
+    def binds(self, volumes):
+        binds = []
+        for volume in volumes:
+            source, rest = volume.split(':', 1)
+            binds.append(f'{self.host_path(source)}:{os.path.expandvars(rest)}')
+        return binds
+
+    def env_files(self, paths):
+        env = []
+        for path in paths:
+            with open(self.host_path(path)) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#') and '=' in line:
+                        env.append(line)
+        return env
+
+    def image_for(self, name, service):
+        if 'image' in service:
+            return service['image']
+        # same tag docker-compose gives to the images it builds, so both share them
+        return f'{self.project_name}_{name}'
+
+    def ensure_image(self, name, service):
+        image = self.image_for(name, service)
+        status, _ = self.request('GET', f'/images/{image}/json', ok=(200, 404))
+        if status == 200:
+            return
+        if 'build' not in service:
+            self.request('POST', '/images/create', query={'fromImage': image})
+            return
+        context = self.host_path(service['build']['context'])
+        dockerfile = os.path.join(context, service['build'].get('dockerfile', 'Dockerfile'))
+        print(f'Building {image} from {dockerfile}')
+        build_process = subprocess.run(['docker', 'build', '-f', dockerfile, '-t', image, context],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       universal_newlines=True)
+        if build_process.returncode != 0:
+            print(build_process.stdout)
+            raise Exception(f'could not build {image}')
+
+    def container_config(self, name, service):
+        networks = service.get('networks', [])
+        if isinstance(networks, list):
+            networks = {network: None for network in networks}
+        endpoints = {}
+        for network, settings in networks.items():
+            endpoint = {'Aliases': [name]}
+            if settings and 'ipv4_address' in settings:
+                endpoint['IPAMConfig'] = {'IPv4Address': settings['ipv4_address']}
+            endpoints[self.network_name(network)] = endpoint
+        host_config = {
+            'Binds': self.binds(service.get('volumes', [])),
+            'Privileged': service.get('privileged', False),
+            'NetworkMode': self.network_name(next(iter(networks))) if networks else 'default',
+        }
+        if 'runtime' in service:
+            host_config['Runtime'] = service['runtime']
+        config = {
+            'Image': self.image_for(name, service),
+            'Hostname': name,
+            'Env': self.env_files(service.get('env_file', [])) + list(service.get('environment', [])),
+            'Cmd': shlex.split(service['command']) if 'command' in service else None,
+            'Tty': service.get('tty', False),
+            'ExposedPorts': {f'{port}/tcp': {} for port in service.get('expose', [])},
+            'HostConfig': host_config,
+            'NetworkingConfig': {'EndpointsConfig': endpoints},
+        }
+        digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        config['Labels'] = {PROJECT_LABEL: self.project_name, SERVICE_LABEL: name, CONFIG_LABEL: digest}
+        return config
+
+    def ensure_networks(self, networks):
+        for name, network in networks.items():
+            full_name = self.network_name(name)
+            status, _ = self.request('GET', f'/networks/{full_name}', ok=(200, 404))
+            if status == 200:
+                continue
+            ipam = network.get('ipam', {})
+            self.request('POST', '/networks/create', body={
+                'Name': full_name,
+                'Driver': network.get('driver', 'bridge'),
+                'IPAM': {'Driver': ipam.get('driver', 'default'),
+                         'Config': [{'Subnet': config['subnet']} for config in ipam.get('config', [])]},
+                'Labels': {PROJECT_LABEL: self.project_name},
+            })
+
+    def create_service(self, name):
+        service = self.services[name]
+        container = service.get('container_name', f'{self.project_name}_{name}_1')
+        config = self.container_config(name, service)
+        status, current = self.request('GET', f'/containers/{container}/json', ok=(200, 404))
+        if status == 200 and current['Config']['Labels'].get(CONFIG_LABEL) != config['Labels'][CONFIG_LABEL]:
+            # stale container from another trial setup, recreate it like compose does
+            self.request('DELETE', f'/containers/{container}', query={'force': 'true'})
+            status = 404
+        if status == 404:
+            self.request('POST', '/containers/create', body=config, query={'name': container})
+        return container
+
+    def start_service(self, name):
+        container = self.create_service(name)
+        # 304: already running
+        self.request('POST', f'/containers/{container}/start', ok=(204, 304))
+
+    def prepare_resources(self, services, networks, remove_orphans=False):
+        self.services = services
+        self.ensure_networks(networks)
+        with self.build_lock:
+            for name, service in services.items():
+                self.ensure_image(name, service)
+        if remove_orphans:
+            orphans = [container for container in self.project_containers()
+                       if container['Labels'].get(SERVICE_LABEL) not in services]
+            self.in_parallel(self.remove_container, orphans)
+
+    def create(self, services, networks):
+        self.prepare_resources(services, networks)
+        self.in_parallel(self.create_service, services)
+
+    def up(self, services, networks, remove_orphans=False):
+        self.prepare_resources(services, networks, remove_orphans)
+        for level in dependency_levels(services):
+            self.in_parallel(self.start_service, level)
+
+    def project_containers(self, running_only=False):
+        filters = {'label': [f'{PROJECT_LABEL}={self.project_name}']}
+        if running_only:
+            filters['status'] = ['running']
+        query = {'filters': json.dumps(filters)}
+        if not running_only:
+            query['all'] = 'true'
+        _, containers = self.request('GET', '/containers/json', query=query)
+        return containers or []
+
+    def stop_container(self, container_id, timeout_s=10):
+        # 304: already stopped, 404: already gone
+        self.request('POST', f'/containers/{container_id}/stop', query={'t': timeout_s}, ok=(204, 304, 404))
+
+    def remove_container(self, container):
+        self.request('DELETE', f'/containers/{container["Id"]}', query={'force': 'true'}, ok=(204, 404))
+
+    def stop(self, names, timeout_s=10):
+        containers = [container for container in self.project_containers(running_only=True)
+                      if container['Labels'].get(SERVICE_LABEL) in names]
+        self.in_parallel(lambda container: self.stop_container(container['Id'], timeout_s), containers)
+
+    def down(self):
+        containers = self.project_containers()
+        running = [container for container in containers if container.get('State') == 'running']
+        self.in_parallel(lambda container: self.stop_container(container['Id']), running)
+        self.in_parallel(self.remove_container, containers)
+        _, networks = self.request('GET', '/networks', query={
+            'filters': json.dumps({'label': [f'{PROJECT_LABEL}={self.project_name}']})})
+        for network in networks or []:
+            self.request('DELETE', f'/networks/{network["Id"]}', ok=(204, 404))
+
+    def running_services(self):
+        try:
+            containers = self.project_containers(running_only=True)
+        except Exception:
+            return None
+        return [container['Labels'].get(SERVICE_LABEL) for container in containers]
+
+    def container_stats(self, container):
+        _, sample = self.request('GET', f'/containers/{container["Id"]}/stats', query={'stream': 'false'})
+        name = container['Names'][0].lstrip('/') if container.get('Names') else container['Id']
+        return name, engine_stats(sample or {})
+
+    def stats(self):
+        # a non streamed sample waits for a second reading to compute the cpu usage, so sample in parallel
+        return dict(self.in_parallel(self.container_stats, self.project_containers(running_only=True)))
+
+    def log_stream(self, container, since=None):
+        _, info = self.request('GET', f'/containers/{container}/json')
+        query = {'follow': 'true', 'stdout': 'true', 'stderr': 'true', 'timestamps': 'true'}
+        if since is not None:
+            query['since'] = str(int(since))
+        url = f'/{API_VERSION}/containers/{container}/logs?'+urllib.parse.urlencode(query)
+        return EngineLogStream(self.socket_path, url, info['Config'].get('Tty', False))
+
+
+def make_runtime(kind, compose_name, project_name, base_path, socket_path=DOCKER_SOCKET):
+    if kind == 'engine':
+        project_name = project_name if project_name is not None else default_project_name(base_path)
+        return DockerEngineRuntime(project_name, base_path, socket_path)
+    return ComposeRuntime(compose_name, project_name)
@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+
+import json
+import math
+import random
+import argparse
+import itertools
+
+from results_store import ResultsStore
+from trial_source import TrialSource, write_trials
+
+
+# expanded in full around every sampled combination, so baseline and planned stay paired
+PAIRED_FACTORS = ('treatment',)
+
+
+def load_design(design_path='experiment_design/design.json'):
+    '''
+    Returns [(factor, {level: values})] in code letter order, e.g.
+        [('avg_speed', {'a': ['0.15', ...]}), ..., ('treatment', {'b': 'baseline', 'p': 'planned'})]
+    '''
+    with open(design_path) as f:
+        design = json.load(f)
+    factors = []
+    for key in sorted(design, key=int):
+        levels = {level: values for level, values in design[key].items() if level != 'factor'}
+        factors.append((design[key]['factor'], levels))
+    return factors
+
+
+def parse_skills(value):
+    # '[operate_drawer, approach_person, navigation]' -> sorted skill names, as in trials.json
+    return sorted(skill.strip() for skill in value.strip('[]').split(',') if skill.strip())
+
+
+class TrialDesigner(object):
+    """
+    Builds trials.json compatible trial sets from the design file. Factor levels
+    come from the design; what only the planner knows (robot poses, the nurse
+    pose and the local plans) is taken from the reference trial with the same code,
+    and so are the skills, which the local plans were made for.
+    """
+    def __init__(self, design_path='experiment_design/design.json', reference_path='experiment_design/trials.json',
+                 seed=None):
+        super(TrialDesigner, self).__init__()
+        self.factors = load_design(design_path)
+        self.reference = TrialSource(reference_path)
+        self.random = random.Random(seed)
+        # robots whose reference skills are not the design ones
+        self.skill_mismatches = 0
+
+    def factor_names(self):
+        return [name for name, _ in self.factors]
+
+    def levels(self, factor):
+        return sorted(dict(self.factors)[factor])
+
+    def sampled_factors(self):
+        return [name for name in self.factor_names() if name not in PAIRED_FACTORS]
+
+    def code(self, combination):
+        # combination: {factor: level}, letters in design order
+        return ''.join(combination[name] for name in self.factor_names())
+
+    def paired(self, combinations):
+        # adds every level of the paired factors to each combination of the sampled ones
+        paired_names = [name for name in self.factor_names() if name in PAIRED_FACTORS]
+        expanded = []
+        for combination in combinations:
+            for levels in itertools.product(*[self.levels(name) for name in paired_names]):
+                expanded.append(dict(combination, **dict(zip(paired_names, levels))))
+        return expanded
+
+    def full_factorial(self):
+        names = self.sampled_factors()
+        combinations = [dict(zip(names, levels)) for levels in itertools.product(*[self.levels(name) for name in names])]
+        return self.paired(combinations)
+
+    def fractional_factorial(self, residue=0):
+        '''
+        Regular 1/L fraction of the factors with the most common number of levels L:
+        keeps the combinations whose level indices add up to residue modulo L
+        (for the 3 level factors of the design, 1/3 of the trials)
+        '''
+        names = self.sampled_factors()
+        sizes = [len(self.levels(name)) for name in names]
+        modulus = max(set(sizes), key=lambda size: (sizes.count(size), size))
+        combinations = []
+        for levels in itertools.product(*[self.levels(name) for name in names]):
+            indices = [self.levels(name).index(level) for name, level in zip(names, levels)]
+            total = sum(index for index, size in zip(indices, sizes) if size == modulus)
+            if total % modulus == residue:
+                combinations.append(dict(zip(names, levels)))
+        return self.paired(combinations)
+
+    def latin_hypercube(self, n_samples):
+        '''
+        n_samples combinations where every level of every factor appears
+        n_samples/levels times (up to rounding), columns shuffled independently
+        '''
+        names = self.sampled_factors()
+        columns = []
+        for name in names:
+            levels = self.levels(name)
+            column = [levels[i*len(levels)//n_samples] for i in range(n_samples)]
+            self.random.shuffle(column)
+            columns.append(column)
+        combinations = []
+        for row in zip(*columns):
+            combination = dict(zip(names, row))
+            if combination not in combinations:
+                combinations.append(combination)
+        return self.paired(combinations)
+
+    def adaptive(self, store, campaign, batch_size):
+        '''
+        Next batch for a running campaign: scores every combination not yet recorded
+        by how little and how inconclusively its factor levels have been observed
+        (outcome entropy plus 1/(1+trials) per level) and takes the best ones
+        '''
+        counts = store.outcome_counts_by_factor(campaign)
+        done = store.recorded_codes(campaign)
+        names = self.sampled_factors()
+
+        def level_score(name, level):
+            outcomes = counts.get((name, level), {})
+            total = sum(outcomes.values())
+            entropy = -sum(n/total*math.log(n/total, 2) for n in outcomes.values()) if total else 1.0
+            return entropy + 1.0/(1 + total)
+
+        candidates = []
+        for levels in itertools.product(*[self.levels(name) for name in names]):
+            combination = dict(zip(names, levels))
+            pairs = self.paired([combination])
+            if all(self.code(pair) in done for pair in pairs):
+                continue
+            score = sum(level_score(name, level) for name, level in combination.items())
+            # random tie break, so equal scores do not always favour the first levels
+            candidates.append((-score, self.random.random(), combination))
+        candidates.sort(key=lambda candidate: candidate[:2])
+        return self.paired([combination for _, _, combination in candidates[:batch_size]])
+
+    def build_trial(self, combination):
+        code = self.code(combination)
+        if code not in self.reference.by_code:
+            return None
+        reference = self.reference[self.reference.index_of(code)]
+        design = dict(self.factors)
+        robots = []
+        for i, ref_robot in enumerate(reference["robots"]):
+            robot = dict(ref_robot)
+            robot["avg_speed"] = float(design["avg_speed"][combination["avg_speed"]][i])
+            robot["battery_charge"] = float(design["battery_charge"][combination["battery_charge"]][i])
+            robot["battery_discharge_rate"] = float(design["battery_discharge_rate"][combination["battery_discharge_rate"]][i])
+            # the skills stay the reference ones, a plan is only valid for the skills it was made for
+            if robot["skills"] != parse_skills(design["skills"][combination["skills"]][i]):
+                self.skill_mismatches += 1
+            robot["location"] = design["location"][combination["location"]][i]
+            robots.append(robot)
+        nurses = [dict(nurse) for nurse in reference["nurses"]]
+        # the design lists the robot locations followed by the nurse one
+        for j, nurse in enumerate(nurses):
+            nurse["location"] = design["location"][combination["location"]][len(robots)+j]
+        return {
+            "code": code,
+            "factors": {name: level for name, level in combination.items() if name not in PAIRED_FACTORS},
+            "id": reference["id"],
+            "nurses": nurses,
+            "robots": robots,
+        }
+
+    def build_trials(self, combinations):
+        trials = []
+        for combination in combinations:
+            trial = self.build_trial(combination)
+            if trial is None:
+                print(f'no reference trial (plans) for {self.code(combination)}, skipped')
+                continue
+            trials.append(trial)
+        if self.skill_mismatches:
+            print(f'{self.skill_mismatches} robots of the reference have other skills than the design, '
+                  f'kept with their plans')
+        return trials
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a trial set from the experiment design')
+    parser.add_argument('mode', choices=['full', 'fractional', 'lhs', 'adaptive'])
+    parser.add_argument('--design', default='experiment_design/design.json', help='design file with the factor levels')
+    parser.add_argument('--reference', default='experiment_design/trials.json',
+                        help='trial set the plans, skills and poses are taken from')
+    parser.add_argument('--out', default='trials_design.json', help='generated trial set, JSON Lines when it ends with .jsonl')
+    parser.add_argument('--samples', type=int, default=18, help='combinations drawn by lhs and adaptive')
+    parser.add_argument('--residue', type=int, default=0, help='fraction selected by fractional')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--campaign', help='campaign the adaptive mode continues')
+    parser.add_argument('--results', default='log/results.db', help='results store read by the adaptive mode')
+    args = parser.parse_args()
+
+    designer = TrialDesigner(args.design, args.reference, args.seed)
+    if args.mode == 'full':
+        combinations = designer.full_factorial()
+    elif args.mode == 'fractional':
+        combinations = designer.fractional_factorial(args.residue)
+    elif args.mode == 'lhs':
+        combinations = designer.latin_hypercube(args.samples)
+    else:
+        if args.campaign is None:
+            parser.error('adaptive needs --campaign')
+        combinations = designer.adaptive(ResultsStore(args.results), args.campaign, args.samples)
+    trials = designer.build_trials(combinations)
+    write_trials(trials, args.out)
+    print(f'{len(trials)} trials ({args.mode}) written to {args.out}')
+
+if __name__ == '__main__':
+    main()
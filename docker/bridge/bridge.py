@@ -1,3 +1,12 @@
+import os
+import json
+import time
+import zlib
+import fnmatch
+import multiprocessing
+from array import array
+from collections import deque
+
 import roslibpy
 import rclpy
 from std_msgs.msg import Float32, Int32, String
@@ -6,76 +15,210 @@ from nav_msgs.msg import Odometry
 from sensor_msgs.msg import LaserScan
 
 
+STATS_PERIOD_S = float(os.environ.get('BRIDGE_STATS_PERIOD_S', '10'))
+DRAIN_PERIOD_S = float(os.environ.get('BRIDGE_DRAIN_PERIOD_S', '0.01'))
+DISCOVERY_PERIOD_S = float(os.environ.get('BRIDGE_DISCOVERY_PERIOD_S', '5'))
+ROSBRIDGE_HOST = os.environ.get('BRIDGE_ROSBRIDGE_HOST', '10.6.0.2')
+ROSBRIDGE_PORT = int(os.environ.get('BRIDGE_ROSBRIDGE_PORT', '9090'))
+# worker processes, each one with its own rosbridge connection and rclpy node
+WORKERS = int(os.environ.get('BRIDGE_WORKERS', '1'))
+# robot: /turtlebotN/... topics go to worker N % WORKERS, type: shard by message type
+SHARD_BY = os.environ.get('BRIDGE_SHARD_BY', 'robot')
+
+BRIDGED_TYPES = ['std_msgs/Float32', 'std_msgs/Int32', 'nav_msgs/Odometry',
+                 'std_msgs/String', 'geometry_msgs/PoseStamped', 'sensor_msgs/LaserScan']
+
+# used for topics no rule matches; same depth the bridge always had
+DEFAULT_RULE = {'policy': 'fifo', 'queue': 10, 'max_rate': None, 'drop': 'oldest'}
+
+
+class TopicRules:
+    '''
+    Declarative per topic rules read from the JSON file in BRIDGE_RULES, e.g.
+        {
+          "include": ["/turtlebot*", "/log"],
+          "exclude": ["*/rosout*"],
+          "rules": [
+            {"topic": "*/odom", "max_rate": 5, "policy": "latest"},
+            {"topic": "*/scan*", "max_rate": 2, "policy": "latest"},
+            {"topic": "/log", "policy": "fifo", "queue": 10000, "drop": "newest"}
+          ],
+          "default": {"policy": "fifo", "queue": 10}
+        }
+    policy latest keeps only the newest message, fifo keeps up to queue messages
+    and drops the oldest (or newest) one when full. max_rate is in Hz.
+    The first rule whose glob matches the topic wins.
+    '''
+    def __init__(self, path=None):
+        config = {}
+        if path:
+            with open(path) as f:
+                config = json.load(f)
+        self.include = config.get('include', ['*'])
+        self.exclude = config.get('exclude', [])
+        self.rules = config.get('rules', [])
+        self.default = dict(DEFAULT_RULE, **config.get('default', {}))
+
+    def bridged(self, topic_name):
+        return (any(fnmatch.fnmatch(topic_name, glob) for glob in self.include)
+                and not any(fnmatch.fnmatch(topic_name, glob) for glob in self.exclude))
+
+    def match(self, topic_name):
+        for rule in self.rules:
+            if fnmatch.fnmatch(topic_name, rule['topic']):
+                return dict(self.default, **rule)
+        return dict(self.default)
+
+
+class TopicStats:
+    def __init__(self):
+        self.count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.received = 0
+        self.dropped = 0
+        self.depth_max = 0
+
+    def add(self, latency):
+        self.count += 1
+        self.latency_sum += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+    def report(self, logger, topic_name, period_s, depth):
+        if self.received:
+            mean_ms = 1000*self.latency_sum/self.count if self.count else 0.0
+            logger.info('%s: in %.1f msg/s, out %.1f msg/s, dropped %d, queue %d (max %d), latency mean %.3f ms max %.3f ms' % (
+                topic_name, self.received/period_s, self.count/period_s, self.dropped, depth, self.depth_max,
+                mean_ms, 1000*self.latency_max))
+        self.count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.received = 0
+        self.dropped = 0
+        self.depth_max = 0
+
+
 class Bridge:
-    def __init__(self, topic_name, topic_type):
-        self.callbacks = {'std_msgs/Float32': self.FloatCallback, 
-                'std_msgs/Int32': self.IntCallback, 
-                'std_msgs/String': self.StringCallback, 
-                'nav_msgs/Odometry': self.OdometryCallback, 
-                'geometry_msgs/PoseStamped': self.PoseCallback, 
-                'sensor_msgs/LaserScan': self.LaserCallback}
-        self.ros2_pub = None
+    def __init__(self, topic_name, topic_type, worker):
+        self.callbacks = {'std_msgs/Float32': (Float32, self.FloatCallback),
+                'std_msgs/Int32': (Int32, self.IntCallback),
+                'std_msgs/String': (String, self.StringCallback),
+                'nav_msgs/Odometry': (Odometry, self.OdometryCallback),
+                'geometry_msgs/PoseStamped': (Pose, self.PoseCallback),
+                'sensor_msgs/LaserScan': (LaserScan, self.LaserCallback)}
         self.topic_name = topic_name
         self.topic_type = topic_type
-        self.topic_bridge = roslibpy.Topic(client, topic_name, topic_type)
-        
-        self.topic_bridge.subscribe(self.callbacks[self.topic_type])
+        self.ros_type, self.convert = self.callbacks[self.topic_type]
+        self.rule = worker.rules.match(topic_name)
+        self.min_period_s = 1.0/self.rule['max_rate'] if self.rule['max_rate'] else 0.0
+        self.last_pub = 0.0
+        # filled from the rosbridge thread, drained by the rclpy timer
+        self.queue = deque()
+        # one message object per topic, publish() serializes it right away so it can be reused
+        self.msg = self.ros_type()
+        self.ros2_pub = worker.node.create_publisher(self.ros_type, self.topic_name, self.rule['queue'])
+        self.stats = TopicStats()
+        # let rosbridge throttle at the source too, so dropped messages never cross the network
+        throttle_ms = int(1000*self.min_period_s)
+        self.topic_bridge = roslibpy.Topic(worker.client, topic_name, topic_type,
+                                           throttle_rate=throttle_ms, queue_length=self.rule['queue'])
+
+        self.topic_bridge.subscribe(self.enqueue)
+
+    def enqueue(self, bridge):
+        self.stats.received += 1
+        if len(self.queue) >= self.rule['queue']:
+            self.stats.dropped += 1
+            if self.rule['policy'] == 'fifo' and self.rule['drop'] == 'newest':
+                return
+            self.queue.popleft()
+        self.queue.append((time.perf_counter(), bridge))
+        if len(self.queue) > self.stats.depth_max:
+            self.stats.depth_max = len(self.queue)
+
+    def drain(self, now):
+        if not self.queue or now - self.last_pub < self.min_period_s:
+            return
+        if self.rule['policy'] == 'latest':
+            received, bridge = self.queue.pop()
+            self.stats.dropped += len(self.queue)
+            self.queue.clear()
+            self.publish(received, bridge)
+        elif self.min_period_s:
+            self.publish(*self.queue.popleft())
+        else:
+            while self.queue:
+                self.publish(*self.queue.popleft())
+        self.last_pub = now
+
+    def publish(self, received, bridge):
+        self.convert(bridge)
+        self.stats.add(time.perf_counter() - received)
 
     def pub(self, ros_type, msg):
-        if self.ros2_pub is None:
-            self.ros2_pub = node.create_publisher(ros_type, self.topic_name, 10)
         self.ros2_pub.publish(msg)
 
 
     def FloatCallback(self, bridge):
-        msg = Float32()
+        msg = self.msg
         msg.data = bridge['data']
         self.pub(Float32, msg)
 
     def IntCallback(self, bridge):
-        msg = Int32()
+        msg = self.msg
         msg.data = bridge['data']
         self.pub(Int32, msg)
 
     def StringCallback(self,bridge):
-        msg = String()
+        msg = self.msg
         msg.data = bridge['data']
         self.pub(String, msg)
-        
+
     def PoseCallback(self, bridge):
-        msg = Pose()
-        msg.position.x = bridge['pose']['position']['x']
-        msg.position.y = bridge['pose']['position']['y']
-        msg.position.z = bridge['pose']['position']['z']
-        msg.orientation.x = bridge['pose']['orientation']['x']
-        msg.orientation.y = bridge['pose']['orientation']['y']
-        msg.orientation.z = bridge['pose']['orientation']['z']
+        msg = self.msg
+        position = bridge['pose']['position']
+        orientation = bridge['pose']['orientation']
+        msg.position.x = position['x']
+        msg.position.y = position['y']
+        msg.position.z = position['z']
+        msg.orientation.x = orientation['x']
+        msg.orientation.y = orientation['y']
+        msg.orientation.z = orientation['z']
         self.pub(Pose, msg)
 
     def OdometryCallback(self, bridge):
-        msg = Odometry()
-        msg.pose.pose.position.x = bridge['pose']['pose']['position']['x']
-        msg.pose.pose.position.y = bridge['pose']['pose']['position']['y']
-        msg.pose.pose.position.z = bridge['pose']['pose']['position']['z']
-        msg.pose.pose.orientation.x = bridge['pose']['pose']['orientation']['x']
-        msg.pose.pose.orientation.y = bridge['pose']['pose']['orientation']['y']
-        msg.pose.pose.orientation.z = bridge['pose']['pose']['orientation']['z']
-        msg.pose.pose.orientation.w = bridge['pose']['pose']['orientation']['w']
-        msg.pose.covariance = bridge['pose']['covariance']
-
-        msg.twist.twist.linear.x = bridge['twist']['twist']['linear']['x']
-        msg.twist.twist.linear.y = bridge['twist']['twist']['linear']['y']
-        msg.twist.twist.linear.z = bridge['twist']['twist']['linear']['z']
-        msg.twist.twist.angular.x = bridge['twist']['twist']['angular']['x']
-        msg.twist.twist.angular.y = bridge['twist']['twist']['angular']['y']
-        msg.twist.twist.angular.z = bridge['twist']['twist']['angular']['z']
-        msg.twist.covariance = bridge['twist']['covariance']
+        msg = self.msg
+        pose = bridge['pose']
+        position = pose['pose']['position']
+        orientation = pose['pose']['orientation']
+        out_pose = msg.pose.pose
+        out_pose.position.x = position['x']
+        out_pose.position.y = position['y']
+        out_pose.position.z = position['z']
+        out_pose.orientation.x = orientation['x']
+        out_pose.orientation.y = orientation['y']
+        out_pose.orientation.z = orientation['z']
+        out_pose.orientation.w = orientation['w']
+        msg.pose.covariance = array('d', pose['covariance'])
+
+        twist = bridge['twist']
+        linear = twist['twist']['linear']
+        angular = twist['twist']['angular']
+        out_twist = msg.twist.twist
+        out_twist.linear.x = linear['x']
+        out_twist.linear.y = linear['y']
+        out_twist.linear.z = linear['z']
+        out_twist.angular.x = angular['x']
+        out_twist.angular.y = angular['y']
+        out_twist.angular.z = angular['z']
+        msg.twist.covariance = array('d', twist['covariance'])
 
         msg.child_frame_id = bridge['child_frame_id']
         self.pub(Odometry, msg)
 
     def LaserCallback(self, bridge):
-        msg = LaserScan()
+        msg = self.msg
         msg.angle_min = bridge['angle_min']
         msg.angle_max = bridge['angle_max']
         msg.angle_increment = bridge['angle_increment']
@@ -83,26 +226,118 @@ class Bridge:
         msg.scan_time = bridge['scan_time']
         msg.range_min = bridge['range_min']
         msg.range_max = bridge['range_max']
-        msg.ranges = bridge['ranges']
-        msg.intensities = bridge['intensities']
+        # array('f') is taken by the generated setters as is, no per element checks
+        msg.ranges = array('f', bridge['ranges'])
+        msg.intensities = array('f', bridge['intensities'])
         self.pub(LaserScan, msg)
 
 
-client = roslibpy.Ros(host='10.6.0.2', port=9090)
-client.run()
+def shard_of(topic_name, topic_type, n_shards):
+    if SHARD_BY == 'type':
+        key = topic_type
+    else:
+        # /turtlebot3/odom -> turtlebot3, global topics such as /log -> ''
+        parts = topic_name.strip('/').split('/')
+        key = parts[0] if len(parts) > 1 else ''
+        if key.startswith('turtlebot') and key[len('turtlebot'):].isdigit():
+            # robots are numbered, spread them round robin instead of by hash
+            return int(key[len('turtlebot'):]) % n_shards
+    return zlib.crc32(key.encode()) % n_shards
+
+
+class BridgeWorker:
+    '''
+    Bridges the topics of one shard. Topics are rediscovered every
+    DISCOVERY_PERIOD_S so robots that come up late are bridged as well.
+    '''
+    def __init__(self, shard=0, n_shards=1):
+        self.shard = shard
+        self.n_shards = n_shards
+        self.client = roslibpy.Ros(host=ROSBRIDGE_HOST, port=ROSBRIDGE_PORT)
+        self.client.run()
+        self.node = rclpy.create_node('bridge' if n_shards == 1 else f'bridge_{shard}')
+        self.rules = TopicRules(os.environ.get('BRIDGE_RULES'))
+        self.bridges = {}
+        # (topic_name, topic_type) found by the rosapi callbacks, bridged from the rclpy thread
+        self.discovered = deque()
+        self.discover()
+        self.stats_timer = self.node.create_timer(STATS_PERIOD_S, self.report_stats)
+        self.drain_timer = self.node.create_timer(DRAIN_PERIOD_S, self.drain_queues)
+        self.discovery_timer = self.node.create_timer(DISCOVERY_PERIOD_S, self.discover)
+
+    def discover(self):
+        # asynchronous rosapi calls, so discovery never stalls the drain timer
+        for topic_type in BRIDGED_TYPES:
+            self.client.get_topics_for_type(topic_type, self.found_topics(topic_type))
+
+    def found_topics(self, topic_type):
+        # rosapi replies with the raw service response, {'topics': [...]}
+        def callback(response):
+            for topic_name in response.get('topics', []):
+                self.discovered.append((topic_name, topic_type))
+        return callback
+
+    def add_bridges(self):
+        while self.discovered:
+            topic_name, topic_type = self.discovered.popleft()
+            if topic_name in self.bridges or not self.rules.bridged(topic_name):
+                continue
+            if shard_of(topic_name, topic_type, self.n_shards) != self.shard:
+                continue
+            self.bridges[topic_name] = Bridge(topic_name, topic_type, self)
+            self.node.get_logger().info(f'bridging {topic_name} ({topic_type})')
+
+    def report_stats(self):
+        for bridge in self.bridges.values():
+            bridge.stats.report(self.node.get_logger(), bridge.topic_name, STATS_PERIOD_S, len(bridge.queue))
+
+    def drain_queues(self):
+        if self.discovered:
+            self.add_bridges()
+        now = time.perf_counter()
+        for bridge in self.bridges.values():
+            bridge.drain(now)
+
+    def spin(self):
+        try:
+            rclpy.spin(self.node)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.client.terminate()
+
+
+def run_worker(shard, n_shards):
+    rclpy.init()
+    BridgeWorker(shard, n_shards).spin()
 
-rclpy.init()
-node = rclpy.create_node('bridge')
 
-float_sub = [Bridge(topic_name,'std_msgs/Float32')  for topic_name in client.get_topics_for_type('std_msgs/Float32')]
-int_sub = [Bridge(topic_name,'std_msgs/Int32')  for topic_name in client.get_topics_for_type('std_msgs/Int32')]
-odom_sub = [Bridge(topic_name,'nav_msgs/Odometry')  for topic_name in client.get_topics_for_type('nav_msgs/Odometry')]
-str_sub = [Bridge(topic_name,'std_msgs/String')  for topic_name in client.get_topics_for_type('std_msgs/String')]
-pose_sub = [Bridge(topic_name,'geometry_msgs/PoseStamped')  for topic_name in client.get_topics_for_type('geometry_msgs/PoseStamped')]
-laser_sub = [Bridge(topic_name,'sensor_msgs/LaserScan')  for topic_name in client.get_topics_for_type('sensor_msgs/LaserScan')]
+def supervise(n_workers, check_period_s=2):
+    '''
+    Keeps one worker process per shard alive, restarting the ones that die
+    '''
+    workers = {}
+    try:
+        while True:
+            for shard in range(n_workers):
+                worker = workers.get(shard)
+                if worker is not None and worker.is_alive():
+                    continue
+                if worker is not None:
+                    print(f'bridge worker {shard} exited with {worker.exitcode}, restarting')
+                worker = multiprocessing.Process(target=run_worker, args=(shard, n_workers), name=f'bridge_{shard}')
+                worker.start()
+                workers[shard] = worker
+            time.sleep(check_period_s)
+    except KeyboardInterrupt:
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.join()
 
-try:
-    rclpy.spin(node)
-except KeyboardInterrupt:
-    client.terminate()
 
+if __name__ == '__main__':
+    if WORKERS > 1:
+        supervise(WORKERS)
+    else:
+        run_worker(0, 1)
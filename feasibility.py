@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import math
+import argparse
+import datetime
+from array import array
+from collections import namedtuple
+
+from trial_source import TrialSource
+
+
+# steps carried out by message passing, the robot needs no skill for them
+COMMUNICATION_STEPS = ('send_message', 'wait_message')
+# the simulation ends the trial with ENDLOWBATT once the battery reaches this level
+LOW_BATTERY_LEVEL = 0.05
+# sim seconds until robots report their first pose, seen in the trial logs
+STARTUP_S = 36.0
+# sim seconds spent in each non navigation step (approach, authenticate, drawer, messages)
+STEP_S = 10.0
+
+Prediction = namedtuple('Prediction', ['idx', 'id', 'code', 'robot', 'outcome', 'runtime_s', 'path_length',
+                                       'battery_needed', 'battery_available', 'missing_skills'])
+
+
+def path_length(waypoints):
+    length = 0.0
+    for (x0, y0, *_), (x1, y1, *_) in zip(waypoints, waypoints[1:]):
+        length += math.hypot(x1 - x0, y1 - y0)
+    return length
+
+
+def plan_requirements(local_plan, skills):
+    '''
+    Returns (navigation length, number of other steps, skills missing from skills)
+    for a local_plan such as [['navigation', ['IC Room 6', [[x, y, yaw], [x, y], ...]], 'navto_room'], ...]
+    '''
+    length = 0.0
+    steps = 0
+    missing = []
+    for skill, args, _ in local_plan:
+        if skill == 'navigation':
+            length += path_length(args[1])
+        else:
+            steps += 1
+        if skill not in COMMUNICATION_STEPS and skill not in skills and skill not in missing:
+            missing.append(skill)
+    return length, steps, missing
+
+
+class PlanColumns(object):
+    """One row per robot that has a plan, across all trials, one typed array per field"""
+    def __init__(self):
+        super(PlanColumns, self).__init__()
+        self.trial = array('i')
+        self.robot = array('h')
+        self.length = array('d')
+        self.steps = array('i')
+        self.speed = array('d')
+        self.charge = array('d')
+        self.rate = array('d')
+        self.missing = []
+
+    def append(self, idx, robot):
+        length, steps, missing = plan_requirements(robot["local_plan"], robot["skills"])
+        self.trial.append(idx)
+        self.robot.append(robot["id"])
+        self.length.append(length)
+        self.steps.append(steps)
+        self.speed.append(robot["avg_speed"])
+        self.charge.append(robot["battery_charge"])
+        self.rate.append(robot["battery_discharge_rate"])
+        self.missing.append(missing)
+
+
+def plan_columns(trials):
+    columns = PlanColumns()
+    for idx, trial in enumerate(trials):
+        for robot in trial["robots"]:
+            if robot["local_plan"]:
+                columns.append(idx, robot)
+    return columns
+
+
+def combine_robots(predictions):
+    '''
+    One prediction for a trial from those of its robots with a plan: any robot
+    predicted to fail makes the trial fail, with the first of them to fail,
+    otherwise the trial lasts until the slowest robot is done
+    '''
+    failing = [prediction for prediction in predictions if prediction.outcome != 'reach-target']
+    if failing:
+        return min(failing, key=lambda prediction: prediction.runtime_s)
+    return max(predictions, key=lambda prediction: prediction.runtime_s)
+
+
+def predict(trials, low_battery_level=LOW_BATTERY_LEVEL, startup_s=STARTUP_S, step_s=STEP_S):
+    '''
+    Predicts the outcome and sim runtime of every trial from its configuration:
+    a plan step the robot has no skill for fails the behavior tree, and the
+    battery drains at battery_discharge_rate per second for the whole mission
+    (travel at avg_speed plus step_s per other step) down to low_battery_level.
+    Returns one Prediction per trial, in the order of trials, the robots of a
+    trial combined by combine_robots
+    '''
+    columns = plan_columns(trials)
+    # column wise, every trial and robot at once
+    mission_s = [length/speed + steps*step_s for length, speed, steps in zip(columns.length, columns.speed, columns.steps)]
+    needed = [rate*duration for rate, duration in zip(columns.rate, mission_s)]
+    available = [charge - low_battery_level for charge in columns.charge]
+    empty_s = [max(spare, 0.0)/rate if rate > 0 else math.inf for spare, rate in zip(available, columns.rate)]
+    by_trial = {}
+    for row, idx in enumerate(columns.trial):
+        if columns.missing[row]:
+            outcome = 'failure-bt'
+            # the tree fails when it reaches the step, close enough to fail early
+            runtime = startup_s
+        elif needed[row] > available[row]:
+            outcome = 'low-battery'
+            runtime = startup_s + empty_s[row]
+        else:
+            outcome = 'reach-target'
+            runtime = startup_s + mission_s[row]
+        by_trial.setdefault(idx, []).append(
+            Prediction(idx, trials[idx]["id"], trials[idx]["code"], f'turtlebot{columns.robot[row]}', outcome,
+                       runtime, columns.length[row], needed[row], available[row], columns.missing[row]))
+    predictions = []
+    for idx, trial in enumerate(trials):
+        if idx in by_trial:
+            predictions.append(combine_robots(by_trial[idx]))
+        else:
+            # trials without any plan have nothing to execute
+            predictions.append(Prediction(idx, trial["id"], trial["code"], None, None, 0.0, 0.0, 0.0, 0.0, []))
+    return predictions
+
+
+def check_verification(predictions, path='experiment_design/verification.json'):
+    '''
+    Compares the predictions with the design verification, keyed by the first
+    five letters of the trial code (the treatment letter is not part of it).
+    Returns {'agree': [...], 'disagree': [...], 'unknown': [...]} lists of codes
+    '''
+    with open(path) as f:
+        verification = json.load(f)
+    report = {'agree': [], 'disagree': [], 'unknown': []}
+    for prediction in predictions:
+        verified = verification.get(prediction.code[:5])
+        if verified is None:
+            report['unknown'].append(prediction.code)
+        elif verified == (prediction.outcome == 'reach-target'):
+            report['agree'].append(prediction.code)
+        else:
+            report['disagree'].append(prediction.code)
+    return report
+
+
+def preflight_order(predictions, sim_list, mode):
+    '''
+    Applies a pre-flight mode to the trial indexes in sim_list:
+        order  shortest predicted runtime first
+        skip   drop the trials predicted to fail
+        flag   keep them all, only report
+    Returns (indexes to run, predictions of the dropped ones)
+    '''
+    sim_list = list(sim_list)
+    if mode == 'order':
+        sim_list.sort(key=lambda idx: predictions[idx].runtime_s)
+    if mode != 'skip':
+        return sim_list, []
+    keep = [idx for idx in sim_list if predictions[idx].outcome == 'reach-target']
+    dropped = [predictions[idx] for idx in sim_list if predictions[idx].outcome != 'reach-target']
+    return keep, dropped
+
+
+def save_predictions(predictions, path):
+    with open(path+'.tmp', 'w') as file:
+        file.write('id,code,robot,outcome,runtime_s,path_length,battery_needed,battery_available,missing_skills\n')
+        for p in predictions:
+            file.write(f'{p.id},{p.code},{p.robot},{p.outcome},{p.runtime_s:.1f},{p.path_length:.2f},'
+                       f'{p.battery_needed:.4f},{p.battery_available:.4f},{" ".join(p.missing_skills)}\n')
+    os.replace(path+'.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict the trial outcomes before running them')
+    parser.add_argument('--trials', default='trials.json', help='trial definitions file')
+    parser.add_argument('--verification', default='experiment_design/verification.json', help='design verification file')
+    args = parser.parse_args()
+    trials = TrialSource(args.trials)
+    predictions = predict(trials)
+    outcomes = {}
+    for prediction in predictions:
+        outcomes[prediction.outcome] = outcomes.get(prediction.outcome, 0) + 1
+    for outcome, count in sorted(outcomes.items(), key=lambda item: str(item[0])):
+        print(f'{outcome}: {count}')
+    print(f'estimated sim time: {sum(p.runtime_s for p in predictions)/3600:.1f} h')
+    report = check_verification(predictions, args.verification)
+    print(f"verification: {len(report['agree'])} agree, {len(report['disagree'])} disagree, {len(report['unknown'])} unknown")
+    if report['disagree']:
+        print('disagree: '+' '.join(report['disagree']))
+    current_date = datetime.datetime.today().strftime('%H-%M-%S-%d-%b-%Y')
+    save_predictions(predictions, f'preflight-{current_date}.csv')
+
+if __name__ == '__main__':
+    main()
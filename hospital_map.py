@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+
+import math
+import heapq
+import argparse
+
+
+# named locations of the MORSE hospital scene, [x, y(, yaw)]
+LOCATIONS = {
+    "IC Corridor": [-37, 15],
+    "IC Room 1": [-39.44, 33.98, 0.00],
+    "IC Room 2": [-32.88, 33.95, 3.14],
+    "IC Room 3": [-40.23, 25.37, 0.00],
+    "IC Room 4": [-33.90, 18.93, 3.14],
+    "IC Room 5": [-38.00, 21.50, 0.00],
+    "IC Room 6": [-38.00, 10.00, 0.00],
+    "PC Corridor": [-19, 16],
+    "PC Room 1": [-28.50, 18.00, -1.57],
+    "PC Room 2": [-27.23, 18.00, -1.57],
+    "PC Room 3": [-21.00, 18.00, -1.57],
+    "PC Room 4": [-19.00, 18.00, -1.57],
+    "PC Room 5": [-13.50, 18.00, -1.57],
+    "PC Room 6": [-11.50, 18, -1.57],
+    "PC Room 7": [-4, 18, -1.57],
+    "PC Room 8": [-27.23, 13.00, 1.57],
+    "PC Room 9": [-26.00, 13.00, 1.57],
+    "PC Room 10": [-18.00, 13.00, 1.57],
+    "Laboratory": [-26.00, 13.00, 1.57],
+    "Reception": [-1, 20],
+    "Pharmacy Corridor": [0, 8],
+    "Pharmacy": [-2, 2.6],
+}
+
+# corridor centre lines as axis aligned segments, the planner routes of trials.json
+# run along x=-37 (IC) and y=16 (PC)
+CORRIDORS = {
+    "IC Corridor": ((-37, 10), (-37, 33.98)),
+    "PC Corridor": ((-37, 16), (0, 16)),
+    "Pharmacy Corridor": ((0, 16), (0, 2.6)),
+}
+
+# offset of the nurse from the point of her room, so she does not stand where the robots are sent
+NURSE_OFFSETS = {
+    "PC Room 1": [-1, -1],
+    "PC Room 2": [-1, -1],
+    "PC Room 3": [-1, +1],
+    "PC Room 4": [+1, +1],
+    "PC Room 5": [-1, +1],
+    "PC Room 6": [+1, +1],
+    "PC Room 7": [-1, +1],
+    "PC Room 8": [+1, +1],
+    "IC Room 1": [-1, +1],
+    "IC Room 2": [-1, -1],
+    "IC Room 3": [-1, +1],
+    "IC Room 4": [-1, -1],
+    "IC Room 5": [+1, -1],
+    "IC Room 6": [+1, +1],
+}
+
+
+def corridor_of(location):
+    # the wing a location belongs to, its door opens onto that corridor
+    for prefix in ('IC', 'Pharmacy'):
+        if location.startswith(prefix):
+            return f'{prefix} Corridor'
+    return 'PC Corridor'
+
+
+def project(point, segment):
+    # closest point of an axis aligned segment to point
+    (x0, y0), (x1, y1) = segment
+    x = min(max(point[0], min(x0, x1)), max(x0, x1))
+    y = min(max(point[1], min(y0, y1)), max(y0, y1))
+    return (x, y)
+
+
+def collinear(a, b, c):
+    return abs((b[0] - a[0])*(c[1] - a[1]) - (b[1] - a[1])*(c[0] - a[0])) < 1e-6
+
+
+class KDTree(object):
+    """2-d tree over (x, y, payload) points for nearest neighbour queries in O(log n)"""
+    def __init__(self, points, depth=0):
+        super(KDTree, self).__init__()
+        axis = depth % 2
+        points = sorted(points, key=lambda point: point[axis])
+        middle = len(points)//2
+        self.axis = axis
+        self.point = points[middle]
+        self.left = KDTree(points[:middle], depth+1) if middle > 0 else None
+        self.right = KDTree(points[middle+1:], depth+1) if middle+1 < len(points) else None
+
+    def nearest(self, x, y, best=None):
+        '''
+        Returns (distance, point) of the point closest to (x, y)
+        '''
+        distance = math.hypot(self.point[0] - x, self.point[1] - y)
+        if best is None or distance < best[0]:
+            best = (distance, self.point)
+        delta = (x, y)[self.axis] - self.point[self.axis]
+        near, far = (self.left, self.right) if delta < 0 else (self.right, self.left)
+        if near is not None:
+            best = near.nearest(x, y, best)
+        # the other side can only hold a closer point if the splitting line is closer than the best so far
+        if far is not None and abs(delta) < best[0]:
+            best = far.nearest(x, y, best)
+        return best
+
+
+class HospitalMap(object):
+    """
+    Graph of the hospital built once: every location is linked to its door on the
+    corridor of its wing, doors and corridor junctions are linked along the corridors.
+    The shortest route between every pair of locations is precomputed, so route()
+    and distance() are lookups; locate() finds the location of a pose through a k-d tree
+    """
+    def __init__(self, locations=LOCATIONS, corridors=CORRIDORS):
+        super(HospitalMap, self).__init__()
+        self.locations = locations
+        self.corridors = corridors
+        self.graph = {}
+        self.build_graph()
+        self.routes = {}
+        for name in self.locations:
+            self.routes.update(self.shortest_routes(name))
+        self.index = KDTree([(pose[0], pose[1], name) for name, pose in self.locations.items()])
+
+    def link(self, a, b):
+        length = math.hypot(a[0] - b[0], a[1] - b[1])
+        self.graph.setdefault(a, {})[b] = length
+        self.graph.setdefault(b, {})[a] = length
+
+    def build_graph(self):
+        # points on each corridor: its ends, the junctions with the other corridors and the doors
+        on_corridor = {name: set(segment) for name, segment in self.corridors.items()}
+        for name, segment in self.corridors.items():
+            for other, other_segment in self.corridors.items():
+                if other != name:
+                    for end in other_segment:
+                        if project(end, segment) == end:
+                            on_corridor[name].add(end)
+        for name, pose in self.locations.items():
+            point = (pose[0], pose[1])
+            corridor = corridor_of(name)
+            door = project(point, self.corridors[corridor])
+            on_corridor[corridor].add(door)
+            if door != point:
+                self.link(point, door)
+            self.graph.setdefault(point, {})
+        for name, points in on_corridor.items():
+            (x0, y0), _ = self.corridors[name]
+            ordered = sorted(points, key=lambda point: math.hypot(point[0] - x0, point[1] - y0))
+            for a, b in zip(ordered, ordered[1:]):
+                self.link(a, b)
+
+    def nearest_corridor(self, point):
+        return min(self.corridors, key=lambda name: math.dist(point, project(point, self.corridors[name])))
+
+    def shortest_routes(self, source):
+        # Dijkstra from one location to every node, keeping the routes that end at a location
+        start = tuple(self.locations[source][:2])
+        lengths = {start: 0.0}
+        previous = {}
+        queue = [(0.0, start)]
+        while queue:
+            length, node = heapq.heappop(queue)
+            if length > lengths[node]:
+                continue
+            for neighbour, edge in self.graph[node].items():
+                if length + edge < lengths.get(neighbour, math.inf):
+                    lengths[neighbour] = length + edge
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (length + edge, neighbour))
+        routes = {}
+        for target, pose in self.locations.items():
+            node = tuple(pose[:2])
+            if node not in lengths:
+                continue
+            waypoints = [node]
+            while waypoints[-1] != start:
+                waypoints.append(previous[waypoints[-1]])
+            waypoints.reverse()
+            routes[(source, target)] = (lengths[node], waypoints)
+        return routes
+
+    def pose(self, location):
+        # a copy, callers may move it
+        return list(self.locations[location])
+
+    def nurse_offset(self, location):
+        return NURSE_OFFSETS[location]
+
+    def distance(self, source, target):
+        return self.routes[(source, target)][0]
+
+    def route(self, source, target):
+        '''
+        Waypoints from source to target as in a local_plan navigation step: the
+        first and last ones are the full poses, with their yaw when known
+        '''
+        points = self.routes[(source, target)][1]
+        # like the planner, keep only the points where the route turns
+        waypoints = [list(point) for i, point in enumerate(points)
+                     if i in (0, len(points) - 1) or not collinear(points[i-1], point, points[i+1])]
+        waypoints[0] = list(self.locations[source])
+        waypoints[-1] = list(self.locations[target])
+        return waypoints
+
+    def nearest(self, x, y):
+        '''
+        Returns (location, distance) of the location closest to (x, y)
+        '''
+        distance, (_, _, name) = self.index.nearest(x, y)
+        return name, distance
+
+    def locate(self, x, y, radius=1.5):
+        '''
+        Name of the location at (x, y): the nearest location within radius metres,
+        else the nearest corridor
+        '''
+        name, distance = self.nearest(x, y)
+        if distance <= radius:
+            return name
+        return self.nearest_corridor((x, y))
+
+
+_default_map = None
+
+
+def default_map():
+    # built on first use and shared, the graph and routes never change
+    global _default_map
+    if _default_map is None:
+        _default_map = HospitalMap()
+    return _default_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the hospital map')
+    parser.add_argument('--route', nargs=2, metavar=('FROM', 'TO'), help='route between two locations')
+    parser.add_argument('--locate', nargs=2, type=float, metavar=('X', 'Y'), help='location of a pose')
+    args = parser.parse_args()
+    hospital = default_map()
+    if args.route:
+        print(f'{hospital.distance(*args.route):.2f} m: {hospital.route(*args.route)}')
+    if args.locate:
+        print(hospital.locate(*args.locate))
+    if not args.route and not args.locate:
+        for name in hospital.locations:
+            print(name, hospital.pose(name))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,14 @@
 import os
+import math
+import json
 import fnmatch
+import argparse
 import datetime
+import multiprocessing
+
+from trial_log import load_columns
+from telemetry import load_telemetry, SUFFIX as TELEMETRY_SUFFIX
+from hospital_map import default_map
 
 def get_path():
     return os.getcwd()+'/log'
@@ -16,51 +24,87 @@ def get_log_files(basepath, ftype):
         print(file.name)
     return files_in_basepath
 
-def count_many_sims(basepath):
-    timeout = 0
-    success = 0
-    low_bat = 0
-    bt_fail = 0
-    total = 0
+def read_last_line(path, block_size=4096):
+    # walk backwards from EOF, only the tail of the log is ever read
+    with open(path, 'rb') as opened_file:
+        opened_file.seek(0, os.SEEK_END)
+        position = opened_file.tell()
+        data = b''
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            opened_file.seek(position)
+            data = opened_file.read(step) + data
+            if b'\n' in data.rstrip(b'\n'):
+                break
+    lines = data.rstrip(b'\n').rsplit(b'\n', 1)
+    return lines[-1].decode('utf-8', 'replace')
 
-    succeded= []
-    faileds = []
-    lows    = [] 
-    timeouts= []   
-    # print("Opening file: "+str(files))
-    # for file in files:
-    #         print(file.name)
+
+def classify_last_line(last_line):
+    if "reach-target" in last_line:
+        return 'success'
+    elif "failure-bt" in last_line:
+        return 'bt_fail'
+    elif "low-battery" in last_line:
+        return 'low_bat'
+    elif "timeout" in last_line or "trial-watcher, False:" in last_line:
+        return 'timeout'
+    elif "trial-watcher, stall-" in last_line:
+        return 'stall'
+    return None
+
+
+def classify_logs(basepath, index_name='.outcome_index.json'):
+    '''
+    Returns {log name: outcome class}. Results are cached in a sidecar index
+    keyed by file mtime and size, so only new or changed logs are touched
+    '''
+    index_path = os.path.join(basepath, index_name)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    outcomes = {}
+    updated = {}
     with os.scandir(basepath) as entries:
-        files_in_basepath = (entry for entry in entries if entry.is_file() and entry.name.endswith('.log'))
-        for file in files_in_basepath:
-            print("Opening file: "+file.name)
-            with open(file, 'r') as opened_file:
-                lines = opened_file.readlines()
-                last_line = ''
-                # print("Opening file: "+str(lines[-1]))
-                try:
-                    last_line = lines[-1]
-                except Exception as e:
-                    pass
-                
+        for entry in entries:
+            if not (entry.is_file() and entry.name.endswith('.log')):
+                continue
+            stat = entry.stat()
+            key = [stat.st_mtime_ns, stat.st_size]
+            cached = index.get(entry.name)
+            if cached is not None and cached[:2] == key:
+                outcome = cached[2]
+            else:
+                last_line = read_last_line(entry.path)
                 print("with last line: "+last_line)
-                if "reach-target" in last_line:
-                    success = success + 1
-                    succeded.append(file.name)
-                elif "failure-bt" in last_line:
-                    bt_fail = bt_fail + 1
-                    faileds.append(file.name)
-                elif "low-battery" in last_line:
-                    low_bat = low_bat + 1
-                    lows.append(file.name)
-                else:
-                    if "timeout" in last_line:
-                        timeout = timeout + 1
-                        timeouts.append(file.name)
-            total = success+low_bat+timeout+bt_fail
+                outcome = classify_last_line(last_line)
+            updated[entry.name] = key + [outcome]
+            outcomes[entry.name] = outcome
+    if updated != index:
+        with open(index_path+'.tmp', 'w') as f:
+            json.dump(updated, f)
+        os.replace(index_path+'.tmp', index_path)
+    return outcomes
+
+
+def count_many_sims(basepath):
+    succeded= []
+    faileds = []
+    lows    = []
+    timeouts= []
+    stalls  = []
+    groups = {'success': succeded, 'bt_fail': faileds, 'low_bat': lows, 'timeout': timeouts, 'stall': stalls}
+    for name, outcome in sorted(classify_logs(basepath).items()):
+        if outcome in groups:
+            groups[outcome].append(name)
+    total = len(succeded)+len(lows)+len(timeouts)+len(faileds)+len(stalls)
     print("lows: "+str(len(lows)/total)+" : "+str(lows))
     print("timeouts: "+str(len(timeouts)/total)+" : "+str(timeouts))
     print("faileds: "+str(len(faileds)/total)+" : "+str(faileds))
+    print("stalls: "+str(len(stalls)/total)+" : "+str(stalls))
     print("succeded: "+str(len(succeded)/total))
     print("total: "+str(total))
 
@@ -69,14 +113,111 @@ def count_many_sims(basepath):
         file.write('Type,Quantity,Percentage\n')
         file.write('BT Failure,'+str(len(faileds))+','+("%.2f"%(100*len(faileds)/total))+'\n')
         file.write('Timeout,'+str(len(timeouts))+','+("%.2f"%(100*len(timeouts)/total))+'\n')
+        file.write('Stall,'+str(len(stalls))+','+("%.2f"%(100*len(stalls)/total))+'\n')
         file.write('Low Battery,'+str(len(lows))+','+("%.2f"%(100*len(lows)/total))+'\n')
         file.write('Success,'+str(len(succeded))+','+("%.2f"%(100*len(succeded)/total))+'\n')
         file.write('Total,'+str(total)+','+("%.2f"%(100*total/total))+'\n')
 
 
+def get_factor_names(design_path='experiment_design/design.json'):
+    # the letters of a trial code follow the factor order of the design file
+    with open(design_path) as f:
+        design = json.load(f)
+    return [design[key]['factor'] for key in sorted(design, key=int)]
+
+
+def drain_slope(times, levels):
+    # least squares slope of battery level (%) over sim time (s)
+    n = len(times)
+    if n < 2:
+        return float('nan')
+    mean_t = sum(times)/n
+    mean_l = sum(levels)/n
+    var_t = sum((t - mean_t)**2 for t in times)
+    if var_t == 0:
+        return float('nan')
+    return sum((t - mean_t)*(l - mean_l) for t, l in zip(times, levels))/var_t
+
+
+def trial_summary(path):
+    columns = load_telemetry(path) if path.endswith(TELEMETRY_SUFFIX) else load_columns(path)
+    name = os.path.basename(path)
+    code = name.rsplit('.', 1)[0].split('_', 1)[-1]
+    robots = {}
+    hospital = default_map()
+    for robot in columns.robots():
+        poses = columns.select('pose', robot)
+        distance = 0.0
+        for prev, curr in zip(poses, poses[1:]):
+            distance += math.hypot(columns.x[curr] - columns.x[prev], columns.y[curr] - columns.y[prev])
+        batteries = columns.select('battery', robot)
+        robots[robot] = {
+            'distance': distance,
+            'drain_slope': drain_slope([columns.sim_time[i] for i in batteries], [columns.battery[i] for i in batteries]),
+            'pose_samples': len(poses),
+            # where the robot was last seen
+            'location': hospital.locate(columns.x[poses[-1]], columns.y[poses[-1]]) if poses else '',
+            'battery_samples': len(batteries),
+        }
+    sim_times = [t for t in columns.sim_time if not math.isnan(t)]
+    return {
+        'file': name,
+        'code': code,
+        'outcome': columns.outcome or 'unknown',
+        'sim_time': max(sim_times) if sim_times else 0.0,
+        'robots': robots,
+    }
+
+
+def analyze_campaign(basepath, processes=None, suffix='.log'):
+    with os.scandir(basepath) as entries:
+        paths = sorted(entry.path for entry in entries if entry.is_file() and entry.name.endswith(suffix) and '_' in entry.name)
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(trial_summary, paths, chunksize=8)
+
+
+def outcome_rates_by_factor(summaries, factor_names):
+    rates = {}
+    for summary in summaries:
+        for factor, level in zip(factor_names, summary['code']):
+            outcomes = rates.setdefault((factor, level), {})
+            outcomes[summary['outcome']] = outcomes.get(summary['outcome'], 0) + 1
+    for outcomes in rates.values():
+        total = sum(outcomes.values())
+        for outcome in outcomes:
+            outcomes[outcome] = outcomes[outcome]/total
+    return rates
+
+
+def save_analytics(summaries, factor_names):
+    current_date = datetime.datetime.today().strftime('%H-%M-%S-%d-%b-%Y')
+    with open('analytics-'+current_date+'.csv', 'w') as file:
+        file.write('File,Code,Outcome,SimTime,Robot,Distance,DrainSlope,PoseSamples,BatterySamples,LastLocation\n')
+        for summary in summaries:
+            for robot, stats in summary['robots'].items():
+                file.write('%s,%s,%s,%.2f,turtlebot%d,%.3f,%.6f,%d,%d,%s\n'%(summary['file'], summary['code'], summary['outcome'],
+                    summary['sim_time'], robot, stats['distance'], stats['drain_slope'], stats['pose_samples'], stats['battery_samples'],
+                    stats['location']))
+    with open('factor-rates-'+current_date+'.csv', 'w') as file:
+        file.write('Factor,Level,Outcome,Rate\n')
+        for (factor, level), outcomes in sorted(outcome_rates_by_factor(summaries, factor_names).items()):
+            for outcome, rate in sorted(outcomes.items()):
+                file.write('%s,%s,%s,%.4f\n'%(factor, level, outcome, rate))
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Summarize the trial logs')
+    parser.add_argument('--analytics', action='store_true', help='per robot distance/battery analytics and per factor outcome rates')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes used by --analytics')
+    parser.add_argument('--telemetry', action='store_true', help='analyze the binary telemetry files instead of the text logs')
+    args = parser.parse_args()
     path = get_path()
     print(path)
+    if args.analytics:
+        summaries = analyze_campaign(path, args.processes, TELEMETRY_SUFFIX if args.telemetry else '.log')
+        print("analyzed %d trial logs"%len(summaries))
+        save_analytics(summaries, get_factor_names())
+        return
     list_of_files = get_log_files(path, '.log')
     print(list_of_files)
     count_many_sims(path)
@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+
+import re
+import json
+import sqlite3
+import datetime
+
+from trial_log import parse_line
+from trial_metrics import STAT_FIELDS
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trials (
+    id          INTEGER PRIMARY KEY,
+    campaign    TEXT NOT NULL,
+    trial_id    INTEGER NOT NULL,
+    code        TEXT NOT NULL,
+    outcome     TEXT NOT NULL,
+    wall_clock  REAL,
+    phases      TEXT,
+    log_path    TEXT,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS trials_campaign ON trials (campaign, outcome);
+CREATE INDEX IF NOT EXISTS trials_trial ON trials (campaign, trial_id);
+CREATE INDEX IF NOT EXISTS trials_code ON trials (campaign, code);
+
+CREATE TABLE IF NOT EXISTS trial_factors (
+    trial   INTEGER NOT NULL REFERENCES trials (id),
+    factor  TEXT NOT NULL,
+    level   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trial_factors_level ON trial_factors (factor, level);
+CREATE INDEX IF NOT EXISTS trial_factors_trial ON trial_factors (trial);
+
+CREATE TABLE IF NOT EXISTS events (
+    trial    INTEGER NOT NULL REFERENCES trials (id),
+    sim_time REAL,
+    source   TEXT,
+    kind     TEXT NOT NULL,
+    data     TEXT
+);
+CREATE INDEX IF NOT EXISTS events_trial ON events (trial, kind);
+
+CREATE TABLE IF NOT EXISTS trial_marks (
+    trial INTEGER NOT NULL REFERENCES trials (id),
+    mark  TEXT NOT NULL,
+    at_s  REAL
+);
+CREATE INDEX IF NOT EXISTS trial_marks_trial ON trial_marks (trial);
+
+CREATE TABLE IF NOT EXISTS container_stats (
+    trial       INTEGER NOT NULL REFERENCES trials (id),
+    at_s        REAL,
+    container   TEXT NOT NULL,
+    cpu_percent REAL,
+    mem_bytes   REAL,
+    block_read  REAL,
+    block_write REAL,
+    net_rx      REAL,
+    net_tx      REAL
+);
+CREATE INDEX IF NOT EXISTS container_stats_trial ON container_stats (trial, container);
+
+CREATE TABLE IF NOT EXISTS container_logs (
+    trial     INTEGER NOT NULL REFERENCES trials (id),
+    container TEXT NOT NULL,
+    part      INTEGER NOT NULL,
+    path      TEXT NOT NULL,
+    bytes     INTEGER
+);
+CREATE INDEX IF NOT EXISTS container_logs_trial ON container_logs (trial, container);
+
+CREATE TABLE IF NOT EXISTS campaign_trials (
+    campaign   TEXT NOT NULL,
+    position   INTEGER NOT NULL,
+    trial_id   INTEGER NOT NULL,
+    code       TEXT NOT NULL,
+    state      TEXT NOT NULL DEFAULT 'pending',
+    reason     TEXT,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    PRIMARY KEY (campaign, code)
+);
+'''
+
+# the row of each trial of a campaign that counts: a trial run again (--force, a
+# result uploaded after its lease was reissued) supersedes its earlier rows
+LATEST_TRIALS = 'SELECT MAX(id) FROM trials WHERE campaign = ? GROUP BY code'
+
+# campaign_trials.state values
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# predicted to fail by the pre-flight check and not run
+SKIPPED = 'skipped'
+
+# outcome -> Orchestrator counter
+OUTCOME_COUNTERS = {
+    'reach-target': 'n_successes',
+    'failure-bt': 'n_bt_failures',
+    'low-battery': 'n_low_battery',
+    'timeout-sim': 'n_timeout_sim',
+    'timeout-wall': 'n_timeout_wall',
+    'stall-startup': 'n_stall_startup',
+    'stall-move-base': 'n_stall_move_base',
+    'stall-sim': 'n_stall_sim',
+    'stall-robot': 'n_stall_robot',
+}
+
+
+class ResultsStore(object):
+    """Append-only SQLite (WAL) store holding one row per trial and its parsed event stream"""
+    def __init__(self, path):
+        super(ResultsStore, self).__init__()
+        self.path = path
+        # one connection per orchestrator, WAL lets parallel slots append concurrently
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def record_trial(self, campaign, trial, outcome, wall_clock, phases, lines, log_path=None, marks=None, samples=None,
+                     container_logs=None):
+        '''
+        marks: {mark: seconds since the trial started}, samples: [(seconds, container, stats dict)],
+        container_logs: [(container, part, path, bytes)] of the captured container output
+        '''
+        finished_at = datetime.datetime.now().isoformat()
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO trials (campaign, trial_id, code, outcome, wall_clock, phases, log_path, finished_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (campaign, trial["id"], trial["code"], outcome, wall_clock, json.dumps(phases), log_path, finished_at))
+            row = cursor.lastrowid
+            self.db.executemany('INSERT INTO trial_factors (trial, factor, level) VALUES (?, ?, ?)',
+                                [(row, factor, level) for factor, level in trial.get("factors", {}).items()])
+            events = (parse_line(line) for line in lines)
+            self.db.executemany('INSERT INTO events (trial, sim_time, source, kind, data) VALUES (?, ?, ?, ?, ?)',
+                                [(row, event.sim_time, event.source, event.kind, json.dumps(event.data)) for event in events])
+            self.db.executemany('INSERT INTO trial_marks (trial, mark, at_s) VALUES (?, ?, ?)',
+                                [(row, mark, at) for mark, at in (marks or {}).items()])
+            self.db.executemany('INSERT INTO container_stats (trial, at_s, container, cpu_percent, mem_bytes, '
+                                'block_read, block_write, net_rx, net_tx) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(row, at, name)+tuple(stats[field] for field in STAT_FIELDS)
+                                 for at, name, stats in (samples or [])])
+            self.db.executemany('INSERT INTO container_logs (trial, container, part, path, bytes) VALUES (?, ?, ?, ?, ?)',
+                                [(row,)+tuple(entry) for entry in (container_logs or [])])
+            # same transaction as the result, so a trial is never counted twice after a crash
+            self.db.execute('UPDATE campaign_trials SET state = ?, reason = NULL, updated_at = ? WHERE campaign = ? AND code = ?',
+                            (DONE, finished_at, campaign, trial["code"]))
+        return row
+
+    def plan_campaign(self, campaign, trials):
+        '''
+        Adds the (position, trial) pairs not yet known to the campaign manifest as pending
+        '''
+        now = datetime.datetime.now().isoformat()
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO campaign_trials (campaign, position, trial_id, code, state, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(campaign, position, trial["id"], trial["code"], PENDING, now) for position, trial in trials])
+
+    def set_trial_state(self, campaign, code, state, reason=None):
+        now = datetime.datetime.now().isoformat()
+        attempt = 1 if state == RUNNING else 0
+        with self.db:
+            self.db.execute('UPDATE campaign_trials SET state = ?, reason = ?, attempts = attempts + ?, updated_at = ? '
+                            'WHERE campaign = ? AND code = ?', (state, reason, attempt, now, campaign, code))
+
+    def fail_trial(self, campaign, code, reason=None):
+        '''
+        Marks a trial failed unless it is already recorded: a stage failing after
+        record_trial (teardown, table files) must not send a finished trial back to the queue
+        '''
+        now = datetime.datetime.now().isoformat()
+        with self.db:
+            cursor = self.db.execute('UPDATE campaign_trials SET state = ?, reason = ?, updated_at = ? '
+                                     'WHERE campaign = ? AND code = ? AND state != ?',
+                                     (FAILED, reason, now, campaign, code, DONE))
+        return cursor.rowcount > 0
+
+    def trial_states(self, campaign):
+        '''
+        Returns {code: (state, attempts, reason)} for every trial of the campaign
+        '''
+        rows = self.db.execute('SELECT code, state, attempts, reason FROM campaign_trials WHERE campaign = ?', (campaign,))
+        return {code: (state, attempts, reason) for code, state, attempts, reason in rows}
+
+    def outcome_counts(self, campaign):
+        rows = self.db.execute(f'SELECT outcome, COUNT(*) FROM trials WHERE id IN ({LATEST_TRIALS}) GROUP BY outcome',
+                               (campaign,))
+        return dict(rows.fetchall())
+
+    def outcome_counts_by_factor(self, campaign):
+        '''
+        Returns {(factor, level): {outcome: number of trials at that level}}
+        '''
+        rows = self.db.execute(
+            'SELECT f.factor, f.level, t.outcome, COUNT(*) FROM trials t '
+            f'JOIN trial_factors f ON f.trial = t.id WHERE t.id IN ({LATEST_TRIALS}) '
+            'GROUP BY f.factor, f.level, t.outcome', (campaign,))
+        counts = {}
+        for factor, level, outcome, count in rows:
+            counts.setdefault((factor, level), {})[outcome] = count
+        return counts
+
+    def outcome_rates_by_factor(self, campaign):
+        '''
+        Returns {(factor, level): {outcome: fraction of the trials at that level}}
+        '''
+        rates = self.outcome_counts_by_factor(campaign)
+        for outcomes in rates.values():
+            total = sum(outcomes.values())
+            for outcome in outcomes:
+                outcomes[outcome] = outcomes[outcome] / total
+        return rates
+
+    def recorded_codes(self, campaign):
+        rows = self.db.execute('SELECT DISTINCT code FROM trials WHERE campaign = ?', (campaign,))
+        return set(code for code, in rows)
+
+    def mark_times(self, campaign):
+        '''
+        Returns {mark: (mean, max) seconds since the trial started} over the
+        campaign, the latest attempt of each trial only
+        '''
+        rows = self.db.execute(
+            'SELECT m.mark, AVG(m.at_s), MAX(m.at_s) FROM trial_marks m '
+            f'WHERE m.trial IN ({LATEST_TRIALS}) GROUP BY m.mark', (campaign,))
+        return {mark: (mean, peak) for mark, mean, peak in rows}
+
+    def container_usage(self, campaign):
+        '''
+        Returns {service: (mean cpu %, max cpu %, max memory bytes)} of the busiest
+        container of each service over the campaign (the latest attempt of each trial),
+        the slot prefix and robot number dropped from the container names
+        (morsesim1_motion_ctrl3 -> motion_ctrl)
+        '''
+        rows = self.db.execute(
+            'SELECT s.container, AVG(s.cpu_percent), MAX(s.cpu_percent), MAX(s.mem_bytes) FROM container_stats s '
+            f'WHERE s.trial IN ({LATEST_TRIALS}) GROUP BY s.container', (campaign,))
+        usage = {}
+        for container, cpu_mean, cpu_max, mem_max in rows:
+            service = re.sub(r'\d+$', '', re.sub(r'^morsesim\d+_', '', container))
+            mean, peak, mem = usage.get(service, (0.0, 0.0, 0.0))
+            usage[service] = (max(mean, cpu_mean), max(peak, cpu_max), max(mem, mem_max))
+        return usage
+
+    def container_log_files(self, campaign, trial_id, container=None):
+        '''
+        Returns [(code, container, part, path, bytes)] of the captured container
+        output of a trial (of all its treatments), in part order
+        '''
+        query = ('SELECT t.code, l.container, l.part, l.path, l.bytes FROM container_logs l '
+                 f'JOIN trials t ON t.id = l.trial WHERE t.id IN ({LATEST_TRIALS}) AND t.trial_id = ?')
+        params = [campaign, trial_id]
+        if container is not None:
+            query += ' AND l.container = ?'
+            params.append(container)
+        return self.db.execute(query+' ORDER BY t.code, l.container, l.part', params).fetchall()
+
+    def close(self):
+        self.db.close()
@@ -2,25 +2,43 @@
 
 import os
 import json
+import argparse
 import math
 import yaml
 import copy
 import time
 import shlex
 import shutil
+import queue
 import random
 import datetime
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-
+from trial_log import LogFollower, TrialWatchdog
+from trial_metrics import StatsSampler, summarize_samples, write_metrics
+from telemetry import write_telemetry
+from container_logs import ContainerLogCollector
+from trial_source import TrialSource
+from hospital_map import default_map
+from work_queue import Coordinator, run_workers
+from results_store import ResultsStore, OUTCOME_COUNTERS, RUNNING, DONE, FAILED, SKIPPED
+from container_runtime import make_runtime, DOCKER_SOCKET
+from feasibility import predict, preflight_order
+from trial_cache import TrialCache, CACHEABLE_OUTCOMES, environment_fingerprint, build_hash, trial_key
 
 
 class Robot(object):
     """docstring for Robot"""
-    def __init__(self, n, loc, batt_level, skills, config):
+    def __init__(self, n, loc, batt_level, skills, config, env_file=None, prefix='', log_dir='./log', pytrees_image=None):
         super(Robot, self).__init__()
         self.id = n
-        self.pose = self.get_pose_from_loc(loc)
+        self.env_file = env_file if env_file is not None else env_path
+        self.prefix = prefix
+        self.log_dir = log_dir
+        self.pytrees_image = pytrees_image
+        self.pose = default_map().pose(loc)
         self.batt_level = batt_level
         self.skills = skills
         self.config = config
@@ -36,32 +54,6 @@ class Robot(object):
         self.build_motion_docker()
         self.build_pytrees_docker()
 
-    def get_pose_from_loc(self, loc):
-        poses = {
-            "IC Corridor": [-37, 15],
-            "IC Room 1": [-39.44, 33.98, 0.00],
-            "IC Room 2": [-32.88, 33.95, 3.14],
-            "IC Room 3": [-40.23, 25.37, 0.00],
-            "IC Room 4": [-33.90, 18.93, 3.14],
-            "IC Room 5": [-38.00, 21.50, 0.00],
-            "IC Room 6": [-38.00, 10.00, 0.00],
-            "PC Corridor": [-19, 16],
-            "PC Room 1": [-28.50, 18.00,-1.57],
-            "PC Room 2": [-27.23, 18.00,-1.57],
-            "PC Room 3": [-21.00, 18.00,-1.57],
-            "PC Room 4": [-19.00, 18.00,-1.57],
-            "PC Room 5": [-13.50, 18.00,-1.57],
-            "PC Room 6": [-11.50, 18,-1.57],
-            "PC Room 7": [-4, 18,-1.57],
-            "PC Room 8": [-27.23, 13.00, 1.57],
-            "PC Room 9": [-26.00, 13.00, 1.57],
-            "PC Room 10": [-18.00, 13.00, 1.57],
-            "Reception": [-1, 20],
-            "Pharmacy Corridor": [0, 8],
-            "Pharmacy": [-2, 2.6],
-        }
-        return poses[loc]
-
     def get_id(self):
         return self.id
 
@@ -118,12 +110,12 @@ class Robot(object):
                 'context' : './docker',
                 'dockerfile': 'Dockerfile.motion',
             },
-            'container_name': container_name,
+            'container_name': self.prefix+container_name,
             'runtime': 'runc',
             'depends_on': ['master'],
             # 'ports': ["9090:9090"],
-            'env_file': [env_path],
-            'volumes': [f'./docker/{self.motion_pkg_name}:/ros_ws/src/{self.motion_pkg_name}/', './docker/turtlebot3_hospital_sim:/ros_ws/src/turtlebot3_hospital_sim/', './log/:/root/.ros/logger_sim/'],
+            'env_file': [self.env_file],
+            'volumes': [f'./docker/{self.motion_pkg_name}:/ros_ws/src/{self.motion_pkg_name}/', './docker/turtlebot3_hospital_sim:/ros_ws/src/turtlebot3_hospital_sim/', f'{self.log_dir}/:/root/.ros/logger_sim/'],
             'environment': [f"ROS_HOSTNAME={container_name}", "ROS_MASTER_URI=http://master:11311", f"ROBOT_NAME=turtlebot{self.id}"],
             # 'command': '/bin/bash -c "source /ros_ws/devel/setup.bash && roslaunch motion_ctrl base_navigation.launch & rosrun topic_tools relay /move_base_simple/goal /turtlebot1/move_base_simple/goal"'
             'command': '/bin/bash -c "source /ros_ws/devel/setup.bash && roslaunch motion_ctrl base_navigation.launch --wait"',
@@ -183,10 +175,10 @@ class Robot(object):
                 'context' : './docker',
                 'dockerfile': 'Dockerfile.pytrees',
             },
-            'container_name': container_name,
+            'container_name': self.prefix+container_name,
             'runtime': 'runc',
             'depends_on': ['master', f'motion_ctrl{self.id}'],
-            'env_file': [env_path],
+            'env_file': [self.env_file],
             'volumes': ['/tmp/.docker.xauth:/tmp/.docker.xauth:rw',
                 '/tmp/.X11-unix:/tmp/.X11-unix:rw',
                 '/var/run/dbus:/var/run/dbus:ro',
@@ -206,10 +198,17 @@ class Robot(object):
             # },
             'networks': ['morsegatonet']
         }
+        if self.pytrees_image is not None:
+            # the workspace was already built into the image, skip the mount and colcon build
+            del self.pytreesd['build']
+            self.pytreesd['image'] = self.pytrees_image
+            self.pytreesd['volumes'] = self.pytreesd['volumes'][:-1]
+            self.pytreesd['command'] = '/bin/bash -c "source /ros_ws/install/setup.bash && ros2 launch py_trees_ros_behaviors tutorial_seven_docking_cancelling_failing_launch.py"'
 
 class Orchestrator(object):
     """docstring for Orchestrator"""
-    def __init__(self, config_file="trials.json", exp_id=0):
+    def __init__(self, config_file="trials.json", exp_id=0, slot=None, reuse_containers=False, campaign=None,
+                 runtime='compose', docker_socket=DOCKER_SOCKET):
         super(Orchestrator, self).__init__()
         self.sim_process = None
         self.docker_compose = dict()
@@ -217,43 +216,109 @@ class Orchestrator(object):
         self.nrobots = 0
         self.config_file = config_file
         self.simulation_timeout_s = 45*60
-        self.load_trials(self.config_file)
-        self.relocate_nurse = {
-            "PC Room 1": [-1, -1],
-            "PC Room 2": [-1, -1],
-            "PC Room 3": [-1, +1],
-            "PC Room 4": [+1, +1],
-            "PC Room 5": [-1, +1],
-            "PC Room 6": [+1, +1],
-            "PC Room 7": [-1, +1],
-            "PC Room 8": [+1, +1],
-            "IC Room 1": [-1, +1],
-            "IC Room 2": [-1, -1],
-            "IC Room 3": [-1, +1],
-            "IC Room 4": [-1, -1],
-            "IC Room 5": [+1, -1],
-            "IC Room 6": [+1, +1],
+        # teardown waits end as soon as their condition holds, these are upper bounds
+        self.log_quiet_s = 2
+        self.flush_timeout_s = 30
+        self.exit_timeout_s = 60
+        # hung trials are aborted as soon as the log stops showing progress, see TrialWatchdog
+        self.use_watchdog = True
+        self.watchdog_thresholds = {
+            'startup_timeout_s': 180,
+            'ready_timeout_s': 300,
+            'sim_stall_s': 120,
+            'robot_silent_s': 60,
+            'robot_frozen_s': 180,
         }
+        self.watchdog = None
+        self.phase_times = {}
+        # wall clock marks since the trial started and container stats sampled every stats_period_s (0: off)
+        self.trial_start = None
+        self.marks = {}
+        self.stats_period_s = 10
+        self.stats_sampler = None
+        self.samples = []
+        # None, or the codec of the binary pose/battery telemetry archived next to each trial log
+        self.telemetry_codec = None
+        # output of every container streamed to log/containers/<trial>/ in gzip parts of
+        # container_log_bytes (0: off), at most container_log_parts of them per container
+        self.container_log_bytes = 16*1024**2
+        self.container_log_parts = 4
+        self.log_collector = None
+        self.container_logs = []
+        # reuse_containers keeps the containers (and their network) between trials instead of recreating
+        # them. Their processes still restart every trial, MORSE and the ROS master included: only
+        # ros1_bridge keeps running, resetting the others needs support in the submodules
+        self.reuse_containers = reuse_containers
+        self.pool_services = ['ros1_bridge']
+        self.pool_up = False
+        # py_trees workspace built once into an image tagged by the behaviors source hash
+        self.use_image_cache = True
+        self.pytrees_image = None
+        self.setup_slot(slot)
+        # compose: docker-compose CLI, engine: Docker Engine API over the local socket
+        self.runtime = make_runtime(runtime, self.compose_name, self.project_name, current_path, docker_socket)
+        self.load_trials(self.config_file)
+        self.hospital = default_map()
         self.endsim = ''
         self.chose_robot = ""
+        self.lines = []
         self.n_timeout_wall = 0
         self.n_timeout_sim = 0
         self.n_successes = 0
         self.n_bt_failures = 0
         self.n_low_battery = 0
+        self.n_stall_startup = 0
+        self.n_stall_move_base = 0
+        self.n_stall_sim = 0
+        self.n_stall_robot = 0
         self.total = 0
         self.current_date = datetime.datetime.today().strftime('%H-%M-%S-%d-%b-%Y')
+        # reusing a campaign name resumes it from the checkpoints in the results store
+        self.campaign = campaign if campaign is not None else f'exp{self.xp_id}-{self.current_date}'
+        self.max_attempts = 3
+        # None, or a feasibility pre-flight mode: order, skip or flag
+        self.preflight = None
+        # the random choices of a trial (yaw, display) derive from seed and trial code,
+        # so a trial is a pure function of its config and can be memoised
+        self.seed = 0
+        self.rng = random.Random()
+        self.use_cache = True
+        # run every trial again even when the cache has it
+        self.force = False
+        self.cache = TrialCache(f'{self.archive_dir}/cache')
+        self.cache_environment = None
+        self.trial_key = None
+        self.results = ResultsStore(f'{self.archive_dir}/results.db')
+
+    def setup_slot(self, slot):
+        # every slot is an isolated compose project: own files, network and log dir
+        self.slot = slot
+        self.archive_dir = f'{current_path}/log'
+        if slot is None:
+            self.project_name = None
+            self.container_prefix = ''
+            self.compose_name = 'experiment_trials.yaml'
+            self.env_path = env_path
+            self.log_dir = f'{current_path}/log'
+            self.trial_dir = f'{current_path}/trial_env'
+            self.subnet_prefix = '10.2'
+        else:
+            self.project_name = f'morsesim{slot}'
+            self.container_prefix = f'{self.project_name}_'
+            self.compose_name = f'experiment_trials_{slot}.yaml'
+            self.env_path = f'{current_path}/sim_{slot}.env'
+            self.log_dir = f'{current_path}/log/slot{slot}'
+            self.trial_dir = f'{current_path}/trial_env_{slot}'
+            self.subnet_prefix = f'10.{10+slot}'
+            os.makedirs(self.log_dir, exist_ok=True)
 
     def load_trials(self, file_name):
         # file_name = "experiment_sample.json"
         curr_path = os.getcwd()+'/'
         file_path = curr_path + file_name
-        self.config = None
-        with open(file_path) as f:
-            self.config = json.load(f)
-        print(print(json.dumps(self.config[0]["robots"][0], indent=2, sort_keys=True)))
-        print(self.config[0]["nurses"][0])
-        print(len(self.config[0]["robots"][1]))
+        # only the byte offsets of the trials are loaded, each one is parsed when accessed
+        self.config = TrialSource(file_path)
+        print(f'{len(self.config)} trials in {file_path}')
         self.nurses_config = self.config[0]["nurses"]
         self.robots_config = self.config[0]["robots"]
 
@@ -268,150 +333,315 @@ class Orchestrator(object):
         self.save_compose_file()
 
     def run_simulation(self):
+        self.run_trial(0)
+
+    def run_trial(self, idx):
+        self.prepare_trial(idx)
+        self.launch_trial(idx)
+        self.watch_trial()
+        self.finish_trial()
+
+    def prepare_trial(self, idx, create=False):
+        '''
+        Writes the env and compose files of trial idx; with create the containers
+        are also created, so launch_trial only has to start them
+        '''
         self.endsim = False
-        idx = 0
+        self.trial_start = time.time()
+        self.marks = {}
+        print(f"RUNNING TRIALS #{idx}")
+        self.results.set_trial_state(self.campaign, self.config[idx]["code"], RUNNING)
         self.nurses_config = self.config[idx]["nurses"]
         self.robots_config = self.config[idx]["robots"]
-        self.create_env_file(self.config[idx]["id"]. self.config[idx]["code"])
+        self.trial         = self.config[idx]
+        self.trial_id      = self.config[idx]["id"]
+        self.trial_code    = self.config[idx]["code"]
+        if self.use_image_cache:
+            self.ensure_pytrees_image()
+        if self.use_cache:
+            self.trial_key = self.cache_key(self.trial)
+        self.create_env_file(self.trial_id, self.trial_code)
+        self.mark('env')
         self.create_dockers()
         self.create_robots()
         self.save_compose_file()
-        print("STARTING SIMULATION...")
+        self.mark('compose')
+        self.phase_times = {}
+        if create:
+            phase_start = time.time()
+            self.runtime.create(self.services, self.networks)
+            self.phase_times['create'] = time.time() - phase_start
+            self.mark('created')
+
+    def launch_trial(self, idx):
+        print(f"STARTING SIMULATION #{idx}...")
+        phase_start = time.time()
         self.start_simulation()
-        start = time.time()
-        runtime = time.time()
+        self.phase_times['up'] = time.time() - phase_start
+        self.mark('up')
+        self.start_stats()
+        self.run_start = time.time()
         self.clear_log_file()
+        self.lines = []
+        self.log_follower = LogFollower(f'{self.log_dir}/trial.log')
+        if self.use_watchdog:
+            robots = [f'turtlebot{r_config["id"]}' for r_config in self.robots_config]
+            self.watchdog = TrialWatchdog(robots, self.chose_robot, start=self.run_start, **self.watchdog_thresholds)
+        # reused containers still hold the output of the earlier trials
+        self.start_container_logs('{:0>2d}_{}'.format(self.trial_id, self.trial_code), self.trial_start if self.reuse_containers else None)
+
+    def watch_trial(self):
         # call simulation and watch timeout
-        while (runtime - start) <= self.simulation_timeout_s and self.endsim == False:
-           time.sleep(1)
-           runtime = time.time()
-           self.check_end_simulation()
-        end = time.time()
+        runtime = time.time()
+        while (runtime - self.run_start) <= self.simulation_timeout_s and self.endsim == False:
+            self.check_end_simulation(timeout_s=1)
+            runtime = time.time()
+        self.run_end = time.time()
+        self.phase_times['run'] = self.run_end - self.run_start
+
+    def finish_trial(self):
+        self.stop_stats()
         self.close_simulation()
-        print("ENDING SIMULATION...")
-        print(f"Runtime of the simulation is {end - start}")
-        self.save_log_file(idx, end - start)
+        self.stop_container_logs()
+        self.mark('teardown')
+        self.log_follower.close()
+        execution_time = self.run_end - self.run_start
+        print(f"ENDING SIMULATION #{self.trial_id}...")
+        print(f"Runtime of the simulation #{self.trial_id} is {execution_time}")
+        self.save_log_file(self.trial_id, self.trial_code, execution_time)
         self.save_table_file()
+        print(f"Phase timings of the simulation #{self.trial_id}: {self.format_phase_times()}")
+
+    def mark(self, name):
+        # only the first occurrence counts, e.g. first-pose
+        if name not in self.marks:
+            self.marks[name] = time.time() - self.trial_start
+
+    def start_stats(self):
+        self.samples = []
+        if self.stats_period_s:
+            self.stats_sampler = StatsSampler(self.runtime, self.stats_period_s)
+            self.stats_sampler.start(self.trial_start)
+
+    def stop_stats(self):
+        if self.stats_sampler is not None:
+            self.samples = self.stats_sampler.stop()
+            self.stats_sampler = None
+
+    def start_container_logs(self, name, since=None):
+        self.container_logs = []
+        if self.container_log_bytes:
+            self.log_collector = ContainerLogCollector(self.runtime, f'{self.archive_dir}/containers/{name}',
+                                                       self.container_log_bytes, self.container_log_parts)
+            self.log_collector.start([service['container_name'] for service in self.services.values()], since)
+
+    def stop_container_logs(self):
+        if self.log_collector is not None:
+            self.container_logs = self.log_collector.stop()
+            self.log_collector = None
+
+    def wait_for(self, condition, timeout_s, interval_s=0.5):
+        # returns as soon as condition() holds, timeout_s is only an upper bound
+        start = time.time()
+        while not condition() and (time.time() - start) < timeout_s:
+            time.sleep(interval_s)
+        return time.time() - start
+
+    def log_is_quiet(self):
+        # the logger has flushed once trial.log stops growing for log_quiet_s
+        offset = self.log_follower.offset
+        for event in self.log_follower.wait(self.log_quiet_s):
+            self.lines.append(event.line)
+        return self.log_follower.offset == offset
+
+    def containers_exited(self):
+        running = self.runtime.running_services()
+        if running is None:
+            return False
+        if self.reuse_containers:
+            return not any(name in running for name in self.trial_services())
+        return running == []
+
+    def shutdown_pool(self):
+        if not self.pool_up:
+            return
+        print('Removing the reused containers')
+        self.runtime.down()
+        self.pool_up = False
+
+    def format_phase_times(self):
+        return ' '.join(f'{phase}={duration:.2f}' for phase, duration in self.phase_times.items())
 
     def run_some_simulations(self, sim_list):
-        print("RUNNING %d TRIALS FOR THIS EXPERIMENT"%len(self.config))
-        # create files
+        sim_list = self.resume_campaign(sim_list)
+        print("RUNNING %d TRIALS FOR THIS EXPERIMENT"%len(sim_list))
         for idx in sim_list:
-            self.endsim = False
-            print("RUNNING TRIALS #%d"%idx)
-            self.nurses_config = self.config[idx]["nurses"]
-            self.robots_config = self.config[idx]["robots"]
-            self.create_env_file(self.config[idx]["id"], self.config[idx]["code"])
-            self.create_dockers()
-            self.create_robots()
-            self.save_compose_file()
-            print(f"STARTING SIMULATION #{idx}...")
-            self.start_simulation()
-            start = time.time()
-            runtime = time.time()
-            self.clear_log_file()
-            # call simulation and watch timeout
-            while (runtime - start) <= self.simulation_timeout_s and self.endsim == False:
-                time.sleep(1)
-                runtime = time.time()
-                self.check_end_simulation()
-                # check simulation end
-            end = time.time()
-            self.close_simulation()
-            print(f"ENDING SIMULATION #{idx}...")
-            print(f"Runtime of the simulation #{idx} is {end - start}")
-            self.save_log_file(self.config[idx]["id"], self.config[idx]["code"], end - start)
-            self.save_table_file()
+            self.run_checkpointed(idx)
+        self.shutdown_pool()
 
     def run_all_simulations(self):
-        print("RUNNING %d TRIALS FOR THIS EXPERIMENT"%len(self.config))
-        # create files
-        for i in range(0, len(self.config)):
-            self.endsim = False
-            print(f"RUNNING TRIALS #{i}")
-            self.nurses_config = self.config[i]["nurses"]
-            self.robots_config = self.config[i]["robots"]
-            self.trial_id      = self.config[i]["id"]
-            self.trial_code    = self.config[i]["code"]
-            self.create_env_file(self.trial_id, self.config[i]["code"])
-            self.create_dockers()
-            self.create_robots()
-            self.save_compose_file()
-            print(f"STARTING SIMULATION #{i}...")
-            self.start_simulation()
-            start = time.time()
-            runtime = time.time()
-            self.clear_log_file()
-            # call simulation and watch timeout
-            while (runtime - start) <= self.simulation_timeout_s and self.endsim == False:
-                time.sleep(1)
-                runtime = time.time()
-                self.check_end_simulation()
-                # check simulation end
-            end = time.time()
-            self.close_simulation()
-            print(f"ENDING SIMULATION #{i}...")
-            print(f"Runtime of the simulation #{self.trial_id} is {end - start}")
-            self.save_log_file(self.config[i]["id"], self.config[i]["code"], end - start)
-            self.save_table_file()
+        self.run_some_simulations(range(0, len(self.config)))
+
+    def resume_campaign(self, sim_list, build_images=True):
+        '''
+        Checkpoints sim_list in the campaign manifest and returns the trials still
+        to run: pending ones, interrupted ones (left running), failed ones with
+        attempts left and the ones a pre-flight skipped, which the pre-flight of
+        this run (if any) decides on again. A coordinator runs no trials and
+        passes build_images=False
+        '''
+        self.results.plan_campaign(self.campaign, [(idx, self.config[idx]) for idx in sim_list])
+        states = self.results.trial_states(self.campaign)
+        todo = []
+        for idx in sim_list:
+            state, attempts, reason = states[self.config[idx]["code"]]
+            if state == DONE or (state == FAILED and attempts >= self.max_attempts):
+                continue
+            todo.append(idx)
+        print(f"Campaign {self.campaign}: {len(sim_list) - len(todo)} of {len(sim_list)} trials already settled")
+        if self.use_cache and not self.force:
+            todo = self.serve_cached(todo, build_images)
+        self.update_counters()
+        if self.preflight is not None:
+            todo = self.apply_preflight(todo)
+        return todo
+
+    def cache_key(self, trial):
+        if self.cache_environment is None:
+            # once per campaign, the sources can not change under a running campaign
+            images = [self.pytrees_image] if self.pytrees_image is not None else []
+            self.cache_environment = environment_fingerprint(current_path, images)
+        return trial_key(trial, self.seed, self.cache_environment)
+
+    def serve_cached(self, sim_list, build_images=True):
+        '''
+        Records the trials of sim_list found in the cache as done, copying their
+        logs to the archive, and returns the ones still to run
+        '''
+        # the image digest is part of the key, so the image has to exist first
+        if self.use_image_cache and not self.ensure_pytrees_image(build=build_images):
+            print("Cache: not looked up, the py_trees image is not built on this host")
+            return sim_list
+        todo = []
+        for idx in sim_list:
+            trial = self.config[idx]
+            hit = self.cache.get(self.cache_key(trial))
+            if hit is None:
+                todo.append(idx)
+                continue
+            result, cached_log = hit
+            log_path = '{}/{:0>2d}_{}.log'.format(self.archive_dir, trial["id"], trial["code"])
+            shutil.copyfile(cached_log, log_path)
+            with open(cached_log) as f:
+                lines = [line for line in f if ', trial-watcher, ' not in line]
+            self.results.record_trial(self.campaign, trial, result["outcome"], result["wall_clock"],
+                                      result["phases"], lines, log_path)
+        if len(todo) < len(sim_list):
+            print(f"Cache: {len(sim_list) - len(todo)} of {len(sim_list)} trials served from {self.cache.path}")
+        return todo
+
+    def apply_preflight(self, sim_list):
+        predictions = predict(self.config)
+        for idx in sim_list:
+            prediction = predictions[idx]
+            if prediction.outcome != 'reach-target':
+                print(f"Pre-flight: trial #{idx} {prediction.code} predicted {prediction.outcome} "
+                      f"(battery {prediction.battery_needed:.3f}/{prediction.battery_available:.3f}, "
+                      f"missing skills {prediction.missing_skills})")
+        sim_list, dropped = preflight_order(predictions, sim_list, self.preflight)
+        for prediction in dropped:
+            self.results.set_trial_state(self.campaign, prediction.code, SKIPPED, f'predicted {prediction.outcome}')
+        print(f"Pre-flight ({self.preflight}): {len(sim_list)} trials to run, {len(dropped)} skipped, "
+              f"about {sum(predictions[idx].runtime_s for idx in sim_list)/3600:.1f} h of sim time")
+        return sim_list
+
+    def run_checkpointed(self, idx, stage=None, *args):
+        '''
+        Runs stage (the whole trial by default), recording a failure of trial idx
+        in the campaign instead of raising. Returns whether the stage succeeded
+        '''
+        try:
+            if stage is None:
+                self.run_trial(idx)
+            else:
+                stage(*args)
+            return True
+        except Exception as e:
+            print(f"Trial #{idx} failed: {e}")
+            # do not leave half started containers behind for the next trial, before reporting
+            # the failure: a worker whose coordinator is unreachable goes on to its next lease
+            self.pool_up = True
+            try:
+                self.shutdown_pool()
+            except Exception as down_error:
+                print(f"Teardown after trial #{idx} failed: {down_error}")
+            self.stop_stats()
+            # what the containers printed is kept, it is what explains the failure
+            self.stop_container_logs()
+            self.results.fail_trial(self.campaign, self.config[idx]["code"], str(e))
+            return False
+
+    def update_counters(self):
+        # the results store is the source of truth, so counters survive crashes and span slots
+        counts = self.results.outcome_counts(self.campaign)
+        for outcome, counter in OUTCOME_COUNTERS.items():
+            setattr(self, counter, counts.get(outcome, 0))
+        self.total = sum(counts.values())
 
     def save_table_file(self):
-        with open(f'{current_path}/log/experiment-{self.current_date}.csv', 'w') as file:
+        self.update_counters()
+        table_path = f'{self.archive_dir}/experiment-{self.current_date}.csv'
+        # slots and lanes finish concurrently, each one writes its own temporary file
+        tmp_path = f'{table_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as file:
             file.write('Type, Quantity\n')
             file.write(f'BT Failure, {self.n_bt_failures}\n')
             file.write(f'Timeout Wall, {self.n_timeout_wall}\n')
             file.write(f'Timeout Sim, {self.n_timeout_sim}\n')
+            file.write(f'Stall Startup, {self.n_stall_startup}\n')
+            file.write(f'Stall Move Base, {self.n_stall_move_base}\n')
+            file.write(f'Stall Sim, {self.n_stall_sim}\n')
+            file.write(f'Stall Robot, {self.n_stall_robot}\n')
             file.write(f'Low Battery, {self.n_low_battery}\n')
             file.write(f'Success, {self.n_successes}\n')
             file.write(f'Total, {self.total}\n')
             file.write(f'\n')
+        os.replace(tmp_path, table_path)
 
     def clear_log_file(self):
-        with open(f'{current_path}/log/trial.log', 'w') as file:
+        with open(f'{self.log_dir}/trial.log', 'w') as file:
             file.write('')
 
     def save_log_file(self, trial_id, trial_code, execution_time):
-        print("Saving log file as: {}/log/{:0>2d}_{}.log".format(current_path,trial_id, trial_code))
-        timeout_to_wait_for_s = 60
-        start = time.time()
-        runtime = time.time()
-        while (runtime - start) <= timeout_to_wait_for_s:
-            time.sleep(1)
-            runtime = time.time()
-        end = time.time()
-        old_path  = f'{current_path}/log/trial.log'
-        new_path = '{}/log/{:0>2d}_{}'.format(current_path,trial_id, trial_code)
-        cp_cmd = 'cp log/trial.log log/{:0>2d}_{}.bkp'.format(trial_id, trial_code)
-        cp_tk = shlex.split(cp_cmd)
-
-        cp_process = subprocess.run(cp_tk,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-        print(cp_process.stdout)
-        print(cp_process.stderr)
-
-        # shutil.copy(old_path, new_path)
-        with open(f'{new_path}.done', 'a') as logfile:
+        print("Saving log file as: {}/{:0>2d}_{}.log".format(self.archive_dir,trial_id, trial_code))
+        self.phase_times['exit'] = self.wait_for(self.containers_exited, self.exit_timeout_s)
+        new_path = '{}/{:0>2d}_{}'.format(self.archive_dir,trial_id, trial_code)
+        outcome = self.endsim if self.endsim else 'timeout-wall'
+        with open(f'{new_path}.log', 'w') as logfile:
             for line in self.lines:
                 logfile.write(line)
+            logfile.write('{:02.2f}, [DEBUG], trial-watcher, phases: {}\n'.format(execution_time,self.format_phase_times()))
             text = '{:02.2f}, [DEBUG], trial-watcher, {}: wall-clock={}\n'.format(execution_time,self.endsim,execution_time)
             logfile.write(text)
-
-        with open(f'{new_path}.bkp', 'a') as logfile:
-            text = '{:02.2f}, [DEBUG], trial-watcher, {}: wall-clock={}\n'.format(execution_time,self.endsim,execution_time)
-            logfile.write(text)
-            if self.endsim == 'reach-target':
-                self.n_successes = self.n_successes + 1
-            elif self.endsim == 'failure-bt':
-                self.n_bt_failures = self.n_bt_failures + 1
-            elif self.endsim == 'low-battery':
-                self.n_low_battery = self.n_low_battery + 1
-            elif self.endsim == 'timeout-sim':
-                self.n_timeout_sim = self.n_timeout_sim + 1
-            else:
-                self.n_timeout_wall = self.n_timeout_wall + 1
-            self.total = self.total + 1
+        if self.telemetry_codec is not None:
+            write_telemetry(f'{new_path}.tlm', self.lines, self.telemetry_codec,
+                            {'campaign': self.campaign, 'trial': trial_id, 'code': trial_code, 'outcome': outcome})
+        self.mark('archived')
+        self.results.record_trial(self.campaign, self.trial, outcome, execution_time,
+                                  self.phase_times, self.lines, f'{new_path}.log', self.marks, self.samples,
+                                  self.container_logs)
+        # the trial is settled once recorded, the metrics and the cache must not fail it
+        try:
+            write_metrics(f'{self.log_dir}/metrics.prom', self.campaign, self.trial, outcome, self.phase_times,
+                          self.marks, summarize_samples(self.samples), self.results.outcome_counts(self.campaign))
+        except Exception as e:
+            print(f"Metrics of trial #{trial_id} not written: {e}")
+        if self.use_cache and outcome in CACHEABLE_OUTCOMES:
+            result = {'code': trial_code, 'outcome': outcome, 'wall_clock': execution_time, 'phases': self.phase_times}
+            try:
+                self.cache.put(self.trial_key, result, f'{new_path}.log')
+            except Exception as e:
+                print(f"Trial #{trial_id} not cached: {e}")
         self.clear_log_file()
         # self.save_bag_file(trial_id)
 
@@ -419,41 +649,39 @@ class Orchestrator(object):
         current_date = datetime.datetime.today().strftime('%H-%M-%S-%d-%b-%Y')
         os.rename(f'{current_path}/log/bag.bag', f'{current_path}/log/exp{self.xp_id}_trial{run}_{current_date}.bag')
 
-    def check_end_simulation(self):
-        with open(f'{current_path}/log/trial.log', 'r') as file:
-            # print("Checking simulation...")
-            self.lines = file.readlines()
-            # print(lines)
-            alllines = ''
-            for line in self.lines:
-                alllines = alllines+line
-                if "ENDSIM" in line:
-                    self.endsim = 'reach-target'
-                if "FAILURE" in line:
-                    self.endsim = 'failure-bt'
-                if "ENDLOWBATT" in line:
-                    self.endsim = 'low-battery'
-                if "ENDTIMEOUTSIM" in line:
-                    self.endsim = 'timeout-sim'
+    def check_end_simulation(self, timeout_s=1):
+        # wakes up as soon as the logger appends to trial.log
+        for event in self.log_follower.wait(timeout_s):
+            self.lines.append(event.line)
+            if event.kind == 'end' and self.endsim == False:
+                self.endsim = event.data
+            if event.kind in TIMED_EVENTS:
+                self.mark(TIMED_EVENTS[event.kind])
+            if self.watchdog is not None:
+                self.watchdog.feed(event)
+        if self.watchdog is not None and self.endsim == False:
+            stall = self.watchdog.check()
+            if stall is not None:
+                print(f"Aborting trial #{self.trial_id}: {stall}, {self.watchdog.reason}")
+                self.endsim = stall
 
     def get_nurse_new_pos(self, nurse_idx):
-        nurse_pos = self.nurses_config[0]["position"]
-        nurse_loc = self.nurses_config[0]["location"]
+        # a new list, the trial config is hashed into the cache key
+        nurse_pos = self.nurses_config[nurse_idx]["position"]
+        nurse_loc = self.nurses_config[nurse_idx]["location"]
         x = 0
         y = 1
-        new_nurse_pos = []
-        new_nurse_pos.append(nurse_pos[x] + self.relocate_nurse[nurse_loc][x])
-        new_nurse_pos.append(nurse_pos[y] + self.relocate_nurse[nurse_loc][y])
+        offset = self.hospital.nurse_offset(nurse_loc)
+        new_nurse_pos = list(nurse_pos)
+        new_nurse_pos[x] = nurse_pos[x] + offset[x]
+        new_nurse_pos[y] = nurse_pos[y] + offset[y]
 
         print(f"Relocating nurse from {nurse_pos} to {new_nurse_pos}")
-        nurse_pos[x] = new_nurse_pos[x]
-        nurse_pos[y] = new_nurse_pos[y]
-        return nurse_pos
+        return new_nurse_pos
 
     def create_env_file(self, n_trial, trial_code):
-        self.env_name = "sim.env"
-        curr_path = os.getcwd()+'/'
-        file_path = curr_path + self.env_name
+        file_path = self.env_path
+        self.rng = random.Random(f'{self.seed}:{trial_code}')
         
         self.chose_robot = ""
         for r_config in self.robots_config:
@@ -463,6 +691,9 @@ class Orchestrator(object):
         with open(file_path, "w") as ef:
             nurse_pos = self.get_nurse_new_pos(0)
             print(str(nurse_pos))
+            # the services get the relocated nurse as well, through a copy of the nurse configs
+            self.nurses_config = copy.deepcopy(self.nurses_config)
+            self.nurses_config[0]["position"] = nurse_pos
             nurse_str = str(nurse_pos).replace(',',';')
             ef.write(f"TRIAL={n_trial}\n\n")
             ef.write(f"TRIAL_CODE={trial_code}\n\n")
@@ -474,7 +705,7 @@ class Orchestrator(object):
                 id_str = (robot["id"])
                 ef.write(f'ROBOT_NAME_{id_str}=turtlebot{id_str}\n')
                 # pose
-                yaw = random.uniform(-math.pi, math.pi)
+                yaw = self.rng.uniform(-math.pi, math.pi)
                 pose_str = str(robot["position"]).replace(',',';')
                 pose_env = (f"ROBOT_POSE_{id_str}={pose_str}")
                 ef.write(pose_env+'\n')
@@ -486,6 +717,83 @@ class Orchestrator(object):
                 batt_slope_env = "BATT_SLOPE_STATE_{}={:02.2f}".format(id_str, batt_slope_str)
                 ef.write(batt_slope_env+'\n')
                 ef.write('\n')
+        if self.reuse_containers:
+            self.create_trial_script()
+
+    def create_trial_script(self):
+        '''
+        Reused containers cannot get new env_file/environment values without being
+        recreated, so the per-trial state goes into a script mounted at /trial
+        and sourced by every service command when its process (re)starts
+        '''
+        os.makedirs(self.trial_dir, exist_ok=True)
+        env = {}
+        with open(self.env_path) as ef:
+            for line in ef:
+                if '=' in line:
+                    key, value = line.rstrip('\n').split('=', 1)
+                    env[key] = value
+        env['ROBOTS_CONFIG'] = json.dumps(self.robots_config)
+        env['NURSES_CONFIG'] = json.dumps(self.nurses_config)
+        for r_config in self.robots_config:
+            env[f'ROBOT_CONFIG_{r_config["id"]}'] = json.dumps(r_config)
+            env[f'SKILLS_{r_config["id"]}'] = str(r_config["skills"])
+        with open(f'{self.trial_dir}/trial_env.sh', 'w') as sf:
+            for key, value in env.items():
+                sf.write(f'export {key}={shlex.quote(value)}\n')
+            # py_trees containers pick their own robot's slice by ROBOT_NAME
+            sf.write('if [ -n "$ROBOT_NAME" ]; then\n')
+            sf.write('    _robot_id=${ROBOT_NAME#turtlebot}\n')
+            sf.write('    _config=ROBOT_CONFIG_$_robot_id; export ROBOT_CONFIG="${!_config}"\n')
+            sf.write('    _skills=SKILLS_$_robot_id; export SKILLS="${!_skills}"\n')
+            sf.write('fi\n')
+
+    def make_services_reusable(self):
+        # strip everything that changes between trials from the compose services
+        per_trial_env = ('ROBOTS_CONFIG=', 'NURSES_CONFIG=', 'ROBOT_CONFIG=', 'SKILLS=')
+        for name, service in self.services.items():
+            if name in self.pool_services:
+                continue
+            service.pop('env_file', None)
+            service['environment'] = [env for env in service['environment'] if not env.startswith(per_trial_env)]
+            service['volumes'].append(f'{self.trial_dir}:/trial:ro')
+            service['command'] = service['command'].replace('/bin/bash -c "', '/bin/bash -c "source /trial/trial_env.sh && ', 1)
+
+    def ensure_pytrees_image(self, build=True):
+        '''
+        Returns whether the py_trees image of the current sources exists, building it unless build is False
+        '''
+        # the tag covers the Dockerfile and everything it copies: the behaviors and the bridge
+        image = 'morse_pytrees_ws:'+build_hash(f'{current_path}/docker/Dockerfile.pytrees', f'{current_path}/docker')[:12]
+        if image == self.pytrees_image:
+            return True
+        with image_lock:
+            try:
+                inspect_process = subprocess.run(['docker', 'image', 'inspect', image],
+                                                 stdout=subprocess.DEVNULL,
+                                                 stderr=subprocess.DEVNULL)
+            except OSError as e:
+                # no docker on this host, which is fine for a coordinator
+                if not build:
+                    return False
+                raise Exception(f'could not inspect {image}: {e}')
+            if inspect_process.returncode != 0:
+                if not build:
+                    return False
+                print(f'Building {image} from docker/Dockerfile.pytrees')
+                build_process = subprocess.run(['docker', 'build', '-f', 'docker/Dockerfile.pytrees', '-t', image, './docker'],
+                                               cwd=current_path,
+                                               stdout=subprocess.PIPE,
+                                               stderr=subprocess.STDOUT,
+                                               universal_newlines=True)
+                if build_process.returncode != 0:
+                    print(build_process.stdout)
+                    raise Exception(f'could not build {image}')
+        self.pytrees_image = image
+        return True
+
+    def trial_services(self):
+        return [name for name in self.services if name not in self.pool_services]
 
     def create_robots(self):
         robots_servs = []
@@ -493,7 +801,9 @@ class Orchestrator(object):
         for r_config in self.robots_config:
             r_id = r_config["id"]
             r_loc = r_config["location"]
-            robot = Robot(r_id, r_loc, r_config["battery_charge"], r_config["skills"], r_config)
+            robot = Robot(r_id, r_loc, r_config["battery_charge"], r_config["skills"], r_config,
+                          env_file=self.env_path, prefix=self.container_prefix, log_dir=self.log_dir,
+                          pytrees_image=self.pytrees_image)
             r_motion_name, r_motion_serv = robot.get_motion_docker()
             r_pytrees_name, r_pytrees_serv = robot.get_pytrees_docker()
             robot_info = {
@@ -509,10 +819,18 @@ class Orchestrator(object):
         for i in range(0, len(self.robots_config)):
             self.services[robots_servs[i]["motion_name"]] = robots_servs[i]["motion_serv"]
             self.services[robots_servs[i]["pytrees_name"]] = robots_servs[i]["pytrees_serv"]
+        if self.reuse_containers:
+            self.make_services_reusable()
         # print(self.services)
 
     def create_dockers(self):
-        display_idx = random.choice([1,2,3])
+        # slots share the host X11 socket dir, so each one needs its own display
+        if self.slot is not None:
+            display_idx = 10+self.slot
+        elif self.reuse_containers:
+            display_idx = 1
+        else:
+            display_idx = self.rng.choice([1,2,3])
         morse_cmd = '/bin/bash -c "source /ros_ws/devel/setup.bash && Xvfb -screen 0 100x100x24 :%d & DISPLAY=:%d morse run morse_hospital_sim"'
         self.morse = {
             'build': {
@@ -520,10 +838,10 @@ class Orchestrator(object):
                 'dockerfile': 'Dockerfile.app',
             },
             'runtime': 'runc',
-            'container_name': 'morse',
+            'container_name': self.container_prefix+'morse',
             'depends_on': ['master'],
             # 'devices': ["/dev/dri", "/dev/snd"],
-            'env_file': [env_path],
+            'env_file': [self.env_path],
             'environment': ["ROS_HOSTNAME=morse", "ROS_MASTER_URI=http://master:11311", "QT_X11_NO_MITSHM=1"],
             'volumes': ['/tmp/.X11-unix:/tmp/.X11-unix:rw', '~/.config/pulse/cookie:/root/.config/pulse/cookie', './docker/hmrs_hostpital_simulation/morse_hospital_sim:/ros_ws/morse_hospital_sim'],
             'expose': ["8081", "3000", "3001"],
@@ -538,15 +856,15 @@ class Orchestrator(object):
                 'context' : './docker',
                 'dockerfile': 'Dockerfile.motion',
             },
-            'container_name': 'master',
-            'env_file': [env_path],
+            'container_name': self.container_prefix+'master',
+            'env_file': [self.env_path],
             'environment': ["ROBOTS_CONFIG="+json.dumps(self.robots_config), "NURSES_CONFIG="+json.dumps(self.nurses_config)],
-            'volumes': ['./log/:/root/.ros/logger_sim/', './docker/motion_ctrl:/ros_ws/src/motion_ctrl/'],
+            'volumes': [f'{self.log_dir}/:/root/.ros/logger_sim/', './docker/motion_ctrl:/ros_ws/src/motion_ctrl/'],
             'command': '/bin/bash -c "source /ros_ws/devel/setup.bash && roslaunch src/motion_ctrl/launch/log.launch"',
             'tty': True,
             'networks': {
                 'morsegatonet': {
-                    'ipv4_address': '10.2.0.5'
+                    'ipv4_address': f'{self.subnet_prefix}.0.5'
                 }
             },
         }
@@ -555,10 +873,10 @@ class Orchestrator(object):
                 'context' : './docker',
                 'dockerfile': 'Dockerfile.pytrees',
             },
-            'container_name': 'ros1_bridge',
+            'container_name': self.container_prefix+'ros1_bridge',
             'runtime': 'runc',
             'depends_on': ['master'],
-            'env_file': [env_path],
+            'env_file': [self.env_path],
             'volumes': ['/tmp/.docker.xauth:/tmp/.docker.xauth:rw', '/tmp/.X11-unix:/tmp/.X11-unix:rw', '/var/run/dbus:/var/run/dbus:ro'],
             'environment': ["ROS_HOSTNAME=ros1_bridge", "ROS_MASTER_URI=http://master:11311"],
             'command': '/bin/bash -c "source /opt/ros/noetic/setup.bash && ros2 run ros1_bridge dynamic_bridge --bridge-all-topics "',
@@ -570,12 +888,15 @@ class Orchestrator(object):
             # },
             'networks': ['morsegatonet']
         }
+        if self.pytrees_image is not None:
+            del self.ros1_bridge['build']
+            self.ros1_bridge['image'] = self.pytrees_image
         self.networks = {
             'morsegatonet': {
                 'driver': 'bridge',
                 'ipam': {
                     'driver': 'default',
-                    'config': [{'subnet': '10.2.0.0/16'}],
+                    'config': [{'subnet': f'{self.subnet_prefix}.0.0/16'}],
                 }
             }
         }
@@ -594,45 +915,390 @@ class Orchestrator(object):
         return self.docker_compose
 
     def start_simulation(self):
-        up_docker_str = 'docker-compose -f experiment_trials.yaml up -d'
         # up_docker_str = 'docker-compose up -d'
         print('Run Simulation')
-        up_docker_tk = shlex.split(up_docker_str)
-        # print(up_docker_tk)
-
-        self.sim_process = subprocess.run(up_docker_tk,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE,
-                                     universal_newlines=True)
-        print(self.sim_process.stdout)
-        print(self.sim_process.stderr)
+        # with an unchanged reused compose file this only starts the stopped containers
+        self.runtime.up(self.services, self.networks, remove_orphans=self.reuse_containers)
 
     def close_simulation(self):
         # stop_docker_str = 'docker-compose down'
-        start = time.time()
-        runtime = time.time()
+        self.phase_times['flush'] = self.wait_for(self.log_is_quiet, self.flush_timeout_s, interval_s=0)
         self.clear_log_file()
-        timeout_to_wait_for_s = 30
-        while (runtime - start) <= timeout_to_wait_for_s:
-            time.sleep(1)
-            runtime = time.time()
-        end = time.time()
-        stop_docker_str = 'docker-compose -f experiment_trials.yaml down'
-        stop_docker_tk = shlex.split(stop_docker_str)
-
         print('Closing Simulation')
-        self.sim_process = subprocess.run(stop_docker_tk,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-        print(self.sim_process.stdout)
-        print(self.sim_process.stderr)
+        start = time.time()
+        if self.reuse_containers:
+            self.runtime.stop(self.trial_services(), timeout_s=2)
+            self.pool_up = True
+        else:
+            self.runtime.down()
+        self.phase_times['down'] = time.time() - start
 
     def save_compose_file(self):
-        self.compose_name = 'experiment_trials.yaml'
         with open(f'{current_path}/{self.compose_name}', 'w') as file:
             documents = yaml.dump(self.get_compose_file(), file)
 
+class ParallelOrchestrator(object):
+    """Feeds trials into N worker slots, each one an isolated Orchestrator"""
+    def __init__(self, config_file="trials.json", exp_id=0, n_slots=2, reuse_containers=False, campaign=None,
+                 runtime='compose', docker_socket=DOCKER_SOCKET, first_slot=0):
+        super(ParallelOrchestrator, self).__init__()
+        # first_slot keeps the slots of several runners on one host apart
+        self.slots = [Orchestrator(config_file, exp_id, slot=k, reuse_containers=reuse_containers, campaign=campaign,
+                                   runtime=runtime, docker_socket=docker_socket)
+                      for k in range(first_slot, first_slot+n_slots)]
+        self.config = self.slots[0].config
+        self.pending = queue.Queue()
+        for slot in self.slots:
+            slot.current_date = self.slots[0].current_date
+            slot.campaign = self.slots[0].campaign
+
+    def slot_worker(self, orchestrator):
+        while True:
+            try:
+                idx = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            orchestrator.run_checkpointed(idx)
+
+    def run_some_simulations(self, sim_list):
+        sim_list = self.slots[0].resume_campaign(sim_list)
+        print(f"RUNNING {len(sim_list)} TRIALS ON {len(self.slots)} SLOTS")
+        for idx in sim_list:
+            self.pending.put(idx)
+        workers = [threading.Thread(target=self.slot_worker, args=(slot,), daemon=True) for slot in self.slots]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for slot in self.slots:
+            slot.shutdown_pool()
+        self.save_table_file()
+
+    def run_all_simulations(self):
+        self.run_some_simulations(range(0, len(self.config)))
+
+    def save_table_file(self):
+        # every slot appends to the same campaign in the results store
+        self.slots[0].save_table_file()
+
+class PipelinedOrchestrator(object):
+    """
+    Runs the trials one at a time, alternating between two isolated lanes so
+    the stages of consecutive trials overlap: while trial N runs on one lane,
+    trial N+1 is prepared (files, image, containers created) on the other;
+    once N ends, N+1 is started first and only then N is flushed, brought
+    down and archived in the background.
+    """
+    def __init__(self, config_file="trials.json", exp_id=0, reuse_containers=False, campaign=None,
+                 runtime='compose', docker_socket=DOCKER_SOCKET):
+        super(PipelinedOrchestrator, self).__init__()
+        self.lanes = [Orchestrator(config_file, exp_id, slot=k, reuse_containers=reuse_containers, campaign=campaign,
+                                   runtime=runtime, docker_socket=docker_socket) for k in range(2)]
+        self.config = self.lanes[0].config
+        for lane in self.lanes:
+            lane.current_date = self.lanes[0].current_date
+            lane.campaign = self.lanes[0].campaign
+        self.executor = ThreadPoolExecutor(max_workers=len(self.lanes))
+
+    def recycle(self, lane, idx, next_idx):
+        # background stage of a lane: archive the trial that just ended, then get the next one ready
+        lane.run_checkpointed(idx, lane.finish_trial)
+        if next_idx is None:
+            return False
+        return lane.run_checkpointed(next_idx, lane.prepare_trial, next_idx, True)
+
+    def run_some_simulations(self, sim_list):
+        sim_list = self.lanes[0].resume_campaign(sim_list)
+        print(f"RUNNING {len(sim_list)} TRIALS PIPELINED ON {len(self.lanes)} LANES")
+        if not sim_list:
+            return
+        ready = {0: self.executor.submit(self.lanes[0].run_checkpointed, sim_list[0],
+                                         self.lanes[0].prepare_trial, sim_list[0], True)}
+        previous = None
+        for n, idx in enumerate(sim_list):
+            k = n % len(self.lanes)
+            lane = self.lanes[k]
+            next_idx = sim_list[n+1] if n+1 < len(sim_list) else None
+            # blocks only until this lane is prepared, never on a fixed sleep
+            launched = ready.pop(k).result() and lane.run_checkpointed(idx, lane.launch_trial, idx)
+            other = (k+1) % len(self.lanes)
+            if previous is not None:
+                ready[other] = self.executor.submit(self.recycle, self.lanes[other], previous, next_idx)
+            elif next_idx is not None:
+                ready[other] = self.executor.submit(self.lanes[other].run_checkpointed, next_idx,
+                                                    self.lanes[other].prepare_trial, next_idx, True)
+            previous = None
+            if launched and lane.run_checkpointed(idx, lane.watch_trial):
+                previous = idx
+        if previous is not None:
+            lane.run_checkpointed(previous, lane.finish_trial)
+        for future in ready.values():
+            future.result()
+        self.executor.shutdown()
+        for lane in self.lanes:
+            lane.shutdown_pool()
+        self.save_table_file()
+
+    def run_all_simulations(self):
+        self.run_some_simulations(range(0, len(self.config)))
+
+    def save_table_file(self):
+        self.lanes[0].save_table_file()
+
+class PackedTrial(object):
+    """State of one trial inside a packed MORSE world"""
+    def __init__(self, position, idx, trial, packed, env_path, log_dir):
+        super(PackedTrial, self).__init__()
+        self.position = position
+        self.idx = idx
+        self.trial = trial
+        self.packed = packed
+        self.env_path = env_path
+        self.log_dir = log_dir
+        # turtlebot<packed id> -> turtlebot<trial id>, to archive the log with the original names
+        self.names = {f'turtlebot{p["id"]}': f'turtlebot{r["id"]}' for p, r in zip(packed["robots"], trial["robots"])}
+        self.chose_robot = ''
+        self.log_follower = None
+        self.watchdog = None
+        self.lines = []
+        self.marks = {}
+        self.endsim = False
+        self.run_end = None
+
+
+class PackedOrchestrator(Orchestrator):
+    """
+    Runs pack_size independent trials at once in one MORSE world. Trial j is
+    moved to the j-th copy of the hospital, offset_m metres along x: its robot
+    ids are remapped after the ones of the previous trials and its poses and
+    plan waypoints shifted. Every trial keeps its own ROBOTS_CONFIG/NURSES_CONFIG
+    slice, env file, logger (in the ROS namespace trial<j>) and trial log.
+    The world gets PACK_SIZE/PACK_OFFSET_X, which the scene in
+    hmrs_hostpital_simulation has to honour by instancing the hospital copies,
+    as the loggers have to by logging only the robots of their namespace.
+    Until the submodules do (see missing_pack_support) it refuses to run: the
+    trials would share one hospital and every logger would record all robots.
+    """
+    def __init__(self, config_file="trials.json", exp_id=0, pack_size=3, offset_m=100.0, campaign=None,
+                 runtime='compose', docker_socket=DOCKER_SOCKET):
+        missing = missing_pack_support(current_path)
+        if missing:
+            raise Exception('packing trials needs support in the submodules: '+', '.join(missing))
+        super(PackedOrchestrator, self).__init__(config_file, exp_id, campaign=campaign,
+                                                 runtime=runtime, docker_socket=docker_socket)
+        self.pack_size = pack_size
+        self.offset_m = offset_m
+        self.world_env_path = f'{current_path}/sim_pack.env'
+        self.pack = []
+
+    def pack_trial(self, position, trial, id_offset):
+        packed = copy.deepcopy(trial)
+        dx = position*self.offset_m
+        for robot in packed["robots"]:
+            robot["id"] += id_offset
+            robot["name"] = f'r{robot["id"]}'
+            robot["position"][0] += dx
+            for step in robot["local_plan"] or []:
+                if step[0] == 'navigation':
+                    for waypoint in step[1][1]:
+                        waypoint[0] += dx
+        for nurse in packed["nurses"]:
+            nurse["position"][0] += dx
+        return packed
+
+    def create_pack(self, sim_list):
+        self.pack = []
+        id_offset = 0
+        for position, idx in enumerate(sim_list):
+            trial = self.config[idx]
+            packed = self.pack_trial(position, trial, id_offset)
+            id_offset += len(trial["robots"])
+            entry = PackedTrial(position, idx, trial, packed,
+                                f'{current_path}/sim_pack{position}.env', f'{self.archive_dir}/pack{position}')
+            os.makedirs(entry.log_dir, exist_ok=True)
+            self.env_path = entry.env_path
+            self.robots_config = packed["robots"]
+            self.nurses_config = packed["nurses"]
+            self.create_env_file(trial["id"], trial["code"])
+            packed["nurses"] = self.nurses_config
+            entry.chose_robot = self.chose_robot
+            self.pack.append(entry)
+        self.create_world_env_file()
+        self.env_path = self.world_env_path
+        self.robots_config = [robot for entry in self.pack for robot in entry.packed["robots"]]
+        self.nurses_config = [nurse for entry in self.pack for nurse in entry.packed["nurses"]]
+        self.create_dockers()
+        # the world master is a bare roscore, the per trial loggers write the trial logs
+        self.master['command'] = '/bin/bash -c "source /ros_ws/devel/setup.bash && roscore"'
+        self.master['volumes'] = self.master['volumes'][1:]
+        for entry in self.pack:
+            self.create_pack_services(entry)
+
+    def create_world_env_file(self):
+        # robot entries of every trial (ids are unique after packing) plus the world layout
+        with open(self.world_env_path, 'w') as ef:
+            ef.write(f'PACK_SIZE={len(self.pack)}\n\n')
+            ef.write(f'PACK_OFFSET_X={self.offset_m}\n\n')
+            ef.write(f'N_ROBOTS={sum(len(entry.packed["robots"]) for entry in self.pack)}\n\n')
+            for entry in self.pack:
+                with open(entry.env_path) as trial_env:
+                    for line in trial_env:
+                        if line.startswith(('ROBOT_', 'BATT_')) or line == '\n':
+                            ef.write(line)
+                        elif line.startswith(('TRIAL=', 'TRIAL_CODE=', 'NURSE_POSE=', 'CHOSE_ROBOT=')):
+                            key, value = line.split('=', 1)
+                            ef.write(f'{key}_{entry.position}={value}')
+
+    def create_pack_services(self, entry):
+        namespace = f'trial{entry.position}'
+        logger = copy.deepcopy(self.master)
+        logger['container_name'] = self.container_prefix+f'logger{entry.position}'
+        logger['env_file'] = [entry.env_path]
+        logger['environment'] = ["ROBOTS_CONFIG="+json.dumps(entry.packed["robots"]),
+                                 "NURSES_CONFIG="+json.dumps(entry.packed["nurses"]),
+                                 "ROS_MASTER_URI=http://master:11311", f"ROS_NAMESPACE={namespace}"]
+        logger['volumes'] = [f'{entry.log_dir}/:/root/.ros/logger_sim/', './docker/motion_ctrl:/ros_ws/src/motion_ctrl/']
+        logger['command'] = '/bin/bash -c "source /ros_ws/devel/setup.bash && roslaunch src/motion_ctrl/launch/log.launch"'
+        logger['depends_on'] = ['master']
+        logger['networks'] = ['morsegatonet']
+        self.services[f'logger{entry.position}'] = logger
+        for r_config in entry.packed["robots"]:
+            robot = Robot(r_config["id"], r_config["location"], r_config["battery_charge"], r_config["skills"], r_config,
+                          env_file=entry.env_path, prefix=self.container_prefix, log_dir=entry.log_dir,
+                          pytrees_image=self.pytrees_image)
+            for name, service in (robot.get_motion_docker(), robot.get_pytrees_docker()):
+                service['environment'].append(f"TRIAL_NAMESPACE=/{namespace}")
+                self.services[name] = service
+
+    def run_some_simulations(self, sim_list):
+        sim_list = self.resume_campaign(sim_list)
+        print(f"RUNNING {len(sim_list)} TRIALS PACKED {self.pack_size} PER WORLD")
+        for start in range(0, len(sim_list), self.pack_size):
+            pack = sim_list[start:start+self.pack_size]
+            try:
+                self.run_pack(pack)
+            except Exception as e:
+                print(f"Pack {pack} failed: {e}")
+                # the trials of the pack recorded before the failure stay done
+                for idx in pack:
+                    self.results.fail_trial(self.campaign, self.config[idx]["code"], str(e))
+                self.pool_up = True
+                try:
+                    self.shutdown_pool()
+                except Exception as down_error:
+                    print(f"Teardown of pack {pack} failed: {down_error}")
+        self.save_table_file()
+
+    def run_pack(self, sim_list):
+        for idx in sim_list:
+            self.results.set_trial_state(self.campaign, self.config[idx]["code"], RUNNING)
+        if self.use_image_cache:
+            self.ensure_pytrees_image()
+        keys = {idx: self.cache_key(self.config[idx]) for idx in sim_list} if self.use_cache else {}
+        self.phase_times = {}
+        self.trial_start = time.time()
+        self.marks = {}
+        self.create_pack(sim_list)
+        self.mark('env')
+        self.save_compose_file()
+        self.mark('compose')
+        print(f"STARTING PACKED SIMULATION {sim_list}...")
+        phase_start = time.time()
+        self.start_simulation()
+        self.phase_times['up'] = time.time() - phase_start
+        self.mark('up')
+        # the containers of the world are shared, every trial of the pack gets all the samples
+        self.start_stats()
+        self.start_container_logs('pack_'+'_'.join(entry.trial["code"] for entry in self.pack))
+        self.run_start = time.time()
+        for entry in self.pack:
+            with open(f'{entry.log_dir}/trial.log', 'w') as file:
+                file.write('')
+            entry.log_follower = LogFollower(f'{entry.log_dir}/trial.log')
+            if self.use_watchdog:
+                robots = [f'turtlebot{r_config["id"]}' for r_config in entry.packed["robots"]]
+                entry.watchdog = TrialWatchdog(robots, entry.chose_robot, start=self.run_start, **self.watchdog_thresholds)
+        # each trial is watched through its own log until all of them ended
+        running = list(self.pack)
+        while running and (time.time() - self.run_start) <= self.simulation_timeout_s:
+            for entry in running:
+                self.watch_packed(entry, timeout_s=1.0/len(running))
+            running = [entry for entry in running if entry.endsim == False]
+        self.run_end = time.time()
+        self.phase_times['run'] = self.run_end - self.run_start
+        for entry in self.pack:
+            self.use_entry(entry)
+            self.phase_times['flush'] = self.wait_for(self.log_is_quiet, self.flush_timeout_s, interval_s=0)
+            entry.lines = self.lines
+        self.stop_stats()
+        print('Closing Simulation')
+        phase_start = time.time()
+        self.runtime.down()
+        self.phase_times['down'] = time.time() - phase_start
+        self.stop_container_logs()
+        self.mark('teardown')
+        pack_marks = self.marks
+        for entry in self.pack:
+            self.use_entry(entry)
+            self.marks = dict(pack_marks, **entry.marks)
+            entry.log_follower.close()
+            run_end = entry.run_end if entry.run_end is not None else self.run_end
+            self.trial_key = keys.get(entry.idx)
+            self.lines = [self.rename_robots(line, entry.names) for line in entry.lines]
+            print(f"Runtime of the simulation #{self.trial_id} is {run_end - self.run_start}")
+            self.save_log_file(self.trial_id, self.trial_code, run_end - self.run_start)
+        self.save_table_file()
+        print(f"Phase timings of the pack {sim_list}: {self.format_phase_times()}")
+
+    def use_entry(self, entry):
+        # point the single trial helpers (log_is_quiet, save_log_file, ...) at one packed trial
+        self.trial = entry.trial
+        self.trial_id = entry.trial["id"]
+        self.trial_code = entry.trial["code"]
+        self.log_dir = entry.log_dir
+        self.log_follower = entry.log_follower
+        self.lines = entry.lines
+        self.endsim = entry.endsim
+
+    def watch_packed(self, entry, timeout_s):
+        for event in entry.log_follower.wait(timeout_s):
+            entry.lines.append(event.line)
+            if event.kind == 'end' and entry.endsim == False:
+                entry.endsim = event.data
+            if event.kind in TIMED_EVENTS and TIMED_EVENTS[event.kind] not in entry.marks:
+                entry.marks[TIMED_EVENTS[event.kind]] = time.time() - self.trial_start
+            if entry.watchdog is not None:
+                entry.watchdog.feed(event)
+        if entry.watchdog is not None and entry.endsim == False:
+            stall = entry.watchdog.check()
+            if stall is not None:
+                print(f"Aborting trial #{entry.trial['id']} ({entry.trial['code']}): {stall}, {entry.watchdog.reason}")
+                entry.endsim = stall
+        if entry.endsim != False and entry.run_end is None:
+            entry.run_end = time.time()
+
+    def rename_robots(self, line, names):
+        for packed_name, name in names.items():
+            line = line.replace(packed_name+',', name+',').replace(packed_name+'"', name+'"')
+        return line
+
+def missing_pack_support(base_path):
+    '''
+    Returns what keeps the submodules from running packed trials, empty when
+    they read every variable PackedOrchestrator passes them
+    '''
+    missing = []
+    for path, names in PACK_REQUIREMENTS:
+        sources = []
+        for root, _, files in os.walk(os.path.join(base_path, path)):
+            for name in files:
+                if name.endswith(('.py', '.launch', '.xml', '.yaml', '.sh')):
+                    with open(os.path.join(root, name), errors='replace') as f:
+                        sources.append(f.read())
+        sources = ''.join(sources)
+        missing += [f'{path} does not read {name}' for name in names if name not in sources]
+    return missing
+
 def choose_poses(n_robots):
     poses = []
     for n in range(0, n_robots):
@@ -648,15 +1314,111 @@ def choose_poses(n_robots):
     return poses
 
 env_path = None
+current_path = os.getcwd()
+# log events whose first occurrence is marked, see Orchestrator.mark
+TIMED_EVENTS = {'move-base-info': 'first-move-base-info', 'pose': 'first-pose', 'end': 'end-marker'}
+# what the submodules have to read for --pack: the scene instances the hospital copies,
+# the robot nodes and the loggers keep to the namespace of their trial
+PACK_REQUIREMENTS = (
+    ('docker/hmrs_hostpital_simulation/morse_hospital_sim', ('PACK_SIZE', 'PACK_OFFSET_X')),
+    ('docker/motion_ctrl', ('TRIAL_NAMESPACE',)),
+)
+# parallel slots must not build the same image twice
+image_lock = threading.Lock()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the MORSE hospital trials')
+    parser.add_argument('--trials', default='trials.json', help='trial definitions file')
+    parser.add_argument('--slots', type=int, default=1, help='number of trials executed concurrently')
+    parser.add_argument('--reuse-containers', action='store_true',
+                        help='keep the containers between trials instead of recreating them; MORSE and the ROS master '
+                             'still restart every trial, this is not a warm simulator pool')
+    parser.add_argument('--no-image-cache', action='store_true', help='run colcon build inside every py_trees container')
+    parser.add_argument('--campaign', help='campaign name, an existing campaign is resumed')
+    parser.add_argument('--preflight', choices=['order', 'skip', 'flag'],
+                        help='predict the trial outcomes first and run the shortest first, skip the infeasible ones or only flag them')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the per trial random choices, part of the cache key')
+    parser.add_argument('--no-cache', action='store_true', help='neither serve nor store trials in log/cache')
+    parser.add_argument('--force', action='store_true', help='run the trials again even when they are cached')
+    parser.add_argument('--invalidate', action='store_true', help='drop the cached results of the trials before running')
+    parser.add_argument('--cache-size', type=int, default=1000, help='cached trials kept, least recently used are evicted')
+    parser.add_argument('--no-watchdog', action='store_true',
+                        help='only abort trials on the wall clock budget, not when they stall')
+    parser.add_argument('--pack', type=int, default=1, help='trials run together in one MORSE world')
+    parser.add_argument('--pack-offset', type=float, default=100.0, help='x offset in metres between the hospital copies of a pack')
+    parser.add_argument('--stats-period', type=float, default=10, help='seconds between container stats samples, 0 disables them')
+    parser.add_argument('--telemetry', choices=['zstd', 'zlib', 'none'],
+                        help='also archive the pose/battery samples as binary telemetry with this compression')
+    parser.add_argument('--container-log-mb', type=float, default=16,
+                        help='MB of output of a container per gzip part in log/containers, 0 disables the capture')
+    parser.add_argument('--container-log-parts', type=int, default=4,
+                        help='parts kept per container, the first one and the last ones')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='prepare the next trial and tear down the previous one while a trial runs')
+    parser.add_argument('--runtime', choices=['compose', 'engine'], default='compose',
+                        help='start containers with docker-compose or through the Docker Engine API')
+    parser.add_argument('--docker-socket', default=DOCKER_SOCKET, help='Docker Engine API socket for --runtime engine')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help='serve the campaign trials to workers instead of running them')
+    parser.add_argument('--lease', type=float, default=120, help='seconds a worker keeps a trial without a heartbeat')
+    parser.add_argument('--worker', metavar='URL', help='run trials leased by the coordinator at URL, one per slot')
+    parser.add_argument('--first-slot', type=int, default=0, help='first slot number of a worker, to run several on one host')
+    args = parser.parse_args()
+
     current_path = os.getcwd()
     print(f'current running path = {current_path}')
     env_path = current_path+'/sim.env'
     print(f'env file will be written in = {env_path}')
 
-    trials_runner = Orchestrator("trials.json", 9)
-    trials_runner.prepare_environment()
-    # trials_runner.run_simulation()
-    # trials_runner.run_some_simulations([9, 17, 34, 63, 73, 75])
-    trials_runner.run_all_simulations()
+    if args.worker is not None:
+        runner = ParallelOrchestrator(args.trials, 9, args.slots, reuse_containers=args.reuse_containers, campaign=args.campaign,
+                                      runtime=args.runtime, docker_socket=args.docker_socket, first_slot=args.first_slot)
+        orchestrators = runner.slots
+    elif args.slots > 1:
+        runner = ParallelOrchestrator(args.trials, 9, args.slots, reuse_containers=args.reuse_containers, campaign=args.campaign,
+                                      runtime=args.runtime, docker_socket=args.docker_socket)
+        orchestrators = runner.slots
+    elif args.pack > 1:
+        runner = PackedOrchestrator(args.trials, 9, args.pack, args.pack_offset, campaign=args.campaign,
+                                    runtime=args.runtime, docker_socket=args.docker_socket)
+        orchestrators = [runner]
+    elif args.pipeline:
+        runner = PipelinedOrchestrator(args.trials, 9, reuse_containers=args.reuse_containers, campaign=args.campaign,
+                                       runtime=args.runtime, docker_socket=args.docker_socket)
+        orchestrators = runner.lanes
+    else:
+        runner = Orchestrator(args.trials, 9, reuse_containers=args.reuse_containers, campaign=args.campaign,
+                              runtime=args.runtime, docker_socket=args.docker_socket)
+        orchestrators = [runner]
+    for orchestrator in orchestrators:
+        orchestrator.use_image_cache = not args.no_image_cache
+        orchestrator.use_watchdog = not args.no_watchdog
+        orchestrator.stats_period_s = args.stats_period
+        orchestrator.telemetry_codec = args.telemetry
+        orchestrator.container_log_bytes = int(args.container_log_mb*1024**2)
+        orchestrator.container_log_parts = args.container_log_parts
+        orchestrator.preflight = args.preflight
+        orchestrator.seed = args.seed
+        orchestrator.use_cache = not args.no_cache
+        orchestrator.force = args.force
+        orchestrator.cache.max_entries = args.cache_size
+    if args.invalidate:
+        dropped = orchestrators[0].cache.invalidate(set(trial["code"] for trial in runner.config))
+        print(f'dropped {dropped} cached trials')
+    if args.coordinator is not None:
+        host, _, port = args.coordinator.rpartition(':')
+        # the workers build their images and run the slots, the coordinator only needs the store
+        store = orchestrators[0]
+        todo = store.resume_campaign(range(0, len(store.config)), build_images=False)
+        coordinator = Coordinator(store.config, todo, store.results, store.campaign, store.archive_dir,
+                                  lease_s=args.lease, max_attempts=store.max_attempts)
+        coordinator.serve(host or '0.0.0.0', int(port))
+        store.save_table_file()
+    elif args.worker is not None:
+        run_workers(args.worker, orchestrators)
+    else:
+        if isinstance(runner, Orchestrator):
+            runner.prepare_environment()
+        # trials_runner.run_simulation()
+        # trials_runner.run_some_simulations([9, 17, 34, 63, 73, 75])
+        runner.run_all_simulations()
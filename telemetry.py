@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import math
+import mmap
+import zlib
+import struct
+import argparse
+
+from trial_log import TrialColumns, EVENT_KINDS, parse_line, robot_number
+
+# zstd is optional: the standard library has it from python 3.14, older ones need zstandard
+try:
+    from compression import zstd as zstd_module
+except ImportError:
+    zstd_module = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'MSTL'
+VERSION = 1
+CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+# magic, version, codec, record size, then a length prefixed JSON metadata blob
+HEADER = struct.Struct('<4sHBxHI')
+# records, payload bytes, sim time of the first and last record
+CHUNK = struct.Struct('<IIdd')
+# sim time, robot number, x, y, yaw, battery level (%); fields a sample does not have are NaN
+RECORD = struct.Struct('<dh2xffff')
+SUFFIX = '.tlm'
+
+
+def zstd_available():
+    return zstd_module is not None or zstandard is not None
+
+
+def compress(codec, data):
+    if codec == 'zlib':
+        return zlib.compress(data, 6)
+    if codec == 'zstd':
+        if zstd_module is not None:
+            return zstd_module.compress(data, 3)
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def decompress(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstd_module is not None:
+            return zstd_module.decompress(data)
+        if zstandard is None:
+            raise Exception('reading zstd telemetry needs python >= 3.14 or the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class TelemetryWriter(object):
+    """
+    Appends fixed width pose/battery records to a telemetry file, compressed
+    in chunks of chunk_records. zstd falls back to zlib when it is not available
+    """
+    def __init__(self, path, codec='zstd', meta=None, chunk_records=4096):
+        super(TelemetryWriter, self).__init__()
+        if codec == 'zstd' and not zstd_available():
+            codec = 'zlib'
+        self.path = path
+        self.codec = codec
+        self.chunk_records = chunk_records
+        self.buffer = bytearray()
+        self.n_buffered = 0
+        self.t_first = None
+        self.t_last = None
+        self.n_records = 0
+        meta_bytes = json.dumps(meta or {}).encode()
+        # written next to the final file and renamed on close, readers never see a partial file
+        self.file = open(path+'.tmp', 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, CODECS[codec], RECORD.size, len(meta_bytes)))
+        self.file.write(meta_bytes)
+
+    def append(self, sim_time, robot, x=math.nan, y=math.nan, yaw=math.nan, battery=math.nan):
+        self.buffer += RECORD.pack(sim_time, robot, x, y, yaw, battery)
+        if self.n_buffered == 0:
+            self.t_first = sim_time
+        self.t_last = sim_time
+        self.n_buffered += 1
+        self.n_records += 1
+        if self.n_buffered >= self.chunk_records:
+            self.flush()
+
+    def append_event(self, event):
+        # only the samples of a robot are telemetry, everything else stays in the text log
+        robot = robot_number(event.source)
+        if robot < 0 or event.sim_time is None:
+            return
+        if event.kind == 'pose':
+            x, y, yaw = event.data
+            self.append(event.sim_time, robot, x, y, yaw)
+        elif event.kind == 'battery':
+            self.append(event.sim_time, robot, battery=event.data)
+
+    def flush(self):
+        if not self.n_buffered:
+            return
+        payload = compress(self.codec, bytes(self.buffer))
+        self.file.write(CHUNK.pack(self.n_buffered, len(payload), self.t_first, self.t_last))
+        self.file.write(payload)
+        self.buffer = bytearray()
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        os.replace(self.path+'.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path+'.tmp')
+
+
+class TelemetryReader(object):
+    """
+    Memory maps a telemetry file. Only the chunk headers are read when it is
+    opened; chunks are decompressed when read, and those outside the sim time
+    range of a query are skipped
+    """
+    def __init__(self, path):
+        super(TelemetryReader, self).__init__()
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, codec, record_size, meta_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise Exception(f'{path} is not a version {VERSION} telemetry file')
+        self.codec = {value: name for name, value in CODECS.items()}[codec]
+        self.meta = json.loads(self.map[HEADER.size:HEADER.size+meta_size])
+        # (offset of the payload, records, payload bytes, first sim time, last sim time)
+        self.chunks = []
+        offset = HEADER.size + meta_size
+        while offset < len(self.map):
+            n_records, size, t_first, t_last = CHUNK.unpack_from(self.map, offset)
+            offset += CHUNK.size
+            self.chunks.append((offset, n_records, size, t_first, t_last))
+            offset += size
+
+    def __len__(self):
+        return sum(chunk[1] for chunk in self.chunks)
+
+    def records(self, t_from=-math.inf, t_to=math.inf, robot=None):
+        '''
+        Yields (sim_time, robot, x, y, yaw, battery) tuples, in file order
+        '''
+        for offset, n_records, size, t_first, t_last in self.chunks:
+            if t_last < t_from or t_first > t_to:
+                continue
+            # slicing the map copies one chunk, never the whole file
+            data = decompress(self.codec, self.map[offset:offset+size])
+            for record in RECORD.iter_unpack(data):
+                if t_from <= record[0] <= t_to and (robot is None or record[1] == robot):
+                    yield record
+
+    def columns(self, name=None):
+        '''
+        Returns the records as a trial_log.TrialColumns, the outcome taken from the metadata
+        '''
+        columns = TrialColumns(name or os.path.basename(self.path))
+        pose, battery_kind = EVENT_KINDS.index('pose'), EVENT_KINDS.index('battery')
+        for sim_time, robot, x, y, yaw, battery in self.records():
+            columns.sim_time.append(sim_time)
+            columns.robot.append(robot)
+            columns.kind.append(pose if not math.isnan(x) else battery_kind)
+            columns.x.append(x)
+            columns.y.append(y)
+            columns.yaw.append(yaw)
+            columns.battery.append(battery)
+        columns.outcome = self.meta.get('outcome')
+        return columns
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_telemetry(path, lines, codec='zstd', meta=None):
+    '''
+    Writes the pose/battery samples of trial log lines to path, returns the number of records
+    '''
+    with TelemetryWriter(path, codec, meta) as writer:
+        for line in lines:
+            writer.append_event(parse_line(line))
+    return writer.n_records
+
+
+def convert_log(log_path, out_path=None, codec='zstd'):
+    '''
+    Converts an archived text trial log (e.g. log/01_aaaaab.log) into a telemetry
+    file next to it; the outcome is kept in the metadata
+    '''
+    out_path = out_path if out_path is not None else os.path.splitext(log_path)[0]+SUFFIX
+    with open(log_path, 'r', errors='replace') as file:
+        lines = file.readlines()
+    columns = TrialColumns(os.path.basename(log_path))
+    for line in lines:
+        event = parse_line(line)
+        if event.kind == 'end' or event.source == 'trial-watcher':
+            columns.append(event)
+    meta = {'source': os.path.basename(log_path), 'outcome': columns.outcome}
+    return out_path, write_telemetry(out_path, lines, codec, meta)
+
+
+def load_telemetry(path):
+    with TelemetryReader(path) as reader:
+        return reader.columns()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert trial logs to binary telemetry and read it back')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='convert text trial logs')
+    convert.add_argument('logs', nargs='+')
+    convert.add_argument('--codec', choices=sorted(CODECS), default='zstd')
+    dump = subparsers.add_parser('dump', help='print the records of a telemetry file as CSV')
+    dump.add_argument('path')
+    dump.add_argument('--robot', type=int, default=None)
+    dump.add_argument('--from', dest='t_from', type=float, default=-math.inf, help='first sim time')
+    dump.add_argument('--to', dest='t_to', type=float, default=math.inf, help='last sim time')
+    args = parser.parse_args()
+    if args.command == 'convert':
+        for log_path in args.logs:
+            out_path, n_records = convert_log(log_path, codec=args.codec)
+            print(f'{log_path}: {n_records} records, {os.path.getsize(log_path)} -> {os.path.getsize(out_path)} bytes')
+        return
+    with TelemetryReader(args.path) as reader:
+        print(f'# {reader.meta} codec={reader.codec} records={len(reader)} chunks={len(reader.chunks)}', file=sys.stderr)
+        print('sim_time,robot,x,y,yaw,battery')
+        for record in reader.records(args.t_from, args.t_to, args.robot):
+            print('%.2f,turtlebot%d,%.3f,%.3f,%.3f,%.2f'%record)
+
+if __name__ == '__main__':
+    main()
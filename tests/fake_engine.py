@@ -0,0 +1,264 @@
+import sys
+import json
+import time
+import socket
+import struct
+import threading
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeContainer(object):
+    """A container of the fake engine: its create body, state and the output it printed"""
+    def __init__(self, container_id, name, config):
+        super(FakeContainer, self).__init__()
+        self.id = container_id
+        self.name = name
+        self.config = config
+        self.running = False
+        self.output = []
+        self.changed = threading.Condition()
+
+    def summary(self):
+        return {'Id': self.id, 'Names': ['/'+self.name], 'Labels': self.config.get('Labels', {}),
+                'State': 'running' if self.running else 'exited'}
+
+
+class FakeEngine(ThreadingHTTPServer):
+    """
+    Just enough of the Docker Engine API on a unix socket for DockerEngineRuntime:
+    images (always present), networks, containers (create, start, stop, remove,
+    list with label/status filters, inspect), one shot stats and followed logs.
+    A started container prints '<name> started'; requests are kept in calls.
+    The (method, path) calls in lost_replies are carried out but their reply is
+    lost; close_idle_connections closes the keep-alive connections as an engine
+    timing them out would, a request that still arrives on one is lost as well
+    """
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+    # a connect to a unix socket with a full backlog fails at once instead of waiting, and
+    # several runtimes open a connection per thread; dockerd listens with the system maximum
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, socket_path):
+        self.containers = {}
+        self.networks = {}
+        self.calls = []
+        self.lost_replies = []
+        self.connections = set()
+        self.started = []
+        self.lock = threading.RLock()
+        self.next_id = 0
+        super(FakeEngine, self).__init__(socket_path, FakeEngineHandler)
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ('fake-engine', 0)
+
+    def new_id(self):
+        self.next_id += 1
+        return f'{self.next_id:064x}'
+
+    def find(self, name_or_id):
+        for container in self.containers.values():
+            if name_or_id in (container.id, container.name):
+                return container
+        return None
+
+    def handle_error(self, request, client_address):
+        # a client closing a followed log stream early is not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(FakeEngine, self).handle_error(request, client_address)
+
+    def close_idle_connections(self):
+        with self.lock:
+            for handler in self.connections:
+                handler.closed_by_engine = True
+                handler.connection.shutdown(socket.SHUT_WR)
+
+    def serve_in_background(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        # wake up the followed log streams
+        for container in list(self.containers.values()):
+            with container.changed:
+                container.running = False
+                container.changed.notify_all()
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(FakeEngineHandler, self).setup()
+        self.closed_by_engine = False
+        with self.server.lock:
+            self.server.connections.add(self)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self)
+        super(FakeEngineHandler, self).finish()
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        engine = self.server
+        with engine.lock:
+            lost = self.call in engine.lost_replies
+            if lost:
+                engine.lost_replies.remove(self.call)
+        if lost or self.closed_by_engine:
+            self.close_connection = True
+            return
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        engine = self.server
+        self.call = (method, '/'+'/'.join(parts[1:]))
+        with engine.lock:
+            engine.calls.append(self.call)
+        return parts[1:], query, body
+
+    def do_GET(self):
+        parts, query, _ = self.route('GET')
+        engine = self.server
+        if parts[0] == 'images':
+            return self.reply(200, {'Id': 'sha256:fake'})
+        if parts == ['networks']:
+            return self.reply(200, [{'Id': network['Id'], 'Name': name} for name, network in engine.networks.items()])
+        if parts[0] == 'networks':
+            network = engine.networks.get(parts[1])
+            return self.reply(200, network) if network else self.reply(404, {'message': 'no such network'})
+        if parts == ['containers', 'json']:
+            return self.reply(200, self.list_containers(query))
+        container = engine.find(parts[1]) if parts[0] == 'containers' else None
+        if container is None:
+            return self.reply(404, {'message': 'no such container'})
+        if parts[2] == 'json':
+            return self.reply(200, {'Id': container.id, 'Name': '/'+container.name, 'Config': container.config,
+                                    'State': {'Running': container.running}})
+        if parts[2] == 'stats':
+            return self.reply(200, {
+                'cpu_stats': {'cpu_usage': {'total_usage': 300}, 'system_cpu_usage': 2000, 'online_cpus': 2},
+                'precpu_stats': {'cpu_usage': {'total_usage': 100}, 'system_cpu_usage': 1000},
+                'memory_stats': {'usage': 1024**2},
+                'blkio_stats': {'io_service_bytes_recursive': [{'op': 'Read', 'value': 10}, {'op': 'Write', 'value': 20}]},
+                'networks': {'eth0': {'rx_bytes': 30, 'tx_bytes': 40}},
+            })
+        if parts[2] == 'logs':
+            return self.follow_logs(container, query)
+        self.reply(404, {'message': f'unknown path {self.path}'})
+
+    def list_containers(self, query):
+        filters = json.loads(query.get('filters', '{}'))
+        containers = []
+        for container in self.server.containers.values():
+            labels = container.config.get('Labels', {})
+            wanted = [label.partition('=') for label in filters.get('label', [])]
+            if any(labels.get(key) != value for key, _, value in wanted):
+                continue
+            if 'running' in filters.get('status', []) and not container.running:
+                continue
+            if not container.running and query.get('all') != 'true':
+                continue
+            containers.append(container.summary())
+        return containers
+
+    def follow_logs(self, container, query):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        tty = container.config.get('Tty', False)
+        sent = 0
+        while True:
+            with container.changed:
+                if sent == len(container.output) and container.running and query.get('follow') == 'true':
+                    container.changed.wait(1)
+                lines = container.output[sent:]
+                running = container.running
+            for line in lines:
+                payload = line if tty else struct.pack('>BxxxI', 1, len(line)) + line
+                self.wfile.write(b'%x\r\n' % len(payload) + payload + b'\r\n')
+            sent += len(lines)
+            if not running or query.get('follow') != 'true':
+                break
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        parts, query, body = self.route('POST')
+        engine = self.server
+        if parts == ['networks', 'create']:
+            with engine.lock:
+                engine.networks[body['Name']] = dict(body, Id=engine.new_id())
+            return self.reply(201, {'Id': engine.networks[body['Name']]['Id']})
+        if parts == ['images', 'create']:
+            return self.reply(200)
+        if parts == ['containers', 'create']:
+            with engine.lock:
+                if engine.find(query['name']) is not None:
+                    return self.reply(409, {'message': 'name in use'})
+                container = FakeContainer(engine.new_id(), query['name'], body)
+                engine.containers[container.id] = container
+            return self.reply(201, {'Id': container.id})
+        container = engine.find(parts[1]) if parts[0] == 'containers' else None
+        if container is None:
+            return self.reply(404, {'message': 'no such container'})
+        with container.changed:
+            if parts[2] == 'start':
+                if container.running:
+                    return self.reply(304)
+                container.running = True
+                container.output.append(f'{container.name} started\n'.encode())
+                with engine.lock:
+                    engine.started.append((time.monotonic(), container.name))
+            elif parts[2] == 'stop':
+                if not container.running:
+                    return self.reply(304)
+                container.running = False
+            container.changed.notify_all()
+        self.reply(204)
+
+    def do_DELETE(self):
+        parts, query, _ = self.route('DELETE')
+        engine = self.server
+        with engine.lock:
+            if parts[0] == 'networks':
+                for name, network in list(engine.networks.items()):
+                    if parts[1] in (name, network['Id']):
+                        del engine.networks[name]
+                        return self.reply(204)
+                return self.reply(404, {'message': 'no such network'})
+            container = engine.find(parts[1])
+            if container is None:
+                return self.reply(404, {'message': 'no such container'})
+            if container.running and query.get('force') != 'true':
+                return self.reply(409, {'message': 'container is running'})
+            del engine.containers[container.id]
+        with container.changed:
+            container.running = False
+            container.changed.notify_all()
+        self.reply(204)
@@ -0,0 +1,88 @@
+import os
+import sys
+import types
+import unittest
+from collections import deque
+from unittest import mock
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'docker', 'bridge')
+
+# the bridge runs in its ROS 2 image; only the names it imports are needed to load it here
+ROS_MODULES = {
+    'roslibpy': ['Ros', 'Topic', 'Message'],
+    'rclpy': ['init', 'spin', 'create_node'],
+    'std_msgs': [],
+    'std_msgs.msg': ['Float32', 'Int32', 'String'],
+    'geometry_msgs': [],
+    'geometry_msgs.msg': ['Pose'],
+    'nav_msgs': [],
+    'nav_msgs.msg': ['Odometry'],
+    'sensor_msgs': [],
+    'sensor_msgs.msg': ['LaserScan'],
+}
+
+
+def import_bridge():
+    modules = {}
+    for name, attributes in ROS_MODULES.items():
+        module = types.ModuleType(name)
+        for attribute in attributes:
+            setattr(module, attribute, mock.MagicMock(name=f'{name}.{attribute}'))
+        modules[name] = module
+    with mock.patch.dict(sys.modules, modules), mock.patch.object(sys, 'path', [BRIDGE_DIR]+sys.path):
+        sys.modules.pop('bridge', None)
+        import bridge
+        sys.modules.pop('bridge', None)
+    return bridge
+
+
+class StubRos(object):
+    """Answers get_topics_for_type like rosapi does, with the raw service response"""
+    def __init__(self, topics):
+        self.topics = topics
+        self.calls = []
+
+    def get_topics_for_type(self, topic_type, callback=None, errback=None):
+        self.calls.append(topic_type)
+        callback({'topics': self.topics.get(topic_type, [])})
+
+
+class BridgeWorkerDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge = import_bridge()
+        self.worker = self.bridge.BridgeWorker.__new__(self.bridge.BridgeWorker)
+        self.worker.client = StubRos({
+            'nav_msgs/Odometry': ['/turtlebot1/odom', '/turtlebot2/odom'],
+            'std_msgs/String': ['/log'],
+        })
+        self.worker.discovered = deque()
+        self.worker.bridges = {}
+        self.worker.rules = self.bridge.TopicRules()
+        self.worker.node = mock.MagicMock()
+
+    def test_discover_queues_the_topic_names_of_the_response(self):
+        self.worker.discover()
+        self.assertEqual(self.worker.client.calls, self.bridge.BRIDGED_TYPES)
+        self.assertEqual(list(self.worker.discovered), [
+            ('/turtlebot1/odom', 'nav_msgs/Odometry'),
+            ('/turtlebot2/odom', 'nav_msgs/Odometry'),
+            ('/log', 'std_msgs/String'),
+        ])
+
+    def test_add_bridges_keeps_the_topics_of_its_shard(self):
+        self.worker.shard = 1
+        self.worker.n_shards = 2
+        self.worker.discover()
+        with mock.patch.object(self.bridge, 'Bridge') as bridge_class:
+            self.worker.add_bridges()
+        self.assertEqual(sorted(self.worker.bridges), ['/turtlebot1/odom'])
+        bridge_class.assert_called_once_with('/turtlebot1/odom', 'nav_msgs/Odometry', self.worker)
+        # rediscovery does not bridge a topic twice
+        self.worker.discover()
+        with mock.patch.object(self.bridge, 'Bridge') as bridge_class:
+            self.worker.add_bridges()
+        bridge_class.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
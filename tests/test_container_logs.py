@@ -0,0 +1,105 @@
+import os
+import sys
+import gzip
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from container_logs import ContainerLogCollector, RotatingLog, part_path, read_log
+from container_runtime import DockerEngineRuntime
+from fake_engine import FakeEngine
+from test_container_runtime import services, NETWORKS
+
+
+def line(k):
+    # 10 bytes each
+    return f'line {k:04d}\n'.encode()
+
+
+class RotatingLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, container='morse'):
+        return b''.join(read_log(self.tmp.name, container))
+
+    def test_without_rotation(self):
+        log = RotatingLog(self.tmp.name, 'morse', max_bytes=100)
+        for k in range(5):
+            log.write(line(k))
+        log.close()
+        self.assertEqual(self.read(), b''.join(line(k) for k in range(5)))
+        self.assertEqual(log.index(), [('morse', 0, part_path(self.tmp.name, 'morse', 0), 50)])
+        self.assertEqual(log.dropped_bytes, 0)
+
+    def test_the_first_and_last_parts_are_kept(self):
+        log = RotatingLog(self.tmp.name, 'morse', max_bytes=20, max_parts=3)
+        for k in range(20):
+            log.write(line(k))
+        log.write(b'end\n')
+        log.close()
+        # parts of two lines: 0 is kept, 1 to 7 are rotated out, 8 and 9 are the last ones
+        self.assertEqual([part for _, part, _, _ in log.index()], [0, 9, 10])
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), [f'morse.{part}.log.gz' for part in (0, 10, 9)])
+        self.assertEqual(log.dropped_bytes, 8*20)
+        self.assertEqual(self.read(), line(0) + line(1) + b'[... parts 1 to 8 rotated out ...]\n' +
+                         line(18) + line(19) + b'end\n')
+        with gzip.open(part_path(self.tmp.name, 'morse', 9), 'rb') as f:
+            self.assertEqual(f.read(), line(18) + line(19))
+
+    def test_at_least_the_first_and_the_current_part(self):
+        log = RotatingLog(self.tmp.name, 'morse', max_bytes=10, max_parts=1)
+        for k in range(3):
+            log.write(line(k))
+        log.close()
+        self.assertEqual(self.read(), line(0) + b'[... parts 1 to 2 rotated out ...]\n')
+
+    def test_containers_are_kept_apart(self):
+        # a container name that is a prefix of another one
+        for container in ('morse', 'morse.1'):
+            log = RotatingLog(self.tmp.name, container)
+            log.write(container.encode())
+            log.close()
+        self.assertEqual(self.read('morse'), b'morse')
+        self.assertEqual(self.read('morse.1'), b'morse.1')
+
+
+class ContainerLogCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = FakeEngine(os.path.join(self.tmp.name, 'docker.sock'))
+        self.engine.serve_in_background()
+        self.runtime = DockerEngineRuntime('morsesim0', self.tmp.name, 'unix://'+self.engine.server_address)
+        self.runtime.up(services(), NETWORKS)
+        self.out_dir = os.path.join(self.tmp.name, 'containers')
+
+    def tearDown(self):
+        self.engine.close()
+        self.tmp.cleanup()
+
+    def test_output_is_kept_until_stop(self):
+        # a stale part of an earlier attempt
+        os.makedirs(self.out_dir)
+        open(part_path(self.out_dir, 'morsesim0_master', 3), 'w').close()
+        collector = ContainerLogCollector(self.runtime, self.out_dir, max_bytes=64, max_parts=2)
+        collector.start(['morsesim0_morse', 'morsesim0_master'])
+        morse = self.engine.find('morsesim0_morse')
+        with morse.changed:
+            morse.output.extend(line(k) for k in range(10))
+            morse.changed.notify_all()
+        self.runtime.stop(['morse'])
+        # master is still running, its stream is closed by stop
+        index = collector.stop(grace_s=0.5)
+        self.assertEqual(sorted(set(container for container, _, _, _ in index)), ['morsesim0_master', 'morsesim0_morse'])
+        self.assertEqual(b''.join(read_log(self.out_dir, 'morsesim0_master')), b'morsesim0_master started\n')
+        morse_log = b''.join(read_log(self.out_dir, 'morsesim0_morse'))
+        self.assertTrue(morse_log.startswith(b'morsesim0_morse started\n'))
+        self.assertTrue(morse_log.endswith(line(9)))
+
+
+if __name__ == '__main__':
+    unittest.main()
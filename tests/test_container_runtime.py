@@ -0,0 +1,178 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from container_runtime import (ComposeRuntime, DockerEngineRuntime, dependency_levels, engine_stats, socket_path_of,
+                               PROJECT_LABEL, SERVICE_LABEL)
+from fake_engine import FakeEngine
+
+
+def services():
+    # the shape of the services the orchestrator writes, a ROS master first
+    return {
+        'master': {'image': 'ros:noetic', 'container_name': 'morsesim0_master', 'tty': True,
+                   'command': '/bin/bash -c "roscore"', 'networks': {'morsegatonet': {'ipv4_address': '10.2.0.5'}}},
+        'morse': {'image': 'morse', 'container_name': 'morsesim0_morse', 'tty': True, 'depends_on': ['master'],
+                  'volumes': ['./log:/root/log'], 'networks': {'morsegatonet': {'ipv4_address': '10.2.0.2'}}},
+        'ros1_bridge': {'image': 'bridge', 'container_name': 'morsesim0_ros1_bridge', 'depends_on': ['master'],
+                        'networks': ['morsegatonet']},
+        'pytrees1': {'image': 'pytrees', 'container_name': 'morsesim0_pytrees1', 'tty': True,
+                     'depends_on': ['morse', 'ros1_bridge'], 'networks': ['morsegatonet']},
+    }
+
+
+NETWORKS = {'morsegatonet': {'driver': 'bridge', 'ipam': {'driver': 'default', 'config': [{'subnet': '10.2.0.0/16'}]}}}
+
+
+class DependencyLevelsTest(unittest.TestCase):
+    def test_levels_follow_depends_on(self):
+        self.assertEqual(dependency_levels(services()), [['master'], ['morse', 'ros1_bridge'], ['pytrees1']])
+
+    def test_unknown_dependencies_are_ignored(self):
+        self.assertEqual(dependency_levels({'a': {'depends_on': ['elsewhere']}}), [['a']])
+
+    def test_cycles_are_rejected(self):
+        with self.assertRaises(Exception):
+            dependency_levels({'a': {'depends_on': ['b']}, 'b': {'depends_on': ['a']}})
+
+
+class SocketPathTest(unittest.TestCase):
+    def test_unix_urls_and_paths(self):
+        self.assertEqual(socket_path_of('unix:///var/run/docker.sock'), '/var/run/docker.sock')
+        self.assertEqual(socket_path_of('/tmp/fake.sock'), '/tmp/fake.sock')
+
+    def test_other_schemes_are_rejected(self):
+        for host in ('tcp://host:2375', 'ssh://user@host', 'unix://'):
+            with self.assertRaises(Exception):
+                socket_path_of(host)
+
+
+class ComposeRuntimeTest(unittest.TestCase):
+    def test_failed_commands_raise(self):
+        runtime = ComposeRuntime('experiment_trials.yaml', 'morsesim0')
+        with mock.patch('subprocess.run', return_value=mock.Mock(returncode=1)) as run:
+            with self.assertRaises(Exception):
+                runtime.up({}, {})
+        self.assertEqual(run.call_args[0][0][:4], ['docker-compose', '-p', 'morsesim0', '-f'])
+        with mock.patch('subprocess.run', return_value=mock.Mock(returncode=0)):
+            runtime.down()
+
+
+class DockerEngineRuntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = FakeEngine(os.path.join(self.tmp.name, 'docker.sock'))
+        self.engine.serve_in_background()
+        self.runtime = DockerEngineRuntime('morsesim0', self.tmp.name, 'unix://'+self.engine.server_address)
+
+    def tearDown(self):
+        self.engine.close()
+        self.tmp.cleanup()
+
+    def test_up_starts_the_services_in_dependency_order(self):
+        self.runtime.up(services(), NETWORKS)
+        started = [name for _, name in sorted(self.engine.started)]
+        self.assertEqual(started[0], 'morsesim0_master')
+        self.assertEqual(sorted(started[1:3]), ['morsesim0_morse', 'morsesim0_ros1_bridge'])
+        self.assertEqual(started[3], 'morsesim0_pytrees1')
+        morse = self.engine.find('morsesim0_morse').config
+        self.assertEqual(morse['Labels'][PROJECT_LABEL], 'morsesim0')
+        self.assertEqual(morse['Labels'][SERVICE_LABEL], 'morse')
+        self.assertEqual(morse['HostConfig']['Binds'], [os.path.join(self.tmp.name, 'log')+':/root/log'])
+        self.assertEqual(morse['NetworkingConfig']['EndpointsConfig']['morsesim0_morsegatonet']['IPAMConfig'],
+                         {'IPv4Address': '10.2.0.2'})
+        self.assertIn('morsesim0_morsegatonet', self.engine.networks)
+        self.assertEqual(sorted(self.runtime.running_services()), sorted(services()))
+
+    def test_create_then_up_reuses_unchanged_containers(self):
+        self.runtime.create(services(), NETWORKS)
+        self.assertEqual(self.engine.started, [])
+        ids = {container.name: container.id for container in self.engine.containers.values()}
+        self.runtime.up(services(), NETWORKS)
+        self.assertEqual({container.name: container.id for container in self.engine.containers.values()}, ids)
+        changed = services()
+        changed['morse']['command'] = 'morse run other_scene'
+        self.runtime.stop(['morse'])
+        self.runtime.up(changed, NETWORKS)
+        self.assertNotEqual(self.engine.find('morsesim0_morse').id, ids['morsesim0_morse'])
+        self.assertEqual(self.engine.find('morsesim0_master').id, ids['morsesim0_master'])
+
+    def test_stop_and_down(self):
+        self.runtime.up(services(), NETWORKS)
+        self.runtime.stop(['pytrees1', 'morse'])
+        self.assertEqual(sorted(self.runtime.running_services()), ['master', 'ros1_bridge'])
+        # already stopped
+        self.runtime.stop(['morse'])
+        self.runtime.down()
+        self.assertEqual(self.engine.containers, {})
+        self.assertEqual(self.engine.networks, {})
+        self.assertEqual(self.runtime.running_services(), [])
+
+    def test_a_create_whose_reply_is_lost_is_not_sent_again(self):
+        self.engine.lost_replies.append(('POST', '/containers/create'))
+        with self.assertRaises(ConnectionError):
+            self.runtime.request('POST', '/containers/create', body={'Image': 'ros:noetic'}, query={'name': 'morsesim0_master'})
+        # created once, a second create would have failed on the name
+        self.assertEqual(self.engine.calls.count(('POST', '/containers/create')), 1)
+        self.assertEqual([container.name for container in self.engine.containers.values()], ['morsesim0_master'])
+
+    def test_a_get_whose_reply_is_lost_is_sent_again(self):
+        self.engine.lost_replies.append(('GET', '/containers/json'))
+        self.assertEqual(self.runtime.request('GET', '/containers/json'), (200, []))
+        self.assertEqual(self.engine.calls.count(('GET', '/containers/json')), 2)
+
+    def test_connections_closed_by_the_engine_are_replaced_before_sending(self):
+        self.runtime.up(services(), NETWORKS)
+        self.engine.close_idle_connections()
+        # a stop sent on the closed connection would be carried out without a reply
+        morse = self.engine.find('morsesim0_morse').id
+        self.runtime.stop_container(morse)
+        self.assertEqual(self.engine.calls.count(('POST', f'/containers/{morse}/stop')), 1)
+        self.assertEqual(sorted(self.runtime.running_services()), ['master', 'pytrees1', 'ros1_bridge'])
+
+    def test_stats(self):
+        self.runtime.up(services(), NETWORKS)
+        stats = self.runtime.stats()
+        self.assertEqual(sorted(stats), sorted(service['container_name'] for service in services().values()))
+        self.assertEqual(stats['morsesim0_morse'], {'cpu_percent': 40.0, 'mem_bytes': 1024.0**2, 'block_read': 10.0,
+                                                    'block_write': 20.0, 'net_rx': 30.0, 'net_tx': 40.0})
+        self.assertEqual(engine_stats({})['cpu_percent'], 0.0)
+
+    def test_logs_follow_until_the_container_stops(self):
+        self.runtime.up(services(), NETWORKS)
+        output = {}
+
+        def follow(container):
+            stream = self.runtime.log_stream(container)
+            chunks = []
+            while True:
+                data = stream.read(1024)
+                if not data:
+                    break
+                chunks.append(data)
+            stream.close()
+            output[container] = b''.join(chunks)
+
+        # morse has a tty, ros1_bridge gets the multiplexed stream
+        threads = [threading.Thread(target=follow, args=(name,)) for name in ('morsesim0_morse', 'morsesim0_ros1_bridge')]
+        for thread in threads:
+            thread.start()
+        bridge = self.engine.find('morsesim0_ros1_bridge')
+        with bridge.changed:
+            bridge.output.append(b'bridging /turtlebot1/odom\n')
+            bridge.changed.notify_all()
+        self.runtime.stop(['morse', 'ros1_bridge'])
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(output['morsesim0_morse'], b'morsesim0_morse started\n')
+        self.assertEqual(output['morsesim0_ros1_bridge'], b'morsesim0_ros1_bridge started\nbridging /turtlebot1/odom\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from design_trials import TrialDesigner
+from trial_source import TrialSource
+
+
+def designer(reference):
+    return TrialDesigner(os.path.join(ROOT, 'experiment_design/design.json'), os.path.join(ROOT, reference), seed=0)
+
+
+class FullFactorialTest(unittest.TestCase):
+    def test_full_mode_reproduces_the_reference(self):
+        full = designer('experiment_design/trials.json')
+        reference = TrialSource(os.path.join(ROOT, 'experiment_design/trials.json'))
+        try:
+            trials = full.build_trials(full.full_factorial())
+            self.assertEqual(trials, list(reference))
+            self.assertEqual(full.skill_mismatches, 0)
+        finally:
+            full.reference.close()
+            reference.close()
+
+    def test_plans_keep_the_skills_they_were_made_for(self):
+        # the root trials.json has other skills than the design for some robots
+        other = designer('trials.json')
+        try:
+            trials = other.build_trials(other.full_factorial())
+            self.assertGreater(other.skill_mismatches, 0)
+            for trial in trials:
+                reference = other.reference[other.reference.index_of(trial["code"])]
+                for robot, ref_robot in zip(trial["robots"], reference["robots"]):
+                    self.assertEqual((robot["skills"], robot["local_plan"]), (ref_robot["skills"], ref_robot["local_plan"]))
+        finally:
+            other.reference.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
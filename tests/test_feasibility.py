@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feasibility import predict, preflight_order, plan_requirements, STARTUP_S, STEP_S
+
+
+# 10 m of navigation then a drawer step
+PLAN = [['navigation', ['IC Room 6', [[0.0, 0.0, 0.0], [3.0, 4.0], [6.0, 8.0]]], 'navto_room'],
+        ['operate_drawer', [], 'open_drawer'],
+        ['send_message', [], 'notify_nurse']]
+
+
+def robot(robot_id, local_plan=None, skills=('navigation', 'operate_drawer'), speed=0.5, charge=1.0, rate=0.001):
+    return {'id': robot_id, 'local_plan': local_plan, 'skills': list(skills), 'avg_speed': speed,
+            'battery_charge': charge, 'battery_discharge_rate': rate}
+
+
+def trial(code, *robots):
+    return {'id': 1, 'code': code, 'robots': list(robots), 'nurses': []}
+
+
+class PredictTest(unittest.TestCase):
+    def test_plan_requirements(self):
+        self.assertEqual(plan_requirements(PLAN, ['navigation']), (10.0, 2, ['operate_drawer']))
+
+    def test_a_feasible_plan_reaches_the_target(self):
+        [prediction] = predict([trial('aaaaap', robot(1, PLAN), robot(2))])
+        self.assertEqual((prediction.outcome, prediction.robot), ('reach-target', 'turtlebot1'))
+        self.assertAlmostEqual(prediction.runtime_s, STARTUP_S + 10.0/0.5 + 2*STEP_S)
+        self.assertAlmostEqual(prediction.battery_needed, 0.001*(20.0 + 2*STEP_S))
+
+    def test_a_missing_skill_fails_the_tree(self):
+        [prediction] = predict([trial('aaaaap', robot(1, PLAN, skills=['navigation']))])
+        self.assertEqual((prediction.outcome, prediction.missing_skills), ('failure-bt', ['operate_drawer']))
+        self.assertEqual(prediction.runtime_s, STARTUP_S)
+
+    def test_a_short_battery_runs_out(self):
+        [prediction] = predict([trial('aaaaap', robot(1, PLAN, charge=0.06, rate=0.001))])
+        self.assertEqual(prediction.outcome, 'low-battery')
+        self.assertAlmostEqual(prediction.runtime_s, STARTUP_S + 0.01/0.001)
+
+    def test_any_infeasible_robot_makes_the_trial_infeasible(self):
+        infeasible = robot(1, PLAN, charge=0.06)
+        feasible = robot(2, PLAN)
+        for robots in ((infeasible, feasible), (feasible, infeasible)):
+            [prediction] = predict([trial('aaaaap', *robots)])
+            self.assertEqual((prediction.outcome, prediction.robot), ('low-battery', 'turtlebot1'))
+        # the first robot to fail ends the trial
+        [prediction] = predict([trial('aaaaap', infeasible, robot(3, PLAN, skills=['navigation']))])
+        self.assertEqual((prediction.outcome, prediction.robot), ('failure-bt', 'turtlebot3'))
+
+    def test_feasible_robots_last_until_the_slowest_is_done(self):
+        [prediction] = predict([trial('aaaaap', robot(1, PLAN, speed=1.0), robot(2, PLAN, speed=0.25))])
+        self.assertEqual((prediction.outcome, prediction.robot), ('reach-target', 'turtlebot2'))
+
+    def test_trials_without_plans(self):
+        predictions = predict([trial('aaaaab', robot(1)), trial('aaaaap', robot(1, PLAN))])
+        self.assertEqual([(p.idx, p.code, p.outcome) for p in predictions],
+                         [(0, 'aaaaab', None), (1, 'aaaaap', 'reach-target')])
+
+
+class PreflightOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.predictions = predict([trial('aaaaab', robot(1, PLAN, speed=0.25)),
+                                    trial('aaaaap', robot(1, PLAN, skills=['navigation'])),
+                                    trial('aaaabp', robot(1, PLAN, speed=1.0))])
+
+    def test_order_runs_the_shortest_first(self):
+        self.assertEqual(preflight_order(self.predictions, range(3), 'order'), ([1, 2, 0], []))
+
+    def test_skip_drops_the_predicted_failures(self):
+        keep, dropped = preflight_order(self.predictions, [0, 1, 2], 'skip')
+        self.assertEqual(keep, [0, 2])
+        self.assertEqual([prediction.code for prediction in dropped], ['aaaaap'])
+
+    def test_flag_keeps_everything(self):
+        self.assertEqual(preflight_order(self.predictions, [2, 1, 0], 'flag'), ([2, 1, 0], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import math
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hospital_map import HospitalMap, KDTree, LOCATIONS
+
+
+class KDTreeTest(unittest.TestCase):
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(0)
+        for n in (1, 2, 3, 10, 200):
+            points = [(rng.uniform(-40, 0), rng.uniform(0, 35), k) for k in range(n)]
+            tree = KDTree(points)
+            for _ in range(200):
+                x, y = rng.uniform(-45, 5), rng.uniform(-5, 40)
+                distance, point = tree.nearest(x, y)
+                expected = min(math.hypot(px - x, py - y) for px, py, _ in points)
+                self.assertAlmostEqual(distance, expected)
+                self.assertAlmostEqual(math.hypot(point[0] - x, point[1] - y), distance)
+
+    def test_points_on_a_grid(self):
+        # many points on the splitting lines
+        points = [(float(x), float(y), (x, y)) for x in range(5) for y in range(5)]
+        tree = KDTree(points)
+        distance, point = tree.nearest(2.2, 3.9)
+        self.assertEqual(point, (2.0, 4.0, (2, 4)))
+        self.assertAlmostEqual(distance, math.hypot(0.2, 0.1))
+
+
+class HospitalMapTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.hospital = HospitalMap()
+
+    def test_routes_follow_the_corridors(self):
+        # door of IC Room 6, up the IC corridor, along the PC corridor to the door of PC Room 4
+        self.assertAlmostEqual(self.hospital.distance('IC Room 6', 'PC Room 4'), 1 + 6 + 18 + 2)
+        self.assertEqual(self.hospital.route('IC Room 6', 'PC Room 4'),
+                         [[-38.0, 10.0, 0.0], [-37, 10.0], [-37, 16], [-19, 16], [-19.0, 18.0, -1.57]])
+        self.assertAlmostEqual(self.hospital.distance('Pharmacy', 'IC Room 1'), 2 + 13.4 + 37 + 17.98 + 2.44)
+        self.assertEqual(self.hospital.route('PC Room 3', 'PC Room 3'), [[-21.0, 18.0, -1.57]])
+
+    def test_every_route_is_as_long_as_its_distance(self):
+        for source in LOCATIONS:
+            self.assertEqual(self.hospital.distance(source, source), 0.0)
+            for target in LOCATIONS:
+                distance = self.hospital.distance(source, target)
+                self.assertAlmostEqual(distance, self.hospital.distance(target, source))
+                waypoints = self.hospital.route(source, target)
+                self.assertAlmostEqual(sum(math.dist(a[:2], b[:2]) for a, b in zip(waypoints, waypoints[1:])), distance)
+                # no shorter than the straight line
+                self.assertGreaterEqual(distance + 1e-9, math.dist(LOCATIONS[source][:2], LOCATIONS[target][:2]))
+
+    def test_locate(self):
+        name, distance = self.hospital.nearest(-38.2, 10.1)
+        self.assertEqual(name, 'IC Room 6')
+        self.assertAlmostEqual(distance, math.hypot(0.2, 0.1))
+        self.assertEqual(self.hospital.locate(-38.2, 10.1), 'IC Room 6')
+        self.assertEqual(self.hospital.locate(-30, 16), 'PC Corridor')
+        self.assertEqual(self.hospital.locate(-37, 28), 'IC Corridor')
+
+    def test_poses_are_copies(self):
+        self.hospital.pose('Pharmacy').append(0.0)
+        self.assertEqual(self.hospital.pose('Pharmacy'), [-2, 2.6])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import math
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import make_table
+from make_table import classify_logs, drain_slope, get_factor_names, outcome_rates_by_factor, read_last_line
+
+
+class LastLineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'trial.log')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def last_line(self, text, block_size=16):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        return read_last_line(self.path, block_size=block_size)
+
+    def test_an_empty_file(self):
+        self.assertEqual(self.last_line(''), '')
+        self.assertEqual(self.last_line('\n'), '')
+
+    def test_with_and_without_a_trailing_newline(self):
+        self.assertEqual(self.last_line('first\nsecond\n'), 'second')
+        self.assertEqual(self.last_line('first\nsecond'), 'second')
+        self.assertEqual(self.last_line('only'), 'only')
+
+    def test_a_line_longer_than_the_read_block(self):
+        long_line = '231.12, [DEBUG], trial-watcher, reach-target: wall-clock=' + '9'*100
+        self.assertEqual(self.last_line('first\n' + long_line + '\n'), long_line)
+        self.assertEqual(self.last_line(long_line), long_line)
+        # the newline right at a block boundary
+        self.assertEqual(self.last_line('x'*15 + '\n' + 'y'*16 + '\n'), 'y'*16)
+
+    def test_the_recorded_logs(self):
+        self.assertEqual(read_last_line(os.path.join(ROOT, 'log/01_aaaaab.log'), block_size=64), '231.12, [DEBUG], None, end!')
+
+
+class ClassifyLogsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.write('01_aaaaab.log', '1.00, [DEBUG], trial-watcher, low-battery: wall-clock=300.0\n')
+        self.write('01_aaaaap.log', '1.00, [DEBUG], trial-watcher, reach-target: wall-clock=200.0\n')
+        self.write('notes.txt', 'reach-target\n')
+        # the log lines classify_logs prints
+        patcher = mock.patch('builtins.print')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.tmp.name, name), 'w') as f:
+            f.write(text)
+
+    def classify(self):
+        with mock.patch.object(make_table, 'read_last_line', wraps=read_last_line) as reader:
+            outcomes = classify_logs(self.tmp.name)
+        return outcomes, sorted(os.path.basename(call.args[0]) for call in reader.call_args_list)
+
+    def test_only_new_or_changed_logs_are_read(self):
+        outcomes, read = self.classify()
+        self.assertEqual(outcomes, {'01_aaaaab.log': 'low_bat', '01_aaaaap.log': 'success'})
+        self.assertEqual(read, ['01_aaaaab.log', '01_aaaaap.log'])
+        with open(os.path.join(self.tmp.name, '.outcome_index.json')) as f:
+            self.assertEqual(sorted(json.load(f)), ['01_aaaaab.log', '01_aaaaap.log'])
+        self.assertEqual(self.classify(), (outcomes, []))
+        # another size
+        self.write('01_aaaaab.log', '1.00, [DEBUG], trial-watcher, stall-sim: wall-clock=300.0\n')
+        self.assertEqual(self.classify(), ({'01_aaaaab.log': 'stall', '01_aaaaap.log': 'success'}, ['01_aaaaab.log']))
+        # the same size, only the mtime changed
+        path = os.path.join(self.tmp.name, '01_aaaaap.log')
+        size = os.path.getsize(path)
+        self.write('01_aaaaap.log', '1.00, [DEBUG], trial-watcher, failure-bt: wall-clock=20000.0\n')
+        stat = os.stat(path)
+        self.assertEqual(stat.st_size, size)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(self.classify(), ({'01_aaaaab.log': 'stall', '01_aaaaap.log': 'bt_fail'}, ['01_aaaaap.log']))
+
+    def test_removed_logs_leave_the_index(self):
+        self.classify()
+        os.remove(os.path.join(self.tmp.name, '01_aaaaab.log'))
+        self.assertEqual(self.classify(), ({'01_aaaaap.log': 'success'}, []))
+        with open(os.path.join(self.tmp.name, '.outcome_index.json')) as f:
+            self.assertEqual(list(json.load(f)), ['01_aaaaap.log'])
+
+    def test_a_corrupt_index_is_rebuilt(self):
+        self.write('.outcome_index.json', '{"01_aaaaab.log": [')
+        outcomes, read = self.classify()
+        self.assertEqual(outcomes['01_aaaaab.log'], 'low_bat')
+        self.assertEqual(len(read), 2)
+
+
+class AnalyticsTest(unittest.TestCase):
+    def test_drain_slope(self):
+        self.assertAlmostEqual(drain_slope([0.0, 10.0, 20.0], [100.0, 99.0, 98.0]), -0.1)
+        self.assertTrue(math.isnan(drain_slope([5.0], [50.0])))
+        self.assertTrue(math.isnan(drain_slope([5.0, 5.0], [50.0, 40.0])))
+
+    def test_outcome_rates_by_factor(self):
+        summaries = [{'code': 'ab', 'outcome': 'reach-target'},
+                     {'code': 'ab', 'outcome': 'low-battery'},
+                     {'code': 'bb', 'outcome': 'reach-target'}]
+        rates = outcome_rates_by_factor(summaries, ['first', 'second'])
+        self.assertEqual(rates[('first', 'a')], {'reach-target': 0.5, 'low-battery': 0.5})
+        self.assertEqual(rates[('first', 'b')], {'reach-target': 1.0})
+        self.assertAlmostEqual(rates[('second', 'b')]['reach-target'], 2/3)
+
+    def test_factor_names_follow_the_code_letters(self):
+        names = get_factor_names(os.path.join(ROOT, 'experiment_design/design.json'))
+        self.assertEqual(len(names), len('aaaaab'))
+
+
+if __name__ == '__main__':
+    unittest.main()
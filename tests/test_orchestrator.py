@@ -0,0 +1,383 @@
+import os
+import sys
+import copy
+import time
+import functools
+import tempfile
+import threading
+import unittest
+import urllib.error
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import run_simulation
+from hospital_map import default_map
+from results_store import ResultsStore, SKIPPED
+from trial_cache import trial_key
+from container_runtime import PROJECT_LABEL
+from fake_engine import FakeEngine
+from trial_log import LogFollower
+from trial_source import TrialSource, write_trials
+
+
+class NurseRelocationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = TrialSource(os.path.join(ROOT, 'trials.json'))
+        # an orchestrator without slots, containers or stores, only what create_env_file needs
+        self.orchestrator = run_simulation.Orchestrator.__new__(run_simulation.Orchestrator)
+        self.orchestrator.hospital = default_map()
+        self.orchestrator.env_path = os.path.join(self.tmp.name, 'sim.env')
+        self.orchestrator.seed = 0
+        self.orchestrator.reuse_containers = False
+
+    def tearDown(self):
+        self.source.close()
+        self.tmp.cleanup()
+
+    def prepare(self, trial):
+        self.orchestrator.nurses_config = trial["nurses"]
+        self.orchestrator.robots_config = trial["robots"]
+        self.orchestrator.create_env_file(trial["id"], trial["code"])
+        with open(self.orchestrator.env_path) as f:
+            return [line for line in f if line.startswith('NURSE_POSE=')]
+
+    def test_the_trial_config_is_left_as_loaded(self):
+        trial = self.source[0]
+        loaded = copy.deepcopy(trial)
+        # prepare_environment and prepare_trial both write the env file of trial 0
+        first = self.prepare(trial)
+        second = self.prepare(self.source[0])
+        self.assertEqual(first, second)
+        self.assertEqual(self.source[0], loaded)
+        # a worker gets the trial as JSON from the coordinator, the key must not depend on that
+        self.assertEqual(trial_key(self.source[0], 0, {}), trial_key(loaded, 0, {}))
+
+    def test_the_services_get_the_relocated_nurse(self):
+        trial = self.source[0]
+        position = trial["nurses"][0]["position"]
+        offset = default_map().nurse_offset(trial["nurses"][0]["location"])
+        relocated = [position[0] + offset[0], position[1] + offset[1]] + position[2:]
+        self.assertEqual(self.prepare(trial), ['NURSE_POSE={}\n'.format(str(relocated).replace(',', ';'))])
+        self.assertEqual(self.orchestrator.nurses_config[0]["position"], relocated)
+
+
+class UnreachableResults(object):
+    """The RemoteResults of a worker whose coordinator went away"""
+    def fail_trial(self, campaign, code, reason=None):
+        raise urllib.error.URLError('connection refused')
+
+
+class RunCheckpointedTest(unittest.TestCase):
+    def setUp(self):
+        self.orchestrator = run_simulation.Orchestrator.__new__(run_simulation.Orchestrator)
+        self.orchestrator.config = {0: {'id': 1, 'code': 'aaaaab'}}
+        self.orchestrator.campaign = 'dist'
+        self.orchestrator.runtime = mock.Mock()
+        self.orchestrator.pool_up = False
+        self.orchestrator.stats_sampler = None
+        self.orchestrator.log_collector = None
+
+    def failing_stage(self):
+        raise Exception('up failed')
+
+    def test_containers_are_removed_before_the_failure_is_reported(self):
+        self.orchestrator.results = UnreachableResults()
+        with self.assertRaises(urllib.error.URLError):
+            self.orchestrator.run_checkpointed(0, self.failing_stage)
+        self.orchestrator.runtime.down.assert_called_once_with()
+        self.assertFalse(self.orchestrator.pool_up)
+
+    def test_a_failed_stage_is_recorded(self):
+        self.orchestrator.results = mock.Mock()
+        self.assertFalse(self.orchestrator.run_checkpointed(0, self.failing_stage))
+        self.orchestrator.results.fail_trial.assert_called_once_with('dist', 'aaaaab', 'up failed')
+        self.orchestrator.runtime.down.assert_called_once_with()
+
+
+class TeardownTest(unittest.TestCase):
+    """Teardown waits for the log to settle and the containers to exit, not for fixed sleeps"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.orchestrator = run_simulation.Orchestrator.__new__(run_simulation.Orchestrator)
+        self.orchestrator.log_dir = self.tmp.name
+        self.orchestrator.clear_log_file()
+        self.orchestrator.log_follower = LogFollower(os.path.join(self.tmp.name, 'trial.log'))
+        self.orchestrator.lines = []
+        self.orchestrator.phase_times = {}
+        self.orchestrator.log_quiet_s = 0.3
+        self.orchestrator.flush_timeout_s = 30
+        self.orchestrator.reuse_containers = False
+        self.orchestrator.pool_services = ['ros1_bridge']
+        self.orchestrator.services = {'morse': {}, 'ros1_bridge': {}, 'pytrees1': {}}
+        self.orchestrator.runtime = mock.Mock()
+
+    def tearDown(self):
+        self.orchestrator.log_follower.close()
+        self.tmp.cleanup()
+
+    def log(self, line):
+        with open(os.path.join(self.tmp.name, 'trial.log'), 'a') as f:
+            f.write(line)
+
+    def test_wait_for_returns_once_the_condition_holds(self):
+        calls = []
+        waited = self.orchestrator.wait_for(lambda: calls.append(1) or len(calls) > 2, 30, interval_s=0.01)
+        self.assertLess(waited, 1)
+        self.assertEqual(len(calls), 3)
+        self.assertGreaterEqual(self.orchestrator.wait_for(lambda: False, 0.1, interval_s=0.01), 0.1)
+
+    def test_the_flush_waits_until_the_log_stops_growing(self):
+        # the logger still writes for a while after the end marker
+        writers = [threading.Timer(0.1*k, self.log, args=(f'{120+k}.00, [DEBUG], None, flushing\n',)) for k in range(1, 6)]
+        for writer in writers:
+            writer.start()
+        self.orchestrator.close_simulation()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(len(self.orchestrator.lines), 5)
+        self.assertGreaterEqual(self.orchestrator.phase_times['flush'], 0.5)
+        self.assertLess(self.orchestrator.phase_times['flush'], 5)
+        self.orchestrator.runtime.down.assert_called_once_with()
+        with open(os.path.join(self.tmp.name, 'trial.log')) as f:
+            self.assertEqual(f.read(), '')
+
+    def test_containers_exited(self):
+        for running, exited in ((None, False), (['morse', 'ros1_bridge'], False), ([], True)):
+            self.orchestrator.runtime.running_services.return_value = running
+            self.assertEqual(self.orchestrator.containers_exited(), exited, running)
+        # the reused containers are meant to stay up
+        self.orchestrator.reuse_containers = True
+        self.orchestrator.runtime.running_services.return_value = ['ros1_bridge']
+        self.assertTrue(self.orchestrator.containers_exited())
+        self.orchestrator.runtime.running_services.return_value = ['ros1_bridge', 'pytrees1']
+        self.assertFalse(self.orchestrator.containers_exited())
+
+
+class ResumeCampaignTest(unittest.TestCase):
+    def setUp(self):
+        self.source = TrialSource(os.path.join(ROOT, 'trials.json'))
+        self.orchestrator = run_simulation.Orchestrator.__new__(run_simulation.Orchestrator)
+        self.orchestrator.config = self.source
+        self.orchestrator.campaign = 'preflight'
+        self.orchestrator.results = ResultsStore(':memory:')
+        self.orchestrator.max_attempts = 3
+        self.orchestrator.use_cache = False
+        self.orchestrator.force = False
+
+    def tearDown(self):
+        self.orchestrator.results.close()
+        self.source.close()
+
+    def test_skipped_trials_are_run_without_the_preflight(self):
+        sim_list = range(0, len(self.source))
+        self.orchestrator.preflight = 'skip'
+        todo = self.orchestrator.resume_campaign(sim_list)
+        skipped = [idx for idx in sim_list if idx not in todo]
+        self.assertTrue(skipped)
+        states = self.orchestrator.results.trial_states('preflight')
+        self.assertEqual(set(states[self.source[idx]["code"]][0] for idx in skipped), {SKIPPED})
+        # skipping again does not lose them
+        self.assertEqual(self.orchestrator.resume_campaign(sim_list), todo)
+        self.orchestrator.preflight = None
+        self.assertEqual(self.orchestrator.resume_campaign(sim_list), list(sim_list))
+
+
+class ImageBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.orchestrator = run_simulation.Orchestrator.__new__(run_simulation.Orchestrator)
+        self.orchestrator.use_image_cache = True
+        self.orchestrator.pytrees_image = None
+        self.orchestrator.cache = mock.Mock()
+
+    def test_a_coordinator_does_not_build_the_image(self):
+        # the image is not on this host
+        with mock.patch('subprocess.run', return_value=mock.Mock(returncode=1)) as run:
+            self.assertEqual(self.orchestrator.serve_cached([0, 1], build_images=False), [0, 1])
+        self.assertEqual([call[0][0][:2] for call in run.call_args_list], [['docker', 'image']])
+        self.orchestrator.cache.get.assert_not_called()
+        self.assertIsNone(self.orchestrator.pytrees_image)
+
+    def test_a_coordinator_does_not_need_docker(self):
+        # nothing mocked, there is no docker binary on the PATH
+        with tempfile.TemporaryDirectory() as empty, mock.patch.dict(os.environ, {'PATH': empty}):
+            self.assertEqual(self.orchestrator.serve_cached([0, 1], build_images=False), [0, 1])
+            with self.assertRaises(Exception):
+                self.orchestrator.ensure_pytrees_image()
+        self.orchestrator.cache.get.assert_not_called()
+
+    def test_a_runner_builds_it(self):
+        with mock.patch('subprocess.run', return_value=mock.Mock(returncode=1)) as run:
+            with self.assertRaises(Exception):
+                self.orchestrator.ensure_pytrees_image()
+        self.assertEqual(run.call_args[0][0][:2], ['docker', 'build'])
+
+
+class FakeEngineTestCase(unittest.TestCase):
+    """
+    Orchestrators on the engine runtime of a FakeEngine, in a scratch copy of the
+    repository with the first trials of trials.json. Nothing writes the trial
+    log, so every trial ends with its (short) wall clock timeout
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = FakeEngine(os.path.join(self.tmp.name, 'docker.sock'))
+        self.engine.serve_in_background()
+        source = TrialSource(os.path.join(ROOT, 'trials.json'))
+        write_trials([source[idx] for idx in range(3)], os.path.join(self.tmp.name, 'trials.json'))
+        source.close()
+        # trials are loaded from the working directory, the files written under current_path
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        patcher = mock.patch.object(run_simulation, 'current_path', self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.close()
+        self.tmp.cleanup()
+
+    def engine_options(self):
+        return {'runtime': 'engine', 'docker_socket': 'unix://'+self.engine.server_address, 'campaign': 'fake'}
+
+    def configure(self, orchestrator):
+        orchestrator.use_image_cache = False
+        orchestrator.use_cache = False
+        orchestrator.stats_period_s = 0
+        orchestrator.container_log_bytes = 0
+        orchestrator.simulation_timeout_s = 0.2
+        orchestrator.log_quiet_s = 0.05
+        orchestrator.exit_timeout_s = 5
+
+    def snapshot(self):
+        # {project: {container name: (network mode, {network: ip}, env)}}, {network: subnet}
+        with self.engine.lock:
+            containers = {}
+            for container in self.engine.containers.values():
+                config = container.config
+                endpoints = config['NetworkingConfig']['EndpointsConfig']
+                containers.setdefault(config['Labels'][PROJECT_LABEL], {})[container.name] = (
+                    config['HostConfig']['NetworkMode'],
+                    {network: endpoint.get('IPAMConfig', {}).get('IPv4Address') for network, endpoint in endpoints.items()},
+                    config['Env'])
+            networks = {name: network['IPAM']['Config'][0]['Subnet'] for name, network in self.engine.networks.items()}
+        return containers, networks
+
+
+class SlotIsolationTest(FakeEngineTestCase):
+    def test_slots_are_separate_projects(self):
+        parallel = run_simulation.ParallelOrchestrator(n_slots=2, first_slot=1, **self.engine_options())
+        self.assertEqual([(slot.project_name, slot.container_prefix, slot.subnet_prefix) for slot in parallel.slots],
+                         [('morsesim1', 'morsesim1_', '10.11'), ('morsesim2', 'morsesim2_', '10.12')])
+        self.assertEqual(len(set(slot.env_path for slot in parallel.slots)), 2)
+        self.assertEqual(len(set(slot.log_dir for slot in parallel.slots)), 2)
+        both_up = threading.Barrier(2, timeout=30)
+        snapshots = []
+
+        def watch_trial(slot, watch):
+            # both slots hold the containers of a trial at this point
+            both_up.wait()
+            snapshots.append(self.snapshot())
+            watch()
+
+        for slot in parallel.slots:
+            self.configure(slot)
+            slot.watch_trial = functools.partial(watch_trial, slot, slot.watch_trial)
+        parallel.run_some_simulations([0, 1])
+        containers, networks = snapshots[0]
+        self.assertEqual(networks, {'morsesim1_morsegatonet': '10.11.0.0/16', 'morsesim2_morsegatonet': '10.12.0.0/16'})
+        self.assertEqual(sorted(containers), ['morsesim1', 'morsesim2'])
+        codes = set()
+        for slot in (1, 2):
+            project = containers[f'morsesim{slot}']
+            # master, morse, ros1_bridge and two containers per robot
+            self.assertEqual(len(project), 3 + 2*6)
+            for name, (network_mode, addresses, env) in project.items():
+                self.assertTrue(name.startswith(f'morsesim{slot}_'), name)
+                self.assertEqual(network_mode, f'morsesim{slot}_morsegatonet')
+                self.assertEqual(list(addresses), [network_mode])
+                # from the env file of the slot
+                codes.update(line for line in env if line.startswith('TRIAL_CODE='))
+            self.assertEqual(project[f'morsesim{slot}_master'][1], {f'morsesim{slot}_morsegatonet': f'10.{10+slot}.0.5'})
+        self.assertEqual(codes, {'TRIAL_CODE=aaaaab', 'TRIAL_CODE=aaaaap'})
+        # every slot took its own project down, and the trials landed in one campaign
+        self.assertEqual(self.snapshot(), ({}, {}))
+        self.assertEqual(parallel.slots[0].results.outcome_counts('fake'), {'timeout-wall': 2})
+        for name in ('01_aaaaab.log', '01_aaaaap.log'):
+            self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'log', name)))
+
+
+class PipelineOverlapTest(FakeEngineTestCase):
+    def setUp(self):
+        super(PipelineOverlapTest, self).setUp()
+        self.events = []
+
+    def record(self, lane, stage, function):
+        def recorded(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.events.append((stage, lane.trial_code, lane.project_name, start, time.monotonic()))
+        return recorded
+
+    def event(self, stage, code):
+        [(start, end)] = [(start, end) for name, trial, _, start, end in self.events if (name, trial) == (stage, code)]
+        return start, end
+
+    def test_stages_of_consecutive_trials_overlap(self):
+        pipeline = run_simulation.PipelinedOrchestrator(**self.engine_options())
+        for lane in pipeline.lanes:
+            self.configure(lane)
+            lane.watch_trial = self.record(lane, 'run', lane.watch_trial)
+            for stage in ('create', 'up', 'down'):
+                setattr(lane.runtime, stage, self.record(lane, stage, getattr(lane.runtime, stage)))
+        pipeline.run_some_simulations([0, 1, 2])
+        self.assertEqual(pipeline.lanes[0].results.outcome_counts('fake'), {'timeout-wall': 3})
+        self.assertEqual(self.snapshot(), ({}, {}))
+        # the lanes take turns
+        self.assertEqual(sorted((trial, project) for stage, trial, project, _, _ in self.events if stage == 'run'),
+                         [('aaaaab', 'morsesim0'), ('aaaaap', 'morsesim1'), ('aaaabb', 'morsesim0')])
+        run = {code: self.event('run', code) for code in ('aaaaab', 'aaaaap', 'aaaabb')}
+        # the next trial is created while the current one runs
+        self.assertLess(self.event('create', 'aaaaap')[1], run['aaaaab'][1])
+        self.assertLess(self.event('create', 'aaaabb')[1], run['aaaaap'][1])
+        # and started before the current one is torn down, which goes on while it runs
+        self.assertLess(self.event('up', 'aaaaap')[0], self.event('down', 'aaaaab')[0])
+        self.assertLess(self.event('down', 'aaaaab')[0], run['aaaaap'][1])
+        self.assertLess(self.event('up', 'aaaabb')[0], self.event('down', 'aaaaap')[0])
+        # a lane is torn down before it is prepared again
+        self.assertLess(self.event('down', 'aaaaab')[1], self.event('create', 'aaaabb')[0])
+        # one trial runs at a time
+        self.assertLessEqual(run['aaaaab'][1], run['aaaaap'][0])
+        self.assertLessEqual(run['aaaaap'][1], run['aaaabb'][0])
+
+
+class PackSupportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_packing_needs_the_submodules_to_read_the_pack_variables(self):
+        self.assertEqual(len(run_simulation.missing_pack_support(self.tmp.name)), 3)
+        self.write('docker/hmrs_hostpital_simulation/morse_hospital_sim/default.py',
+                   "copies = int(os.environ.get('PACK_SIZE', 1))\noffset = float(os.environ['PACK_OFFSET_X'])\n")
+        self.assertEqual(run_simulation.missing_pack_support(self.tmp.name),
+                         ['docker/motion_ctrl does not read TRIAL_NAMESPACE'])
+        self.write('docker/motion_ctrl/launch/log.launch', '<arg name="ns" default="$(env TRIAL_NAMESPACE)"/>\n')
+        self.assertEqual(run_simulation.missing_pack_support(self.tmp.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results_store import ResultsStore, RUNNING, DONE, FAILED
+
+
+TRIALS = [{'id': 1, 'code': 'aaaaab', 'factors': {'nurse': 'PC Room 1'}},
+          {'id': 1, 'code': 'aaaaap', 'factors': {'nurse': 'PC Room 1'}}]
+
+
+class ResultsStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ResultsStore(':memory:')
+        self.store.plan_campaign('exp', list(enumerate(TRIALS)))
+        for trial in TRIALS:
+            self.store.set_trial_state('exp', trial['code'], RUNNING)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_fail_trial_keeps_recorded_trials_done(self):
+        self.store.record_trial('exp', TRIALS[0], 'reach-target', 10.0, {}, [])
+        self.assertFalse(self.store.fail_trial('exp', 'aaaaab', 'table file not written'))
+        self.assertTrue(self.store.fail_trial('exp', 'aaaaap', 'up failed'))
+        states = self.store.trial_states('exp')
+        self.assertEqual(states['aaaaab'][0], DONE)
+        self.assertEqual(states['aaaaap'], (FAILED, 1, 'up failed'))
+
+    def test_counts_only_the_latest_row_of_a_trial(self):
+        self.store.record_trial('exp', TRIALS[0], 'timeout-wall', 10.0, {}, [])
+        self.store.record_trial('exp', TRIALS[1], 'reach-target', 10.0, {}, [])
+        # run again with --force
+        self.store.record_trial('exp', TRIALS[0], 'reach-target', 10.0, {}, [])
+        self.assertEqual(self.store.outcome_counts('exp'), {'reach-target': 2})
+        self.assertEqual(self.store.outcome_counts_by_factor('exp'), {('nurse', 'PC Room 1'): {'reach-target': 2}})
+        self.assertEqual(self.store.outcome_counts('other'), {})
+
+    def test_marks_and_usage_of_the_latest_attempt_only(self):
+        def stats(cpu, mem):
+            return {'cpu_percent': cpu, 'mem_bytes': mem, 'block_read': 0.0, 'block_write': 0.0, 'net_rx': 0.0, 'net_tx': 0.0}
+
+        # a first attempt that hung, then the retry
+        self.store.record_trial('exp', TRIALS[0], 'stall-sim', 600.0, {}, [], marks={'first-pose': 500.0},
+                                samples=[(10.0, 'morsesim0_morse', stats(400.0, 8e9))])
+        self.store.record_trial('exp', TRIALS[1], 'reach-target', 100.0, {}, [], marks={'first-pose': 30.0},
+                                samples=[(10.0, 'morsesim1_morse', stats(50.0, 1e9)),
+                                         (10.0, 'morsesim1_motion_ctrl3', stats(5.0, 1e8))])
+        self.store.record_trial('exp', TRIALS[0], 'reach-target', 100.0, {}, [], marks={'first-pose': 40.0},
+                                samples=[(10.0, 'morsesim0_morse', stats(70.0, 2e9)),
+                                         (20.0, 'morsesim0_morse', stats(90.0, 2e9))])
+        self.assertEqual(self.store.mark_times('exp'), {'first-pose': (35.0, 40.0)})
+        self.assertEqual(self.store.container_usage('exp'), {'morse': (80.0, 90.0, 2e9), 'motion_ctrl': (5.0, 5.0, 1e8)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import math
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import telemetry
+from telemetry import TelemetryReader, TelemetryWriter, convert_log, load_telemetry, zstd_available
+from trial_log import load_columns
+
+
+# sim time, robot, x, y, yaw, battery; the coordinates are stored as float32, so keep them exact in binary
+SAMPLES = [(float(t), 1 + t % 3, t*0.25, -t*0.5, 0.125, math.nan) for t in range(20)] + \
+          [(float(t), 4, math.nan, math.nan, math.nan, 100.0 - t*0.5) for t in range(20, 30)]
+
+
+def same(first, second):
+    # NaN fields compare equal
+    return all(a == b or (isinstance(a, float) and math.isnan(a) and math.isnan(b)) for a, b in zip(first, second))
+
+
+class TelemetryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'trial'+telemetry.SUFFIX)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def round_trip(self, codec):
+        with TelemetryWriter(self.path, codec, meta={'outcome': 'low-battery'}, chunk_records=8) as writer:
+            for sample in SAMPLES:
+                writer.append(*sample)
+        self.assertFalse(os.path.exists(self.path+'.tmp'))
+        with TelemetryReader(self.path) as reader:
+            self.assertEqual((reader.codec, reader.meta, len(reader), len(reader.chunks)), (codec, {'outcome': 'low-battery'}, 30, 4))
+            records = list(reader.records())
+            self.assertEqual(len(records), len(SAMPLES))
+            for record, sample in zip(records, SAMPLES):
+                self.assertTrue(same(record, sample), (record, sample))
+            self.assertEqual([record[0] for record in reader.records(t_from=6.0, t_to=9.0, robot=1)], [6.0, 9.0])
+            # chunks outside the range are not decompressed
+            with mock.patch.object(telemetry, 'decompress', wraps=telemetry.decompress) as decompress:
+                self.assertEqual(len(list(reader.records(t_from=25.0))), 5)
+            self.assertEqual(decompress.call_count, 1)
+
+    def test_zlib_round_trip(self):
+        self.round_trip('zlib')
+
+    @unittest.skipUnless(zstd_available(), 'needs python >= 3.14 or the zstandard package')
+    def test_zstd_round_trip(self):
+        self.round_trip('zstd')
+
+    def test_zstd_falls_back_to_zlib(self):
+        with mock.patch.object(telemetry, 'zstd_module', None), mock.patch.object(telemetry, 'zstandard', None):
+            with TelemetryWriter(self.path, 'zstd') as writer:
+                writer.append(*SAMPLES[0])
+        with TelemetryReader(self.path) as reader:
+            self.assertEqual(reader.codec, 'zlib')
+            self.assertTrue(same(next(reader.records()), SAMPLES[0]))
+
+    def test_a_failed_write_leaves_no_file(self):
+        with self.assertRaises(ValueError):
+            with TelemetryWriter(self.path, 'zlib') as writer:
+                writer.append(*SAMPLES[0])
+                raise ValueError()
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_other_files_are_rejected(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not telemetry at all')
+        with self.assertRaises(Exception):
+            TelemetryReader(self.path)
+
+    def test_convert_the_recorded_logs(self):
+        for name in ('01_aaaaab.log', '01_aaaaap.log'):
+            log_path = os.path.join(ROOT, 'log', name)
+            out_path, n_records = convert_log(log_path, os.path.join(self.tmp.name, name+telemetry.SUFFIX), codec='zlib')
+            self.assertLess(os.path.getsize(out_path), os.path.getsize(log_path))
+            text = load_columns(log_path)
+            binary = load_telemetry(out_path)
+            # the robot samples and the outcome survive, the other lines stay in the text log
+            samples = sorted(text.select('pose') + text.select('battery'))
+            self.assertEqual(n_records, len(samples))
+            self.assertEqual(len(binary), len(samples))
+            self.assertEqual(binary.outcome, text.outcome)
+            self.assertEqual(binary.robots(), text.robots())
+            for row, i in enumerate(samples):
+                self.assertEqual((binary.sim_time[row], binary.robot[row], binary.kind[row]),
+                                 (text.sim_time[i], text.robot[i], text.kind[i]))
+                for field in ('x', 'y', 'yaw', 'battery'):
+                    expected = getattr(text, field)[i]
+                    if math.isnan(expected):
+                        self.assertTrue(math.isnan(getattr(binary, field)[row]))
+                    else:
+                        self.assertAlmostEqual(getattr(binary, field)[row], expected, places=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trial_cache import build_hash, dockerfile_inputs
+
+
+DOCKERFILE = '''FROM ros:foxy
+COPY py_trees_ros_behaviors /ros_ws/src/py_trees_ros_behaviors
+COPY bridge/bridge.py /ros_ws/src
+COPY --from=builder /opt/tool /opt/tool
+ADD https://example.com/file.tar /tmp
+RUN colcon build
+'''
+
+
+class BuildHashTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.context = self.tmp.name
+        self.write('Dockerfile.pytrees', DOCKERFILE)
+        self.write('py_trees_ros_behaviors/setup.py', 'setup()\n')
+        self.write('bridge/bridge.py', 'print("bridge")\n')
+        self.write('hos/unrelated.txt', 'not copied\n')
+        self.dockerfile = os.path.join(self.context, 'Dockerfile.pytrees')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.context, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_inputs_are_the_dockerfile_and_its_local_copies(self):
+        self.assertEqual([os.path.relpath(path, self.context) for path in dockerfile_inputs(self.dockerfile, self.context)],
+                         ['Dockerfile.pytrees', 'py_trees_ros_behaviors', 'bridge/bridge.py'])
+
+    def test_hash_changes_with_every_input_only(self):
+        before = build_hash(self.dockerfile, self.context)
+        self.write('hos/unrelated.txt', 'changed\n')
+        self.assertEqual(build_hash(self.dockerfile, self.context), before)
+        for name, text in (('bridge/bridge.py', 'print("bridge 2")\n'),
+                           ('py_trees_ros_behaviors/setup.py', 'setup(name="x")\n'),
+                           ('Dockerfile.pytrees', DOCKERFILE+'RUN true\n')):
+            self.write(name, text)
+            after = build_hash(self.dockerfile, self.context)
+            self.assertNotEqual(after, before, name)
+            before = after
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+import os
+import sys
+import math
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import run_simulation
+from trial_log import LogEvent, LogFollower, TrialColumns, TrialWatchdog, load_columns, parse_line
+
+
+POSE = '36.08, [INFO], turtlebot2, {"y": "17.99", "x": "-19.01", "yaw": "-1.38"}\n'
+BATTERY = '36.12, [INFO], turtlebot4, {"battery-level": "16.72%"}\n'
+MOVE_BASE = '2.10, [DEBUG], None, [debug],turtlebot1,move-base-info,Move_base is up and ok....,None\n'
+
+
+class ParseLineTest(unittest.TestCase):
+    def test_events(self):
+        pose = parse_line(POSE)
+        self.assertEqual((pose.kind, pose.sim_time, pose.source, pose.data), ('pose', 36.08, 'turtlebot2', (-19.01, 17.99, -1.38)))
+        battery = parse_line(BATTERY)
+        self.assertEqual((battery.kind, battery.source, battery.data), ('battery', 'turtlebot4', 16.72))
+        move_base = parse_line(MOVE_BASE)
+        self.assertEqual((move_base.kind, move_base.source), ('move-base-info', 'turtlebot1'))
+        self.assertEqual(parse_line('231.12, [DEBUG], None, ENDLOWBATT\n')[:4], ('end', 231.12, 'None', 'low-battery'))
+        self.assertEqual(parse_line('not a logger line\n').kind, 'debug')
+
+    def test_markers_of_one_line_in_order(self):
+        self.assertEqual(parse_line('10.00, [DEBUG], None, ENDSIM after FAILURE\n').data, 'failure-bt')
+        self.assertEqual(parse_line('10.00, [DEBUG], None, ENDSIM ENDTIMEOUTSIM\n').data, 'timeout-sim')
+
+
+class LogFollowerTest(unittest.TestCase):
+    polling = False
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'trial.log')
+        self.write('', 'w')
+        if self.polling:
+            with mock.patch.object(LogFollower, 'watch_inotify'):
+                self.follower = LogFollower(self.path, poll_interval_s=0.05)
+            self.assertIsNone(self.follower.inotify_fd)
+        else:
+            self.follower = LogFollower(self.path)
+
+    def tearDown(self):
+        self.follower.close()
+        self.tmp.cleanup()
+
+    def write(self, text, mode='a'):
+        with open(self.path, mode) as f:
+            f.write(text)
+
+    def lines(self, timeout_s=0.2):
+        return [event.line for event in self.follower.wait(timeout_s)]
+
+    def test_only_appended_lines_are_read(self):
+        self.write(POSE)
+        self.assertEqual(self.lines(), [POSE])
+        self.assertEqual(self.lines(), [])
+        self.write(BATTERY)
+        self.assertEqual(self.lines(), [BATTERY])
+
+    def test_a_partial_trailing_line_waits_for_its_end(self):
+        self.write(POSE + BATTERY[:20])
+        self.assertEqual(self.lines(), [POSE])
+        self.assertEqual(self.lines(), [])
+        self.write(BATTERY[20:])
+        self.assertEqual(self.lines(), [BATTERY])
+
+    def test_truncation_starts_over(self):
+        self.write(POSE + BATTERY + BATTERY[:10])
+        self.assertEqual(len(self.lines()), 2)
+        # clear_log_file, then a shorter log
+        self.write(MOVE_BASE, 'w')
+        self.assertEqual(self.lines(), [MOVE_BASE])
+
+    def test_a_rotated_file_is_read_from_its_start(self):
+        self.write(POSE)
+        self.assertEqual(self.lines(), [POSE])
+        # replaced by a longer file, the size alone does not tell
+        rotated = self.path + '.new'
+        with open(rotated, 'w') as f:
+            f.write(MOVE_BASE + BATTERY)
+        os.replace(rotated, self.path)
+        self.assertEqual(self.lines(), [MOVE_BASE, BATTERY])
+
+    def test_wait_returns_as_soon_as_a_line_is_appended(self):
+        writer = threading.Timer(0.3, self.write, args=(POSE,))
+        writer.start()
+        start = time.time()
+        self.assertEqual(self.lines(timeout_s=10), [POSE])
+        self.assertLess(time.time() - start, 5)
+        writer.join()
+
+    def test_wait_times_out_without_complete_lines(self):
+        writer = threading.Timer(0.1, self.write, args=('no end of line',))
+        writer.start()
+        start = time.time()
+        self.assertEqual(self.lines(timeout_s=0.5), [])
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        writer.join()
+
+
+class PollingLogFollowerTest(LogFollowerTest):
+    """The same without inotify"""
+    polling = True
+
+
+class EndOfTrialTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'trial.log')
+        open(self.path, 'w').close()
+        self.orchestrator = run_simulation.Orchestrator.__new__(run_simulation.Orchestrator)
+        self.orchestrator.log_follower = LogFollower(self.path)
+        self.orchestrator.lines = []
+        self.orchestrator.marks = {}
+        self.orchestrator.trial_start = time.time()
+        self.orchestrator.watchdog = None
+        self.orchestrator.endsim = False
+
+    def tearDown(self):
+        self.orchestrator.log_follower.close()
+        self.tmp.cleanup()
+
+    def test_the_first_end_marker_names_the_outcome(self):
+        # the robot reached the target, then the battery ran out while the logger flushed
+        with open(self.path, 'w') as f:
+            f.write(POSE + '120.50, [DEBUG], None, ENDSIM\n' + '121.00, [DEBUG], None, ENDLOWBATT\n')
+        self.orchestrator.check_end_simulation(timeout_s=0.2)
+        self.assertEqual(self.orchestrator.endsim, 'reach-target')
+        self.assertEqual(len(self.orchestrator.lines), 3)
+        with open(self.path, 'a') as f:
+            f.write('122.00, [DEBUG], None, FAILURE\n')
+        self.orchestrator.check_end_simulation(timeout_s=0.2)
+        self.assertEqual(self.orchestrator.endsim, 'reach-target')
+        self.assertIn('end-marker', self.orchestrator.marks)
+
+
+class TrialColumnsTest(unittest.TestCase):
+    def test_one_row_per_line(self):
+        columns = load_columns(os.path.join(ROOT, 'log/01_aaaaab.log'))
+        self.assertEqual(columns.name, '01_aaaaab.log')
+        self.assertEqual(len(columns), 108)
+        self.assertEqual(columns.robots(), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(columns.outcome, 'low-battery')
+        batteries = columns.select('battery')
+        self.assertEqual(len(batteries), 14)
+        self.assertEqual(set(columns.robot[i] for i in batteries), {4})
+        self.assertEqual((columns.sim_time[batteries[-1]], columns.battery[batteries[-1]]), (231.12, 5.02))
+
+    def test_fields_of_other_kinds_are_nan(self):
+        columns = TrialColumns('trial.log')
+        for line in (POSE, BATTERY, MOVE_BASE, 'not a logger line\n'):
+            columns.append(parse_line(line))
+        self.assertEqual((columns.x[0], columns.y[0], columns.yaw[0]), (-19.01, 17.99, -1.38))
+        self.assertTrue(math.isnan(columns.battery[0]))
+        self.assertTrue(math.isnan(columns.x[1]))
+        self.assertEqual(columns.select('pose', robot=2), [0])
+        self.assertEqual(columns.select('pose', robot=4), [])
+        self.assertEqual(list(columns.robot), [2, 4, 1, -1])
+        self.assertTrue(math.isnan(columns.sim_time[3]))
+
+    def test_the_watcher_verdict_wins_over_the_markers(self):
+        columns = TrialColumns('trial.log')
+        columns.append(parse_line('120.50, [DEBUG], None, ENDSIM\n'))
+        columns.append(parse_line('121.00, [DEBUG], None, ENDLOWBATT\n'))
+        self.assertEqual(columns.outcome, 'reach-target')
+        columns.append(parse_line('1200.00, [DEBUG], trial-watcher, False: wall-clock=1200.0\n'))
+        self.assertEqual(columns.outcome, 'timeout-wall')
+
+
+ROBOTS = ['turtlebot1', 'turtlebot2']
+
+
+def pose(robot, sim_time, x=0.0, y=0.0):
+    return LogEvent('pose', sim_time, robot, (x, y, 0.0), '')
+
+
+class TrialWatchdogTest(unittest.TestCase):
+    """Driven by fake wall clock timestamps, the run starts at 1000"""
+    def setUp(self):
+        self.watchdog = TrialWatchdog(ROBOTS, 'turtlebot1', start=1000, startup_timeout_s=180, ready_timeout_s=300,
+                                      sim_stall_s=120, robot_silent_s=60, robot_frozen_s=180)
+
+    def ready(self, now=1010):
+        for robot in ROBOTS:
+            self.watchdog.feed(LogEvent('move-base-info', 2.0, robot, 'Move_base is up and ok', ''), now)
+
+    def test_stall_startup(self):
+        self.assertIsNone(self.watchdog.check(now=1170))
+        self.assertEqual(self.watchdog.check(now=1181), 'stall-startup')
+        self.assertIn('no log', self.watchdog.reason)
+
+    def test_stall_move_base(self):
+        self.watchdog.feed(LogEvent('move-base-info', 2.0, 'turtlebot1', 'Move_base is up and ok', ''), 1010)
+        self.watchdog.feed(pose('turtlebot1', 250.0), 1290)
+        self.assertIsNone(self.watchdog.check(now=1290))
+        self.assertEqual(self.watchdog.check(now=1301), 'stall-move-base')
+        self.assertIn('turtlebot2', self.watchdog.reason)
+
+    def test_stall_sim(self):
+        self.ready()
+        self.watchdog.feed(pose('turtlebot1', 40.0), 1050)
+        self.assertIsNone(self.watchdog.check(now=1160))
+        # lines keep coming, but without a later sim time
+        self.watchdog.feed(pose('turtlebot2', 40.0), 1160)
+        self.assertEqual(self.watchdog.check(now=1171), 'stall-sim')
+        self.assertIn('40.00', self.watchdog.reason)
+
+    def test_stall_robot_silent(self):
+        self.ready()
+        for sim_time in range(40, 101, 10):
+            self.watchdog.feed(pose('turtlebot1', float(sim_time), x=sim_time/10.0), 1000 + sim_time)
+        self.watchdog.feed(pose('turtlebot2', 40.0), 1040)
+        self.assertIsNone(self.watchdog.check(now=1100))
+        self.watchdog.feed(pose('turtlebot1', 101.0, x=10.1), 1101)
+        self.assertEqual(self.watchdog.check(now=1101), 'stall-robot')
+        self.assertIn('turtlebot2 silent', self.watchdog.reason)
+
+    def test_stall_robot_frozen(self):
+        self.ready()
+        for sim_time in range(40, 231, 10):
+            # turtlebot2 wanders, the robot with the plan stays put from sim time 40 on
+            self.watchdog.feed(pose('turtlebot1', float(sim_time)), 1000 + sim_time)
+            self.watchdog.feed(pose('turtlebot2', float(sim_time), x=sim_time/10.0), 1000 + sim_time)
+            stall = self.watchdog.check(now=1000 + sim_time)
+            if sim_time <= 40 + 180:
+                self.assertIsNone(stall, sim_time)
+        self.assertEqual(stall, 'stall-robot')
+        self.assertIn('turtlebot1 frozen', self.watchdog.reason)
+
+    def test_a_healthy_trial_is_left_alone(self):
+        self.ready()
+        for sim_time in range(40, 1000, 10):
+            for robot in ROBOTS:
+                self.watchdog.feed(pose(robot, float(sim_time), x=sim_time/10.0), 1000 + sim_time)
+            self.assertIsNone(self.watchdog.check(now=1000 + sim_time))
+
+    def test_replay_of_a_frozen_robot(self):
+        # in log/01_aaaaab.log turtlebot4, the robot with the plan, never leaves its start pose
+        watchdog = TrialWatchdog([f'turtlebot{i}' for i in range(1, 7)], 'turtlebot4', start=0)
+        stall = None
+        with open(os.path.join(ROOT, 'log/01_aaaaab.log')) as f:
+            for line in f:
+                event = parse_line(line)
+                if event.kind == 'end' or event.sim_time is None:
+                    continue
+                # one sim second per wall second
+                watchdog.feed(event, now=event.sim_time)
+                stall = watchdog.check(now=event.sim_time)
+                if stall is not None:
+                    break
+        self.assertEqual(stall, 'stall-robot')
+        self.assertIn('turtlebot4 frozen', watchdog.reason)
+        self.assertLess(watchdog.sim_time, 231)
+
+
+if __name__ == '__main__':
+    unittest.main()
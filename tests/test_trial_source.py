@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trial_source import TrialSource, write_trials
+
+
+# brackets and quotes inside strings are not structure
+TRIALS = [{'id': k//2 + 1, 'code': f'aaaa{"abc"[k//2]}{"bp"[k%2]}', 'note': 'room [3] {"x"} \\ done',
+           'robots': [{'id': 1, 'local_plan': [['navigation', ['IC Room 6', [[0.0, 1.0]]], 'navto']]}], 'nurses': []}
+          for k in range(6)]
+
+
+class TrialSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def source(self, name='trials.json', trials=TRIALS, **kwargs):
+        path = os.path.join(self.tmp.name, name)
+        if not os.path.exists(path):
+            write_trials(trials, path)
+        source = TrialSource(path, **kwargs)
+        self.addCleanup(source.close)
+        return source
+
+    def test_index_of_a_json_array_and_json_lines(self):
+        for name in ('trials.json', 'trials.jsonl'):
+            source = self.source(name)
+            self.assertEqual(len(source), 6)
+            self.assertEqual(list(source), TRIALS)
+            self.assertEqual(source[-1], TRIALS[-1])
+            self.assertEqual(source.ids, [1, 1, 2, 2, 3, 3])
+            self.assertEqual(source.index_of('aaaabp'), 3)
+            with self.assertRaises(IndexError):
+                source[6]
+
+    def test_an_empty_file(self):
+        open(os.path.join(self.tmp.name, 'empty.jsonl'), 'w').close()
+        self.assertEqual(list(self.source('empty.jsonl')), [])
+
+    def test_the_index_is_reused_until_the_file_changes(self):
+        path = os.path.join(self.tmp.name, 'trials.json')
+        self.source()
+        self.assertTrue(os.path.exists(path+'.idx'))
+        with mock.patch.object(TrialSource, 'build_index', side_effect=AssertionError('rebuilt')):
+            self.assertEqual(list(self.source()), TRIALS)
+        # the same size, only the mtime tells the file changed
+        changed = [dict(trial, code=trial['code'][::-1]) for trial in TRIALS]
+        write_trials(changed, path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(list(self.source()), changed)
+        # a different size, with a stale index of an older format
+        with open(path+'.idx') as f:
+            index = json.load(f)
+        write_trials(TRIALS[:2], path)
+        index['size'] = os.path.getsize(path)
+        index['version'] = 0
+        with open(path+'.idx', 'w') as f:
+            json.dump(index, f)
+        self.assertEqual(list(self.source()), TRIALS[:2])
+        # a corrupt index is rebuilt
+        with open(path+'.idx', 'w') as f:
+            f.write('{"version"')
+        self.assertEqual(list(self.source()), TRIALS[:2])
+
+    def test_the_cache_keeps_the_most_recently_used_trials(self):
+        source = self.source(cache_size=2)
+        source[0]
+        source[1]
+        source[0]
+        source[2]
+        self.assertEqual(list(source.cache), [0, 2])
+        with mock.patch('os.pread', side_effect=AssertionError('not cached')):
+            self.assertEqual(source[2], TRIALS[2])
+
+    def test_every_access_gets_its_own_trial(self):
+        source = self.source()
+        trial = source[0]
+        trial['robots'][0]['local_plan'].clear()
+        trial['code'] = 'changed'
+        self.assertEqual(source[0], TRIALS[0])
+
+    def test_shared_between_threads(self):
+        source = self.source(cache_size=3)
+        errors = []
+
+        def read(offset):
+            try:
+                for k in range(300):
+                    idx = (k + offset) % len(TRIALS)
+                    if source[idx] != TRIALS[idx]:
+                        errors.append(idx)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(source.cache), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results_store import ResultsStore, DONE
+from work_queue import Coordinator, CoordinatorClient, Worker, run_workers
+
+
+TRIALS = [{'id': 1, 'code': 'aaaaab', 'robots': [], 'nurses': []},
+          {'id': 1, 'code': 'aaaaap', 'robots': [], 'nurses': []}]
+# enough for several workers to compete for
+MANY_TRIALS = [{'id': i//2 + 1, 'code': 'aaaa'+'abc'[i//2]+'bp'[i%2], 'robots': [], 'nurses': []} for i in range(6)]
+
+
+def report(log_name='01_aaaaab.log'):
+    return {'outcome': 'reach-target', 'wall_clock': 12.5, 'phases': {'run': 12.5}, 'lines': [],
+            'marks': {}, 'samples': [], 'log_name': log_name, 'log': 'log of the trial\n'}
+
+
+class CoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive_dir = os.path.join(self.tmp.name, 'log')
+        os.makedirs(self.archive_dir)
+        self.results = ResultsStore(':memory:')
+        self.results.plan_campaign('dist', list(enumerate(TRIALS)))
+        self.coordinator = Coordinator(TRIALS, [0, 1], self.results, 'dist', self.archive_dir, lease_s=60)
+
+    def tearDown(self):
+        self.results.close()
+        self.tmp.cleanup()
+
+    def test_log_names_can_not_leave_the_archive(self):
+        lease = self.coordinator.lease('worker-a')
+        for name in ('', '.', '..', '.hidden'):
+            with self.assertRaises(ValueError):
+                self.coordinator.complete(lease['lease'], report(name))
+        # the lease survives a rejected report
+        self.assertEqual(self.coordinator.complete(lease['lease'], report('../../outside.log')), {})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'outside.log')))
+        with open(os.path.join(self.archive_dir, 'outside.log')) as f:
+            self.assertEqual(f.read(), 'log of the trial\n')
+        self.assertEqual(self.results.trial_states('dist')['aaaaab'][0], DONE)
+
+
+class WorkerDied(BaseException):
+    """The host of a worker going away in the middle of a trial"""
+
+
+class StubOrchestrator(object):
+    """
+    Runs a leased trial by writing its log after run_s seconds, in place of the
+    containers. A dying one raises WorkerDied on its first trial instead
+    """
+    def __init__(self, log_dir, run_s=0, slot=0, dying=False):
+        super(StubOrchestrator, self).__init__()
+        self.slot = slot
+        self.dying = dying
+        self.leased = []
+        self.config = {}
+        self.campaign = None
+        self.results = None
+        self.endsim = None
+        self.log_dir = log_dir
+        self.run_s = run_s
+        self.ran = []
+
+    def run_checkpointed(self, idx, stage=None, *args):
+        trial = self.config[idx]
+        self.leased.append(idx)
+        if self.dying:
+            raise WorkerDied()
+        time.sleep(self.run_s)
+        log_path = os.path.join(self.log_dir, '{:0>2d}_{}.log'.format(trial["id"], trial["code"]))
+        with open(log_path, 'w') as f:
+            f.write(f'log of {trial["code"]}\n')
+        self.ran.append(idx)
+        self.results.record_trial(self.campaign, trial, 'reach-target', self.run_s, {'run': self.run_s}, [], log_path)
+        return True
+
+    def shutdown_pool(self):
+        pass
+
+
+class LocalhostTest(unittest.TestCase):
+    """A coordinator served on localhost and a worker leasing from it"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive_dir = os.path.join(self.tmp.name, 'log')
+        self.worker_dir = os.path.join(self.tmp.name, 'worker')
+        os.makedirs(self.archive_dir)
+        os.makedirs(self.worker_dir)
+        self.results = ResultsStore(':memory:')
+
+    def tearDown(self):
+        self.results.close()
+        self.tmp.cleanup()
+
+    def serve(self, lease_s, trials=TRIALS):
+        self.results.plan_campaign('dist', list(enumerate(trials)))
+        self.coordinator = Coordinator(trials, list(range(len(trials))), self.results, 'dist', self.archive_dir,
+                                       lease_s=lease_s)
+        # lingers longer than a worker waits between polls, so it learns the campaign is done
+        self.server = threading.Thread(target=self.coordinator.serve, args=('127.0.0.1', 0, 1), daemon=True)
+        self.server.start()
+        self.assertTrue(self.coordinator.listening.wait(5))
+        return 'http://127.0.0.1:{}'.format(self.coordinator.address[1])
+
+    def wait_for_the_coordinator(self):
+        # it stops once every trial is settled
+        self.server.join(10)
+        self.assertFalse(self.server.is_alive())
+
+    def run_worker(self, url, orchestrator):
+        Worker(url, orchestrator, name='worker-a').run()
+        self.wait_for_the_coordinator()
+
+    def recorded(self):
+        # {code: number of results recorded}
+        return dict(self.results.db.execute('SELECT code, COUNT(*) FROM trials WHERE campaign = ? GROUP BY code',
+                                            ('dist',)).fetchall())
+
+    def test_heartbeats_keep_a_long_trial_leased(self):
+        url = self.serve(lease_s=0.6)
+        # each trial outlives its lease, only the heartbeats keep it
+        orchestrator = StubOrchestrator(self.worker_dir, run_s=1.5)
+        self.run_worker(url, orchestrator)
+        self.assertEqual(orchestrator.ran, [0, 1])
+        states = self.results.trial_states('dist')
+        self.assertEqual(states['aaaaab'][:2], (DONE, 1))
+        self.assertEqual(states['aaaaap'][:2], (DONE, 1))
+        self.assertEqual(self.results.outcome_counts('dist'), {'reach-target': 2})
+        with open(os.path.join(self.archive_dir, '01_aaaaap.log')) as f:
+            self.assertEqual(f.read(), 'log of aaaaap\n')
+
+    def test_an_expired_lease_is_requeued(self):
+        url = self.serve(lease_s=0.6)
+        client = CoordinatorClient(url)
+        # a worker that leases the first trial and dies
+        lost = client.call('/lease', {'worker': 'worker-dead'})
+        self.assertEqual(lost['idx'], 0)
+        orchestrator = StubOrchestrator(self.worker_dir)
+        self.run_worker(url, orchestrator)
+        self.assertEqual(orchestrator.ran, [1, 0])
+        state, attempts, _ = self.results.trial_states('dist')['aaaaab']
+        self.assertEqual((state, attempts), (DONE, 2))
+        # the dead worker coming back late is told its lease is gone
+        self.assertIsNone(self.coordinator.heartbeat(lost['lease']))
+        self.assertIsNone(self.coordinator.complete(lost['lease'], report()))
+
+    def test_workers_compete_for_the_trials(self):
+        url = self.serve(lease_s=5, trials=MANY_TRIALS)
+        orchestrators = [StubOrchestrator(self.worker_dir, run_s=0.2, slot=slot) for slot in range(3)]
+        run_workers(url, orchestrators)
+        self.wait_for_the_coordinator()
+        # every trial ran once, on one of the workers
+        self.assertEqual(sorted(idx for orchestrator in orchestrators for idx in orchestrator.ran), list(range(6)))
+        self.assertGreater(len([orchestrator for orchestrator in orchestrators if orchestrator.ran]), 1)
+        self.assertEqual(self.recorded(), {trial["code"]: 1 for trial in MANY_TRIALS})
+        self.assertEqual(set(state for state, _, _ in self.results.trial_states('dist').values()), {DONE})
+
+    def test_the_trial_of_a_dead_worker_goes_to_another_one(self):
+        url = self.serve(lease_s=0.6, trials=MANY_TRIALS)
+        dead = StubOrchestrator(self.worker_dir, slot=0, dying=True)
+        with self.assertRaises(WorkerDied):
+            Worker(url, dead, name='worker-dead').run()
+        self.assertEqual(dead.leased, [0])
+        # its lease is not renewed any more, the live workers get the trial once it expires
+        alive = [StubOrchestrator(self.worker_dir, run_s=0.1, slot=slot) for slot in (1, 2)]
+        run_workers(url, alive)
+        self.wait_for_the_coordinator()
+        self.assertEqual(dead.ran, [])
+        self.assertIn(0, alive[0].ran + alive[1].ran)
+        self.assertEqual(self.recorded(), {trial["code"]: 1 for trial in MANY_TRIALS})
+        state, attempts, _ = self.results.trial_states('dist')['aaaaab']
+        self.assertEqual((state, attempts), (DONE, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import glob
+import shutil
+import hashlib
+import subprocess
+import configparser
+
+
+# outcomes worth replaying; stalls and wall clock timeouts are usually infrastructure hiccups
+CACHEABLE_OUTCOMES = ('reach-target', 'failure-bt', 'low-battery', 'timeout-sim')
+
+
+def submodule_commits(base_path):
+    '''
+    Returns {submodule path: commit} for the submodules in .gitmodules, with the
+    diff hash appended when the checkout has local changes. Submodules that
+    are not git checkouts are fingerprinted by their contents instead
+    '''
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(base_path, '.gitmodules'))
+    commits = {}
+    for section in parser.sections():
+        path = parser[section].get('path')
+        full_path = os.path.join(base_path, path)
+        head = subprocess.run(['git', '-C', full_path, 'rev-parse', 'HEAD'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        if head.returncode == 0 and os.path.exists(os.path.join(full_path, '.git')):
+            commit = head.stdout.strip()
+            diff = subprocess.run(['git', '-C', full_path, 'diff', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            if diff.stdout:
+                commit += '+'+hashlib.sha256(diff.stdout).hexdigest()[:12]
+        elif os.path.isdir(full_path):
+            commit = 'tree:'+source_hash(full_path)
+        else:
+            commit = None
+        commits[path] = commit
+    return commits
+
+
+def source_hash(path):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in ('build', 'install', 'log', '__pycache__', '.git'))
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def dockerfile_inputs(dockerfile, context):
+    '''
+    Returns the paths an image build reads: the Dockerfile and the local
+    sources of its COPY/ADD instructions (not those copied from another stage or a URL)
+    '''
+    paths = [dockerfile]
+    with open(dockerfile) as f:
+        lines = f.read().replace('\\\n', ' ').splitlines()
+    for line in lines:
+        words = line.split()
+        if len(words) < 3 or words[0].upper() not in ('COPY', 'ADD'):
+            continue
+        if any(word.startswith('--from') for word in words[1:-1]):
+            continue
+        for source in words[1:-1]:
+            if not source.startswith('--') and '://' not in source:
+                paths.append(os.path.join(context, source))
+    return paths
+
+
+def build_hash(dockerfile, context):
+    '''
+    Hash of everything a docker build of dockerfile in context reads, so an
+    image tagged with it is rebuilt when the Dockerfile or any copied source changes
+    '''
+    digest = hashlib.sha256()
+    for path in dockerfile_inputs(dockerfile, context):
+        digest.update(os.path.relpath(path, context).encode())
+        if os.path.isdir(path):
+            digest.update(source_hash(path).encode())
+        elif os.path.isfile(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        else:
+            # a missing source fails the build itself, this only has to differ from any content
+            digest.update(b'\0missing')
+    return digest.hexdigest()
+
+
+def image_digest(image):
+    inspect = subprocess.run(['docker', 'image', 'inspect', '--format', '{{.Id}}', image],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return inspect.stdout.strip() if inspect.returncode == 0 else None
+
+
+def environment_fingerprint(base_path, images=()):
+    '''
+    Everything outside the trial config that decides its outcome: the Dockerfiles
+    the services are built from, the digests of prebuilt images and the
+    submodule commits mounted into the containers
+    '''
+    dockerfiles = {}
+    for path in sorted(glob.glob(os.path.join(base_path, 'docker', 'Dockerfile*'))):
+        with open(path, 'rb') as f:
+            dockerfiles[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+    return {
+        'dockerfiles': dockerfiles,
+        'images': {image: image_digest(image) for image in images},
+        'submodules': submodule_commits(base_path),
+    }
+
+
+def trial_key(trial, seed, environment):
+    canonical = json.dumps({'trial': trial, 'seed': seed, 'environment': environment},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class TrialCache(object):
+    """
+    Content addressed store of finished trials: <path>/<key[:2]>/<key>/ holds
+    result.json and the archived trial log. Entries are used least recently
+    first when evicting
+    """
+    def __init__(self, path, max_entries=1000):
+        super(TrialCache, self).__init__()
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        '''
+        Returns (result dict, log path) or None
+        '''
+        entry = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry, 'result.json')) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # mtime is the recency used by evict()
+        os.utime(os.path.join(entry, 'result.json'))
+        return result, os.path.join(entry, 'trial.log')
+
+    def put(self, key, result, log_path):
+        entry = self.entry_dir(key)
+        tmp = entry+'.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        shutil.copyfile(log_path, os.path.join(tmp, 'trial.log'))
+        with open(os.path.join(tmp, 'result.json'), 'w') as f:
+            json.dump(result, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def entries(self):
+        found = []
+        for result_path in glob.glob(os.path.join(self.path, '??', '*', 'result.json')):
+            found.append((os.path.getmtime(result_path), os.path.dirname(result_path)))
+        return sorted(found)
+
+    def evict(self, max_entries=None):
+        max_entries = self.max_entries if max_entries is None else max_entries
+        entries = self.entries()
+        for _, entry in entries[:max(len(entries) - max_entries, 0)]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def invalidate(self, codes=None):
+        '''
+        Drops the entries of the given trial codes, every entry when codes is None.
+        Returns how many were dropped
+        '''
+        dropped = 0
+        for _, entry in self.entries():
+            if codes is not None:
+                try:
+                    with open(os.path.join(entry, 'result.json')) as f:
+                        code = json.load(f).get('code')
+                except (OSError, ValueError):
+                    code = None
+                if code not in codes:
+                    continue
+            shutil.rmtree(entry, ignore_errors=True)
+            dropped += 1
+        return dropped
@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import math
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+from array import array
+from collections import namedtuple
+
+
+# kind: end | pose | battery | move-base-info | debug
+LogEvent = namedtuple('LogEvent', ['kind', 'sim_time', 'source', 'data', 'line'])
+
+# checked in this order, the first marker found in a line names the outcome
+END_MARKERS = [
+    ('ENDTIMEOUTSIM', 'timeout-sim'),
+    ('ENDLOWBATT', 'low-battery'),
+    ('FAILURE', 'failure-bt'),
+    ('ENDSIM', 'reach-target'),
+]
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def parse_line(line):
+    '''
+    Turns a logger line into a LogEvent, e.g.
+        36.08, [INFO], turtlebot2, {"y": "17.99", "x": "-19.01", "yaw": "-1.38"}
+        36.12, [INFO], turtlebot4, {"battery-level": "16.72%"}
+        2.10, [DEBUG], None, [debug],turtlebot1,move-base-info,Move_base is up and ok....,None
+        231.12, [DEBUG], None, ENDLOWBATT
+    '''
+    fields = line.rstrip('\n').split(', ', 3)
+    try:
+        sim_time = float(fields[0])
+    except ValueError:
+        sim_time = None
+    source = fields[2] if len(fields) > 2 else None
+    message = fields[3] if len(fields) > 3 else ''
+    for marker, outcome in END_MARKERS:
+        if marker in line:
+            return LogEvent('end', sim_time, source, outcome, line)
+    if message.startswith('{'):
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            payload = {}
+        if 'x' in payload:
+            pose = (float(payload['x']), float(payload['y']), float(payload.get('yaw', 0.0)))
+            return LogEvent('pose', sim_time, source, pose, line)
+        if 'battery-level' in payload:
+            level = float(payload['battery-level'].rstrip('%'))
+            return LogEvent('battery', sim_time, source, level, line)
+    if message.startswith('[debug],'):
+        parts = message.split(',')
+        if len(parts) > 3 and parts[2] == 'move-base-info':
+            return LogEvent('move-base-info', sim_time, parts[1], parts[3], line)
+    return LogEvent('debug', sim_time, source, message, line)
+
+
+class LogFollower(object):
+    """Follows a growing log file, reading only the bytes appended since the last call"""
+    def __init__(self, path, poll_interval_s=0.2):
+        super(LogFollower, self).__init__()
+        self.path = path
+        self.poll_interval_s = poll_interval_s
+        self.offset = 0
+        self.partial = b''
+        # inode of the file the offset is in, a replaced (rotated) file starts over
+        self.inode = None
+        self.inotify_fd = None
+        self.watch_inotify()
+
+    def watch_inotify(self):
+        # the logger writes from inside a container through a bind mount, so we
+        # watch the directory and re-read on any change; polling is the fallback
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path)).encode()
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if libc.inotify_add_watch(fd, directory, mask) < 0:
+                os.close(fd)
+                return
+            self.inotify_fd = fd
+        except (OSError, AttributeError):
+            self.inotify_fd = None
+
+    def read_lines(self):
+        try:
+            with open(self.path, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                if stat.st_ino != self.inode or stat.st_size < self.offset:
+                    # replaced or truncated (e.g. clear_log_file), start over
+                    self.inode = stat.st_ino
+                    self.offset = 0
+                    self.partial = b''
+                if stat.st_size == self.offset:
+                    return []
+                file.seek(self.offset)
+                chunk = file.read(stat.st_size - self.offset)
+        except OSError:
+            return []
+        self.offset += len(chunk)
+        data = self.partial + chunk
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        return [line.decode('utf-8', 'replace')+'\n' for line in lines]
+
+    def wait(self, timeout_s):
+        '''
+        Blocks until complete lines are appended or timeout_s elapses and
+        returns the LogEvents parsed from them
+        '''
+        deadline = time.time() + timeout_s
+        if self.inotify_fd is not None:
+            # forget notifications for data we are about to read anyway
+            self.drain_inotify()
+        lines = self.read_lines()
+        while not lines:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self.inotify_fd is not None:
+                ready, _, _ = select.select([self.inotify_fd], [], [], remaining)
+                if ready:
+                    self.drain_inotify()
+            else:
+                time.sleep(min(self.poll_interval_s, remaining))
+            lines = self.read_lines()
+        return [parse_line(line) for line in lines]
+
+    def drain_inotify(self):
+        while True:
+            try:
+                if not os.read(self.inotify_fd, 4096):
+                    return
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+EVENT_KINDS = ['pose', 'battery', 'move-base-info', 'end', 'debug']
+
+
+class TrialColumns(object):
+    """Columnar view of one trial log, one typed array per field"""
+    def __init__(self, name):
+        super(TrialColumns, self).__init__()
+        self.name = name
+        self.sim_time = array('d')
+        self.robot = array('h')
+        self.kind = array('b')
+        self.x = array('d')
+        self.y = array('d')
+        self.yaw = array('d')
+        self.battery = array('d')
+        self.outcome = None
+
+    def __len__(self):
+        return len(self.sim_time)
+
+    def append(self, event):
+        nan = float('nan')
+        self.sim_time.append(event.sim_time if event.sim_time is not None else nan)
+        self.robot.append(robot_number(event.source))
+        self.kind.append(EVENT_KINDS.index(event.kind))
+        x, y, yaw = event.data if event.kind == 'pose' else (nan, nan, nan)
+        self.x.append(x)
+        self.y.append(y)
+        self.yaw.append(yaw)
+        self.battery.append(event.data if event.kind == 'battery' else nan)
+        if event.kind == 'end' and self.outcome is None:
+            self.outcome = event.data
+        if event.source == 'trial-watcher' and ': wall-clock=' in event.data:
+            # the orchestrator verdict wins over the markers found in the log
+            verdict = event.data.split(':')[0]
+            self.outcome = 'timeout-wall' if verdict == 'False' else verdict
+
+    def select(self, kind, robot=None):
+        code = EVENT_KINDS.index(kind)
+        return [i for i in range(len(self.kind)) if self.kind[i] == code and (robot is None or self.robot[i] == robot)]
+
+    def robots(self):
+        return sorted(set(r for r in self.robot if r >= 0))
+
+
+def robot_number(source):
+    # turtlebot4 -> 4, anything else -> -1
+    if source and source.startswith('turtlebot'):
+        try:
+            return int(source[len('turtlebot'):])
+        except ValueError:
+            pass
+    return -1
+
+
+def load_columns(path):
+    columns = TrialColumns(os.path.basename(path))
+    with open(path, 'r', errors='replace') as file:
+        for line in file:
+            columns.append(parse_line(line))
+    return columns
+
+
+class TrialWatchdog(object):
+    """
+    Aborts hung trials from the streaming log instead of waiting for the wall
+    clock budget. check() returns one of these outcomes, None while healthy:
+        stall-startup   no log line at all within startup_timeout_s (wall)
+        stall-move-base a robot never reported move-base-info within ready_timeout_s (wall)
+        stall-sim       simulated time stopped advancing for sim_stall_s (wall)
+        stall-robot     a robot sent no pose/battery update for robot_silent_s (sim),
+                        or the robot with a plan did not move for robot_frozen_s (sim)
+    """
+    def __init__(self, robots, chosen_robot=None, start=None, startup_timeout_s=180, ready_timeout_s=300,
+                 sim_stall_s=120, robot_silent_s=60, robot_frozen_s=180, frozen_distance=0.05):
+        super(TrialWatchdog, self).__init__()
+        self.robots = list(robots)
+        self.chosen_robot = chosen_robot
+        self.start = start if start is not None else time.time()
+        self.startup_timeout_s = startup_timeout_s
+        self.ready_timeout_s = ready_timeout_s
+        self.sim_stall_s = sim_stall_s
+        self.robot_silent_s = robot_silent_s
+        self.robot_frozen_s = robot_frozen_s
+        self.frozen_distance = frozen_distance
+        self.first_line = None
+        self.sim_time = None
+        # wall clock of the last simulated time increase
+        self.sim_progress = None
+        self.ready = set()
+        # robot -> sim time of its last pose/battery update
+        self.last_update = {}
+        # sim time since when the chosen robot has been at moved_from
+        self.moved_from = None
+        self.moved_at = None
+        self.reason = None
+
+    def feed(self, event, now=None):
+        now = now if now is not None else time.time()
+        if self.first_line is None:
+            self.first_line = now
+        sim_time = event.sim_time
+        if sim_time is not None and (self.sim_time is None or sim_time > self.sim_time):
+            self.sim_time = sim_time
+            self.sim_progress = now
+        if event.kind == 'move-base-info':
+            self.ready.add(event.source)
+        elif event.kind in ('pose', 'battery') and sim_time is not None:
+            self.last_update[event.source] = sim_time
+            if event.kind == 'pose' and event.source == self.chosen_robot:
+                x, y, _ = event.data
+                if self.moved_from is None or math.hypot(x - self.moved_from[0], y - self.moved_from[1]) > self.frozen_distance:
+                    self.moved_from = (x, y)
+                    self.moved_at = sim_time
+
+    def check(self, now=None):
+        now = now if now is not None else time.time()
+        if self.first_line is None:
+            if now - self.start > self.startup_timeout_s:
+                return self.stall('stall-startup', f'no log after {now - self.start:.0f}s')
+            return None
+        missing = [robot for robot in self.robots if robot not in self.ready]
+        if missing and now - self.start > self.ready_timeout_s:
+            return self.stall('stall-move-base', f'move_base not up for {",".join(missing)}')
+        if self.sim_progress is not None and now - self.sim_progress > self.sim_stall_s:
+            return self.stall('stall-sim', f'sim time stuck at {self.sim_time:.2f}')
+        if self.sim_time is None or missing:
+            return None
+        for robot in self.robots:
+            # robots only start reporting once they are up, count from the first report on
+            last = self.last_update.get(robot)
+            if last is not None and self.sim_time - last > self.robot_silent_s:
+                return self.stall('stall-robot', f'{robot} silent since {last:.2f}')
+        if self.moved_at is not None and self.sim_time - self.moved_at > self.robot_frozen_s:
+            return self.stall('stall-robot', f'{self.chosen_robot} frozen at {self.moved_from} since {self.moved_at:.2f}')
+        return None
+
+    def stall(self, outcome, reason):
+        self.reason = reason
+        return outcome
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+
+import os
+import time
+import threading
+
+
+# wall clock marks of a trial, in the order it goes through them
+MARKS = ('env', 'compose', 'created', 'up', 'first-move-base-info', 'first-pose', 'end-marker', 'teardown', 'archived')
+# fields of a container stats sample, see container_runtime.engine_stats
+STAT_FIELDS = ('cpu_percent', 'mem_bytes', 'block_read', 'block_write', 'net_rx', 'net_tx')
+
+
+class StatsSampler(object):
+    """
+    Samples the container stats of a runtime every period_s in a background
+    thread, from start() until stop(). Every sample is kept as
+    (seconds since origin, container name, stats dict)
+    """
+    def __init__(self, runtime, period_s=10.0):
+        super(StatsSampler, self).__init__()
+        self.runtime = runtime
+        self.period_s = period_s
+        self.origin = None
+        self.samples = []
+        self.error = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, origin=None):
+        self.origin = origin if origin is not None else time.time()
+        self.samples = []
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            at = time.time() - self.origin
+            try:
+                for name, stats in self.runtime.stats().items():
+                    self.samples.append((at, name, stats))
+            except Exception as e:
+                # stats are best effort, a trial never fails over them
+                if self.error is None:
+                    print(f'Container stats unavailable: {e}')
+                self.error = str(e)
+            self.stopping.wait(self.period_s)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.samples
+
+
+def summarize_samples(samples):
+    '''
+    Returns {container: {'cpu_percent_mean', 'cpu_percent_max', 'mem_bytes_max', 'block_read',
+    'block_write', 'net_rx', 'net_tx'}}. The '' entry holds the whole trial: the
+    peaks of the summed cpu and memory of all its containers at one sample time,
+    which is what a slot has to fit in
+    '''
+    summary = {}
+    cpu = {}
+    totals = {}
+    for at, name, stats in samples:
+        entry = summary.setdefault(name, {'cpu_percent_max': 0.0, 'mem_bytes_max': 0.0, 'block_read': 0.0,
+                                          'block_write': 0.0, 'net_rx': 0.0, 'net_tx': 0.0})
+        cpu.setdefault(name, []).append(stats['cpu_percent'])
+        entry['cpu_percent_max'] = max(entry['cpu_percent_max'], stats['cpu_percent'])
+        entry['mem_bytes_max'] = max(entry['mem_bytes_max'], stats['mem_bytes'])
+        # io counters are cumulative since the container started
+        for field in ('block_read', 'block_write', 'net_rx', 'net_tx'):
+            entry[field] = max(entry[field], stats[field])
+        total = totals.setdefault(at, [0.0, 0.0])
+        total[0] += stats['cpu_percent']
+        total[1] += stats['mem_bytes']
+    for name, values in cpu.items():
+        summary[name]['cpu_percent_mean'] = sum(values)/len(values)
+    if totals:
+        summary[''] = {
+            'cpu_percent_mean': sum(cpu for cpu, _ in totals.values())/len(totals),
+            'cpu_percent_max': max(cpu for cpu, _ in totals.values()),
+            'mem_bytes_max': max(mem for _, mem in totals.values()),
+        }
+    return summary
+
+
+def write_metrics(path, campaign, trial, outcome, phases, marks, summary, outcome_counts):
+    '''
+    Writes the last finished trial and the campaign outcome counts in the
+    Prometheus text format, e.g. for the node exporter textfile collector
+    '''
+    labels = f'campaign="{campaign}",trial="{trial["id"]}",code="{trial["code"]}"'
+    lines = ['# TYPE morsesim_trials gauge']
+    for name, count in sorted(outcome_counts.items()):
+        lines.append(f'morsesim_trials{{campaign="{campaign}",outcome="{name}"}} {count}')
+    lines.append('# TYPE morsesim_trial_outcome gauge')
+    lines.append(f'morsesim_trial_outcome{{{labels},outcome="{outcome}"}} 1')
+    lines.append('# TYPE morsesim_trial_phase_seconds gauge')
+    for phase, duration in phases.items():
+        lines.append(f'morsesim_trial_phase_seconds{{{labels},phase="{phase}"}} {duration:.3f}')
+    lines.append('# TYPE morsesim_trial_mark_seconds gauge')
+    for mark, at in marks.items():
+        lines.append(f'morsesim_trial_mark_seconds{{{labels},mark="{mark}"}} {at:.3f}')
+    for field in ('cpu_percent_mean', 'cpu_percent_max', 'mem_bytes_max', 'block_read', 'block_write', 'net_rx', 'net_tx'):
+        lines.append(f'# TYPE morsesim_container_{field} gauge')
+        for name, entry in sorted(summary.items()):
+            if field in entry:
+                container = name if name else 'all'
+                lines.append(f'morsesim_container_{field}{{{labels},container="{container}"}} {entry[field]:.1f}')
+    with open(path+'.tmp', 'w') as file:
+        file.write('\n'.join(lines)+'\n')
+    os.replace(path+'.tmp', path)
@@ -0,0 +1,171 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import argparse
+import threading
+from collections import OrderedDict
+
+
+# a whole JSON string (brackets inside it are not structure) or one structural bracket
+JSON_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+INDEX_VERSION = 1
+
+
+def scan_array(data):
+    '''
+    Returns the (start, end) byte offsets of the elements of the top level JSON
+    array in data, without parsing them. The elements must be objects or arrays,
+    as the trials are
+    '''
+    spans = []
+    depth = 0
+    start = None
+    for match in JSON_TOKEN.finditer(data):
+        token = match.group()[:1]
+        if token in b'[{':
+            depth += 1
+            if depth == 2:
+                start = match.start()
+        elif token in b']}':
+            depth -= 1
+            if depth == 1:
+                spans.append((start, match.end()))
+    return spans
+
+
+def scan_lines(data):
+    spans = []
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start)
+        end = len(data) if end < 0 else end
+        if data[start:end].strip():
+            spans.append((start, end))
+        start = end + 1
+    return spans
+
+
+class TrialSource(object):
+    """
+    Read only sequence of the trials of a trials.json (a JSON array) or
+    trials.jsonl (JSON Lines) file. Only a byte offset index is loaded: trials are
+    read when accessed, the bytes of the last cache_size of them kept, so startup
+    time and memory do not grow with the campaign. Every access parses a new
+    trial, which the caller may change. The index, with the id and code of every
+    trial, is cached in <path>.idx until the file changes. Safe to share between threads.
+    """
+    def __init__(self, path, cache_size=64):
+        super(TrialSource, self).__init__()
+        self.path = path
+        self.cache_size = cache_size
+        # idx -> bytes of the trial, least recently used first
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDONLY)
+        self.index_path = path+'.idx'
+        self.spans, self.ids, self.codes = self.load_index()
+        self.by_code = {code: idx for idx, code in enumerate(self.codes)}
+
+    def load_index(self):
+        stat = os.fstat(self.fd)
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if (index['version'], index['size'], index['mtime_ns']) == (INDEX_VERSION, stat.st_size, stat.st_mtime_ns):
+                return [tuple(span) for span in index['spans']], index['ids'], index['codes']
+        except (OSError, ValueError, KeyError):
+            pass
+        spans, ids, codes = self.build_index()
+        index = {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'spans': spans, 'ids': ids, 'codes': codes}
+        # the index is only a cache, a read only trials directory just means rebuilding it every time
+        try:
+            with open(self.index_path+'.tmp', 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(self.index_path+'.tmp', self.index_path)
+        except OSError:
+            pass
+        return spans, ids, codes
+
+    def build_index(self):
+        if os.fstat(self.fd).st_size == 0:
+            return [], [], []
+        with mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ) as data:
+            spans = scan_lines(data) if self.path.endswith('.jsonl') else scan_array(data)
+            ids = []
+            codes = []
+            for start, end in spans:
+                trial = json.loads(data[start:end])
+                ids.append(trial["id"])
+                codes.append(trial["code"])
+        return spans, ids, codes
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self.spans)
+        # parsing the cached bytes again is cheaper than a deep copy of a shared trial
+        return json.loads(self.read(idx))
+
+    def read(self, idx):
+        with self.lock:
+            data = self.cache.get(idx)
+            if data is not None:
+                self.cache.move_to_end(idx)
+                return data
+        start, end = self.spans[idx]
+        data = os.pread(self.fd, end - start, start)
+        with self.lock:
+            self.cache[idx] = data
+            self.cache.move_to_end(idx)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
+
+    def __iter__(self):
+        for idx in range(len(self.spans)):
+            yield self[idx]
+
+    def index_of(self, code):
+        return self.by_code[code]
+
+    def close(self):
+        os.close(self.fd)
+
+
+def write_trials(trials, path):
+    '''
+    Writes trials as JSON Lines when path ends with .jsonl, as an indented JSON array otherwise
+    '''
+    with open(path+'.tmp', 'w') as f:
+        if path.endswith('.jsonl'):
+            for trial in trials:
+                f.write(json.dumps(trial, sort_keys=True)+'\n')
+        else:
+            json.dump(list(trials), f, indent=4, sort_keys=True)
+    os.replace(path+'.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index trial files and convert them to JSON Lines')
+    parser.add_argument('path', help='trials file, .json (array) or .jsonl')
+    parser.add_argument('--to-jsonl', metavar='OUT', help='write the trials as JSON Lines to OUT')
+    parser.add_argument('--show', nargs='*', metavar='CODE', help='print the trials with these codes')
+    args = parser.parse_args()
+    start = time.time()
+    source = TrialSource(args.path)
+    print(f'{len(source)} trials indexed in {time.time() - start:.3f} s', file=sys.stderr)
+    if args.to_jsonl:
+        write_trials(source, args.to_jsonl)
+    for code in args.show or []:
+        print(json.dumps(source[source.index_of(code)], indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from results_store import RUNNING, FAILED
+
+
+class Lease(object):
+    """A trial handed out to a worker until expires, extended by its heartbeats"""
+    def __init__(self, lease_id, idx, worker, lease_s):
+        super(Lease, self).__init__()
+        self.lease_id = lease_id
+        self.idx = idx
+        self.worker = worker
+        self.lease_s = lease_s
+        self.expires = time.time() + lease_s
+
+    def renew(self):
+        self.expires = time.time() + self.lease_s
+
+
+class Coordinator(object):
+    """
+    Owns the queue of a campaign and leases its trials to workers over HTTP.
+    A lease not renewed within lease_s (the worker died or lost the network)
+    is requeued, until the trial used up max_attempts. Results and logs are
+    uploaded by the workers and recorded in the coordinator's results store.
+
+        POST /lease      {worker}                        -> {lease, idx, trial, campaign, lease_s} | {wait} | {done}
+        POST /heartbeat  {lease}                         -> {} or 409 when the lease is gone
+        POST /complete   {lease, outcome, ..., log}      -> {}, 409 or 400 for a bad log name
+        POST /fail       {lease, reason}                 -> {} or 409
+        GET  /status                                     -> {counts, queued, leased}
+    """
+    def __init__(self, trials, sim_list, results, campaign, archive_dir, lease_s=120, max_attempts=3):
+        super(Coordinator, self).__init__()
+        self.trials = trials
+        self.results = results
+        self.campaign = campaign
+        self.archive_dir = archive_dir
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.queue = deque(sim_list)
+        self.leases = {}
+        # one lock for the queue, the leases and the shared sqlite connection
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        # the address actually bound, set once serve listens (port 0 picks a free one)
+        self.address = None
+        self.listening = threading.Event()
+        if not self.queue:
+            self.finished.set()
+
+    def attempts(self, idx):
+        return self.results.trial_states(self.campaign)[self.trials[idx]["code"]][1]
+
+    def lease(self, worker):
+        with self.lock:
+            self.reap()
+            if not self.queue:
+                return {'done': True} if not self.leases else {'wait': min(self.lease_s/4, 5)}
+            idx = self.queue.popleft()
+            lease = Lease(uuid.uuid4().hex, idx, worker, self.lease_s)
+            self.leases[lease.lease_id] = lease
+            self.results.set_trial_state(self.campaign, self.trials[idx]["code"], RUNNING, f'leased to {worker}')
+        print(f"Trial #{idx} ({self.trials[idx]['code']}) leased to {worker}")
+        return {'lease': lease.lease_id, 'idx': idx, 'trial': self.trials[idx], 'campaign': self.campaign,
+                'lease_s': self.lease_s}
+
+    def heartbeat(self, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            lease.renew()
+        return {}
+
+    def complete(self, lease_id, report):
+        # the name comes from the network, it must not lead out of the archive
+        log_name = os.path.basename(report.get('log_name') or '')
+        if not log_name or log_name.startswith('.'):
+            raise ValueError(f'invalid log name {report.get("log_name")!r}')
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return None
+            trial = self.trials[lease.idx]
+            log_path = os.path.join(self.archive_dir, log_name)
+            with open(log_path, 'w') as logfile:
+                logfile.write(report['log'])
+            self.results.record_trial(self.campaign, trial, report['outcome'], report['wall_clock'], report['phases'],
+                                      report['lines'], log_path, report['marks'], report['samples'])
+            self.check_finished()
+        print(f"Trial #{lease.idx} ({trial['code']}) finished by {lease.worker}: {report['outcome']}")
+        return {}
+
+    def fail(self, lease_id, reason):
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return None
+            self.release(lease, reason)
+        return {}
+
+    def release(self, lease, reason):
+        # called with the lock held: records the failure and requeues the trial if it has attempts left
+        code = self.trials[lease.idx]["code"]
+        self.results.set_trial_state(self.campaign, code, FAILED, reason)
+        if self.attempts(lease.idx) < self.max_attempts:
+            self.queue.append(lease.idx)
+            print(f"Trial #{lease.idx} ({code}) requeued: {reason}")
+        else:
+            print(f"Trial #{lease.idx} ({code}) given up: {reason}")
+        self.check_finished()
+
+    def reap(self):
+        # called with the lock held
+        now = time.time()
+        for lease in [lease for lease in self.leases.values() if lease.expires < now]:
+            del self.leases[lease.lease_id]
+            self.release(lease, f'lease of {lease.worker} expired')
+
+    def check_finished(self):
+        if not self.queue and not self.leases:
+            self.finished.set()
+
+    def status(self):
+        with self.lock:
+            return {'counts': self.results.outcome_counts(self.campaign), 'queued': len(self.queue),
+                    'leased': len(self.leases)}
+
+    def serve(self, host='0.0.0.0', port=8765, linger_s=10):
+        '''
+        Serves until every trial is settled, then lingers so polling workers learn they are done
+        '''
+        server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+        server.coordinator = self
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.address = server.server_address
+        self.listening.set()
+        print(f"Coordinator of campaign {self.campaign} listening on {host}:{self.address[1]}, "
+              f"{len(self.queue)} trials queued")
+        while not self.finished.wait(1):
+            with self.lock:
+                self.reap()
+        time.sleep(linger_s)
+        server.shutdown()
+        server.server_close()
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # progress is printed by the coordinator, not one line per request
+        pass
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            return self.reply(200, self.server.coordinator.status())
+        self.reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        coordinator = self.server.coordinator
+        try:
+            if self.path == '/lease':
+                result = coordinator.lease(body.get('worker', self.client_address[0]))
+            elif self.path == '/heartbeat':
+                result = coordinator.heartbeat(body['lease'])
+            elif self.path == '/complete':
+                result = coordinator.complete(body['lease'], body)
+            elif self.path == '/fail':
+                result = coordinator.fail(body['lease'], body.get('reason'))
+            else:
+                return self.reply(404, {'error': f'unknown path {self.path}'})
+        except (KeyError, ValueError) as e:
+            return self.reply(400, {'error': str(e)})
+        if result is None:
+            return self.reply(409, {'error': 'lease expired or unknown'})
+        self.reply(200, result)
+
+
+class CoordinatorClient(object):
+    """JSON over HTTP calls to a Coordinator"""
+    def __init__(self, url, timeout_s=60):
+        super(CoordinatorClient, self).__init__()
+        self.url = url.rstrip('/')
+        self.timeout_s = timeout_s
+
+    def call(self, path, body=None):
+        '''
+        Returns the decoded reply, None when the coordinator no longer knows the lease (409)
+        '''
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url+path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                return None
+            raise
+
+
+class RemoteResults(object):
+    """
+    Stands in for the ResultsStore of an Orchestrator running a leased trial:
+    the result and the archived log go to the coordinator instead of the local store
+    """
+    def __init__(self, client, lease_id):
+        super(RemoteResults, self).__init__()
+        self.client = client
+        self.lease_id = lease_id
+
+    def record_trial(self, campaign, trial, outcome, wall_clock, phases, lines, log_path=None, marks=None, samples=None,
+                     container_logs=None):
+        # the container logs are too big to upload, they stay in the log dir of the worker
+        with open(log_path) as logfile:
+            log = logfile.read()
+        reply = self.client.call('/complete', {
+            'lease': self.lease_id, 'outcome': outcome, 'wall_clock': wall_clock, 'phases': phases,
+            'lines': lines, 'marks': marks or {}, 'samples': samples or [],
+            'log_name': os.path.basename(log_path), 'log': log,
+        })
+        if reply is None:
+            print(f"Result of trial #{trial['id']} dropped, its lease expired")
+
+    def set_trial_state(self, campaign, code, state, reason=None):
+        # the coordinator marks leased trials running itself, only failures are reported
+        if state == FAILED:
+            self.fail_trial(campaign, code, reason)
+
+    def fail_trial(self, campaign, code, reason=None):
+        # a lease already completed is gone, the coordinator ignores its failure (409)
+        return self.client.call('/fail', {'lease': self.lease_id, 'reason': reason}) is not None
+
+    def outcome_counts(self, campaign):
+        return self.client.call('/status')['counts']
+
+
+class Worker(object):
+    """
+    Pulls trials from a coordinator and runs them through an Orchestrator,
+    renewing the lease while the trial runs
+    """
+    def __init__(self, url, orchestrator, name=None, retries=5):
+        super(Worker, self).__init__()
+        self.client = CoordinatorClient(url)
+        self.orchestrator = orchestrator
+        slot = '' if orchestrator.slot is None else f'/slot{orchestrator.slot}'
+        self.name = name if name is not None else f'{socket.gethostname()}:{os.getpid()}{slot}'
+        self.retries = retries
+
+    def run(self):
+        failures = 0
+        while True:
+            try:
+                reply = self.client.call('/lease', {'worker': self.name})
+            except (urllib.error.URLError, ConnectionError) as e:
+                # the coordinator may be restarting, it resumes the campaign from its store
+                failures += 1
+                if failures > self.retries:
+                    print(f"{self.name}: coordinator unreachable ({e}), stopping")
+                    return
+                time.sleep(5*failures)
+                continue
+            failures = 0
+            if reply.get('done'):
+                print(f"{self.name}: campaign finished")
+                return
+            if 'lease' not in reply:
+                time.sleep(reply.get('wait', 5))
+                continue
+            try:
+                self.run_lease(reply)
+            except (urllib.error.URLError, ConnectionError) as e:
+                # the result could not be uploaded, the lease expires and the trial is requeued
+                print(f"{self.name}: trial #{reply['idx']} not reported: {e}")
+
+    def run_lease(self, lease):
+        idx = lease['idx']
+        orchestrator = self.orchestrator
+        orchestrator.config = {idx: lease['trial']}
+        orchestrator.campaign = lease['campaign']
+        orchestrator.results = RemoteResults(self.client, lease['lease'])
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(lease, stop), daemon=True)
+        heartbeat.start()
+        try:
+            orchestrator.run_checkpointed(idx)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def heartbeat(self, lease, stop):
+        while not stop.wait(lease['lease_s']/3):
+            try:
+                reply = self.client.call('/heartbeat', {'lease': lease['lease']})
+            except (urllib.error.URLError, ConnectionError) as e:
+                print(f"{self.name}: heartbeat failed: {e}")
+                continue
+            if reply is None:
+                # requeued elsewhere, stop wasting the slot on it
+                print(f"{self.name}: lease of trial #{lease['idx']} lost, aborting it")
+                self.orchestrator.endsim = 'lease-lost'
+                return
+
+
+def run_workers(url, orchestrators):
+    # one worker per slot, each one pulling its own trials
+    workers = [Worker(url, orchestrator) for orchestrator in orchestrators]
+    threads = [threading.Thread(target=worker.run, daemon=True) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for orchestrator in orchestrators:
+        orchestrator.shutdown_pool()